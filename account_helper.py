@@ -0,0 +1,152 @@
+"""Account deletion: the user is deactivated at once, then their data is worked through in small batches in the background"""
+
+from sqlalchemy import select, update, delete, func, desc, nulls_last
+from sqlalchemy.orm import lazyload
+from datetime import datetime
+import logging
+import secrets
+
+from model import (db, User, Recipe, Edit, Experiment, Permission, AccountDeletion,
+                   log_changes, item_change_row, permission_change_row)
+import permissions_helper as ph
+import response_cache as rc
+
+logger = logging.getLogger(__name__)
+BATCH_SIZE = 50 # rows per transaction, so no batch holds locks on more than this many recipes (or edits...)
+
+def request_deletion(user: User) -> AccountDeletion:
+    """Deactivate the user -- no more logins, tokens or profile -- and record the deletion for run_deletion() to carry out.
+    Doesn't commit."""
+    now = datetime.utcnow()
+    user.deactivated_at = now
+    user.token = None
+    user.token_expiration = None
+    job = AccountDeletion(id=secrets.token_hex(16), user_id=user.id, status='pending', requested_at=now, updated_at=now,
+                          recipes_total=db.session.scalar(select(func.count(Recipe.id)).where(Recipe.user_id == user.id)))
+    db.session.add(job)
+    rc.cache.invalidate_after_commit({f'profile:{user.id}'})
+    return job
+
+def get_pending_deletion(user_id: int) -> AccountDeletion | None:
+    return db.session.scalars(select(AccountDeletion).where(AccountDeletion.user_id == user_id)
+                              .where(AccountDeletion.status != 'done')).first()
+
+#################### Batches ####################
+# Each step does at most batch_size rows and returns whether it did anything; run_deletion() calls them in order
+# until none has anything left. Everything is re-read from the db, so a crashed or stopped job just picks up again.
+
+def _new_owners(recipe_ids: list[int]) -> dict[int, int]:
+    """recipe_id -> the collaborator with the most access to it (can_edit before can_experiment), if any"""
+    # SELECT DISTINCT ON (recipe_id) recipe_id, user_id FROM permissions JOIN users ...
+    # ORDER BY recipe_id, can_edit DESC NULLS LAST, can_experiment DESC NULLS LAST, user_id
+    stmt = (select(Permission.recipe_id, Permission.user_id).join(Permission.user)
+            .where(Permission.recipe_id.in_(recipe_ids)).where(User.deactivated_at.is_(None))
+            .distinct(Permission.recipe_id)
+            .order_by(Permission.recipe_id, nulls_last(desc(Permission.can_edit)),
+                      nulls_last(desc(Permission.can_experiment)), Permission.user_id))
+    return dict(db.session.execute(stmt).all())
+
+def _hand_off_recipes(job: AccountDeletion, batch_size: int) -> bool:
+    """Give each of the user's recipes to its top collaborator; delete the ones nobody else has access to"""
+    recipes = db.session.scalars(select(Recipe).where(Recipe.user_id == job.user_id).order_by(Recipe.id).limit(batch_size)
+                                 .options(lazyload(Recipe.edits))).all()
+    new_owners = _new_owners([recipe.id for recipe in recipes])
+    for recipe in recipes:
+        rc.cache.invalidate_after_commit(rc.recipe_tags(recipe))
+        new_owner_id = new_owners.get(recipe.id)
+        if new_owner_id is not None:
+            # owners don't hold a permission on their own recipe
+            db.session.delete(Permission.get_by_user_and_recipe(new_owner_id, recipe.id))
+            Recipe.adjust_counts(recipe.id, collaborators=-1)
+            recipe.user_id = new_owner_id
+            rc.cache.invalidate_after_commit({f'profile:{new_owner_id}'})
+            job.recipes_transferred += 1
+            continue
+        # nobody (still active) to hand it to
+        if recipe.forked_from:
+            Recipe.adjust_counts(recipe.forked_from, forks=-1)
+            rc.cache.invalidate_after_commit(rc.recipe_tags(recipe.parent))
+        for fork in Recipe.delete_with_history(recipe.id):
+            rc.cache.invalidate_after_commit(rc.recipe_tags(fork))
+        job.recipes_deleted += 1
+    return bool(recipes)
+
+def _revoke_access(job: AccountDeletion, batch_size: int) -> bool:
+    """Remove the user from recipes shared with them"""
+    pairs = db.session.execute(select(Permission.user_id, Permission.recipe_id)
+                               .where(Permission.user_id == job.user_id).limit(batch_size)).all()
+    revoked = ph.delete_permissions([tuple(pair) for pair in pairs])
+    log_changes([permission_change_row(recipe_id, user_id, 'delete') for user_id, recipe_id in revoked])
+    for _, recipe_id in revoked:
+        Recipe.adjust_counts(recipe_id, collaborators=-1)
+        rc.cache.invalidate_after_commit(rc.recipe_tags(db.session.get(Recipe, recipe_id)))
+    return bool(pairs)
+
+def _withdraw_pending_edits(job: AccountDeletion, batch_size: int) -> bool:
+    """Drop edits the user proposed that nobody has approved yet"""
+    pending = db.session.scalars(select(Edit).where(Edit.commit_by == job.user_id).where(Edit.pending_approval == True)
+                                 .limit(batch_size)).all()
+    for edit in pending:
+        db.session.delete(edit)
+    return bool(pending)
+
+def _disown_contributions(job: AccountDeletion, batch_size: int) -> bool:
+    """Keep the user's edits and experiments on other people's recipes, credited to nobody (a deactivated user)"""
+    if job.contributions_total is None: # only known once their own recipes are gone or handed off
+        job.contributions_total = sum(db.session.scalar(select(func.count(model_class.id)).where(model_class.commit_by == job.user_id))
+                                      for model_class in (Edit, Experiment))
+    touched = []
+    for model_class, entity_type in ((Edit, 'edit'), (Experiment, 'experiment')):
+        ids = select(model_class.id).where(model_class.commit_by == job.user_id).limit(batch_size - len(touched))
+        rows = db.session.execute(update(model_class).where(model_class.id.in_(ids.scalar_subquery())).values(commit_by=None)
+                                  .returning(model_class.id, model_class.recipe_id)
+                                  .execution_options(synchronize_session=False)).all()
+        touched += [(entity_type, recipe_id, item_id) for item_id, recipe_id in rows]
+        if len(touched) >= batch_size:
+            break
+    log_changes([item_change_row(entity_type, recipe_id, item_id) for entity_type, recipe_id, item_id in touched])
+    rc.cache.invalidate_after_commit({f'recipe:{recipe_id}' for _, recipe_id, _ in touched})
+    job.contributions_done += len(touched)
+    return bool(touched)
+
+def _delete_user(job: AccountDeletion, batch_size: int) -> bool:
+    db.session.execute(delete(User).where(User.id == job.user_id)) # their feed goes with them (ON DELETE CASCADE)
+    return False
+
+STEPS = (_hand_off_recipes, _revoke_access, _withdraw_pending_edits, _disown_contributions, _delete_user)
+
+#################### Running ####################
+def run_deletion(job_id: str, batch_size: int = BATCH_SIZE) -> bool:
+    """Carry out a deletion, one batch per transaction. Returns whether it's done.
+
+    The job's row is locked (FOR UPDATE SKIP LOCKED) for each batch, so a second runner for the same job just returns.
+    """
+    while True:
+        job = db.session.scalars(select(AccountDeletion).where(AccountDeletion.id == job_id)
+                                 .with_for_update(skip_locked=True)).first()
+        if job is None or job.status == 'done':
+            db.session.rollback()
+            return job is not None
+        try:
+            job.status = 'running'
+            did_work = any(step(job, batch_size) for step in STEPS)
+            job.updated_at = datetime.utcnow()
+            if not did_work:
+                job.status = 'done'
+                job.finished_at = job.updated_at
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.exception('Account deletion %s failed', job_id)
+            db.session.execute(update(AccountDeletion).where(AccountDeletion.id == job_id)
+                               .values(status='failed', error=type(e).__name__, updated_at=datetime.utcnow()))
+            db.session.commit()
+            return False
+        if not did_work:
+            return True
+
+def resume_deletions() -> int:
+    """Run every deletion that hasn't finished (crashed, stopped with the server, or failed). Returns how many finished."""
+    job_ids = db.session.scalars(select(AccountDeletion.id).where(AccountDeletion.status != 'done')
+                                 .order_by(AccountDeletion.requested_at)).all()
+    return sum(run_deletion(job_id) for job_id in job_ids)
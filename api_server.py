@@ -1,31 +1,101 @@
 """API Server for Forkd"""
 
-from flask import (Flask, request, jsonify)
-from dotenv import load_dotenv # COMMENT OUT WHEN BUILDING IMAGE
-import requests
+from flask import (Blueprint, Flask, Response, current_app, request, jsonify, stream_with_context)
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 from werkzeug.http import HTTP_STATUS_CODES
-import cloudinary.uploader
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 import model
 import permissions_helper as ph
-
+import feed_helper as fh
+import sync_helper as sh
+import ingredients_helper as ih
+import similarity_helper as sim
+import response_helper as rh
+import dto_helper as dh
+import response_cache as rc
+import archive_helper as ah
+import account_helper as acc
+import events_helper as eh
+import deadline
+import pubsub
+import metrics
+import tasks
+from rate_limit import RateLimiter
+from idempotency import Idempotency
+from http_client import HttpClient, UpstreamError, CircuitOpen
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+
+import math
 import re
 import os
-from datetime import datetime
+import time
+from datetime import datetime, timedelta, timezone
+from collections import Counter
 
 
-load_dotenv() # COMMENT OUT WHEN BUILDING IMAGE
-SPOONACULAR_KEY = os.environ['SPOONACULAR_KEY']
-CLOUDINARY_KEY = os.environ['CLOUDINARY_KEY']
-CLOUDINARY_SECRET = os.environ['CLOUDINARY_SECRET']
-RDS_URI = os.environ['RDS_URI'] # for prod
-DEV_URI = os.environ['DEV_URI']
 CLOUD_NAME = 'dw0c9rwkd'
 
-app = Flask(__name__)
-app.secret_key = os.environ['FLASK_KEY']
-# model.connect_to_db(app, RDS_URI, False)      # using Amazon RDS instance, uncomment to build image
+api = Blueprint('api', __name__)
+limiter = RateLimiter()
+idempotency = Idempotency()
+outbound = HttpClient() # Spoonacular and Cloudinary
+
+def create_app(config: dict | None = None) -> Flask:
+    """Build the app. Settings come from the environment (and .env, if python-dotenv is installed), then config.
+
+    DB_URI is username:password@host:port/db_name, as for model.connect_to_db(); it defaults to $RDS_URI.
+    Nothing here talks to the db or to Cloudinary/Spoonacular, so it's safe to run in gunicorn's master (--preload).
+    """
+    try:
+        from dotenv import load_dotenv # dev only; not in the image
+        load_dotenv()
+    except ImportError:
+        pass
+    app = Flask(__name__)
+    app.config.update(SECRET_KEY=os.environ.get('FLASK_KEY'),
+                      DB_URI=os.environ.get('RDS_URI'),
+                      SPOONACULAR_KEY=os.environ.get('SPOONACULAR_KEY'),
+                      CLOUDINARY_KEY=os.environ.get('CLOUDINARY_KEY'),
+                      CLOUDINARY_SECRET=os.environ.get('CLOUDINARY_SECRET'),
+                      RATELIMIT_BACKEND=os.environ.get('RATELIMIT_BACKEND', 'database'), # shared by all gunicorn workers
+                      RESPONSE_CACHE_BACKEND=os.environ.get('RESPONSE_CACHE_BACKEND', 'database'), # invalidated in every worker
+                      PUBSUB_BACKEND=os.environ.get('PUBSUB_BACKEND', 'postgres'), # live updates reach every worker
+                      PROXY_HOPS=int(os.environ.get('PROXY_HOPS', 1)), # proxies in front of us (the frontend container's)
+                      HTTP_UPSTREAMS={name: {'base_url': os.environ[variable]} # e.g. upstream_stubs.py, to work offline
+                                      for name, variable in (('spoonacular', 'SPOONACULAR_URL'), ('cloudinary', 'CLOUDINARY_API_URL'))
+                                      if os.environ.get(variable)})
+    app.config.update(config or {})
+    if not app.config['DB_URI']:
+        raise RuntimeError('No database: set RDS_URI, or pass DB_URI in config')
+
+    if app.config['PROXY_HOPS']: # remote_addr is the client's, from X-Forwarded-For, not the proxy's
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_HOPS'])
+    rh.init_app(app) # gzip/brotli compression of responses
+    deadline.init_app(app) # per-route time budgets, passed on as statement_timeout and HTTP timeouts
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {'pool_timeout': 5}) # seconds to wait for a free connection
+    limiter.init_app(app)
+    idempotency.init_app(app) # Idempotency-Key on POSTs that create things, so clients can retry them
+    outbound.init_app(app) # pooled sessions, retries and circuit breakers for upstream APIs
+    rc.cache.init_app(app) # public timelines and profiles, invalidated on write
+    pubsub.hub.init_app(app) # wakes /api/recipes/<id>/events streams when a recipe changes
+    app.config.setdefault('EVENTS_MAX_STREAMS', 12) # per worker; keep it below gunicorn's threads, so requests still get one
+    app.config.setdefault('EVENTS_STREAM_SECONDS', 300) # then the client reconnects, with Last-Event-ID
+    app.register_blueprint(api)
+    model.connect_to_db(app, app.config['DB_URI'], False)
+    os.register_at_fork(after_in_child=lambda: _after_fork(app))
+    return app
+
+def _after_fork(app: Flask) -> None:
+    """In a forked worker: drop the db connections and per-process state inherited from the parent,
+    so workers never share a socket, lock or thread pool"""
+    with app.app_context():
+        model.db.engine.dispose(close=False) # leave the parent's connections open for the parent
+    tasks.reset()
+    limiter.reset()
+    rc.cache.reset()
+    pubsub.hub.reset()
+    outbound.reset()
 
 ### Error response helper
 def error_response(status_code=500, message=None):
@@ -35,6 +105,36 @@ def error_response(status_code=500, message=None):
     response = jsonify(payload)
     response.status_code = status_code
     return response
+
+@api.app_errorhandler(429)
+def rate_limited(error):
+    response = error_response(429, error.description)
+    response.headers['Retry-After'] = error.retry_after
+    return response
+
+@api.app_errorhandler(409)
+@api.app_errorhandler(422)
+def idempotency_error(error):
+    return error_response(error.code, error.description)
+
+@api.app_errorhandler(deadline.DeadlineExceeded)
+def deadline_exceeded(error):
+    model.db.session.rollback() # a cancelled statement leaves the transaction unusable
+    return error_response(504, 'The request took too long')
+
+@api.app_errorhandler(UpstreamError)
+def upstream_failed(error):
+    response = error_response(error.status_code, str(error))
+    if isinstance(error, CircuitOpen):
+        response.headers['Retry-After'] = str(math.ceil(error.retry_after))
+    return response
+
+@api.app_errorhandler(PoolTimeout)
+def db_pool_exhausted(error):
+    metrics.incr('db.pool_timeouts')
+    response = error_response(503, 'Too busy, try again shortly')
+    response.headers['Retry-After'] = '1'
+    return response
     
 
 ##################### Endpoint '/api/tokens' ---- for login ############################
@@ -55,7 +155,8 @@ def basic_auth_error(status):
     return '', 403
 
 # POST -- expects Basic Auth Header
-@app.route('/api/tokens', methods=['POST']) # login - give a token
+@api.route('/api/tokens', methods=['POST']) # login - give a token
+@limiter.limit('login') # before auth, so throttled attempts don't cost an Argon2 verify
 @basic_auth.login_required
 def get_token():
     token = basic_auth.current_user().get_token()
@@ -72,8 +173,13 @@ def verify_token(token):
 def token_auth_error(status):
     return error_response(status)
 
+@idempotency.user_id_loader
+def idempotency_user_id():
+    user = token_auth.current_user()
+    return user.id if isinstance(user, model.User) else None
+
 # DELETE -- expects Authentication: Bearer Header, logout - revoke token
-@app.route('/api/tokens', methods=['DELETE'])
+@api.route('/api/tokens', methods=['DELETE'])
 @token_auth.login_required
 def revoke_token():
     if token_auth.current_user() == 'expired':
@@ -81,14 +187,29 @@ def revoke_token():
     
     if token_auth.current_user().is_temp_user:
         submitter = token_auth.current_user()
+        rc.cache.invalidate_after_commit(rc.user_tags(submitter.id))
+        # forks of anything about to be deleted need their own copy of its content first
+        model.Edit.materialize_copies_of([edit.id for edit in submitter.committed_edits])
         for recipe in submitter.recipes:
-            model.db.session.delete(recipe)
+            if recipe.forked_from:
+                model.Recipe.adjust_counts(recipe.forked_from, forks=-1)
+                rc.cache.invalidate_after_commit(rc.recipe_tags(recipe.parent))
+            model.Recipe.delete_with_history(recipe.id) # forks are already in user_tags()
         model.db.session.commit()
         # go through all their edits, experiments and delete (basically in other's recipes)
+        removed = {}
         for edit in submitter.committed_edits:
+            if not edit.pending_approval: # pending ones were never counted
+                removed.setdefault(edit.recipe_id, Counter())['edits'] -= 1
             model.db.session.delete(edit)
         for experiment in submitter.committed_experiments:
+            removed.setdefault(experiment.recipe_id, Counter())['experiments'] -= 1
             model.db.session.delete(experiment)
+        for permission in submitter.permissions: # deleted along with the user
+            removed.setdefault(permission.recipe_id, Counter())['collaborators'] -= 1
+            rc.cache.invalidate_after_commit(rc.recipe_tags(permission.recipe))
+        for recipe_id, counts in removed.items():
+            model.Recipe.adjust_counts(recipe_id, **counts)
         model.db.session.delete(submitter)
     else:
         token_auth.current_user().revoke_token()
@@ -98,7 +219,7 @@ def revoke_token():
 
 # GET /api/me -- expects Authentication: Bearer Header containing session token
 # returns user details corresponding to the session token
-@app.route('/api/me')
+@api.route('/api/me')
 @token_auth.login_required
 def get_user():
     user = token_auth.current_user()
@@ -110,12 +231,13 @@ def get_user():
 
 ################ Endpoint '/api/users' ############################
 # GET -- return all users; unused in Frontend
-@app.route('/api/users')
+@api.route('/api/users')
 def read_all_users():
     return [user.to_dict() for user in model.User.get_all()], 200
 
 # POST -- create a new user
-@app.route('/api/users', methods=['POST'])
+@api.route('/api/users', methods=['POST'])
+@limiter.limit('signup')
 def create_user():
     """Creates a new user.
 
@@ -154,7 +276,7 @@ def create_user():
 
 ################ Endpoint '/api/users/<username>' ############################
 # GET -- return user details and list of recipes
-@app.route('/api/users/<username>')
+@api.route('/api/users/<username>')
 @token_auth.login_required(optional=True)
 def read_user_profile(username):
     """Gets a user's profile -- user details, plus their viewable recipes. Token auth is optional, but determines which recipes are visible depending on permissions.
@@ -177,51 +299,95 @@ def read_user_profile(username):
                                              is_experiments_public: <bool>,
                                              is_public: <bool>,
                                              last_modified: <datetime>,
+                                             edit_count, experiment_count, fork_count, 
+                                             collaborator_count: <int, how many users it's shared with>
                                             }>,
                  (shared_with_me): <list, similar to recipes above. only if viewer is viewing their own username>}
+    Query string: sort=<recent (default) | edits | experiments | forks | collaborators>, most first
+                  view=summary -- recipes carry only what a list shows: no description or forked_from_username/avatar
+                  fields=<comma-separated keys, e.g. id,title,last_modified> -- recipes carry only these (and id)
     """
     viewer = token_auth.current_user()
     status = 200
     if viewer == 'expired': 
         status = 401
         viewer = None
+    sort = request.args.get('sort', 'recent')
+    if sort not in ph.RECIPE_SORTS:
+        return error_response(400, f'sort must be one of {", ".join(ph.RECIPE_SORTS)}')
+    try:
+        fields = rh.requested_fields(request.args)
+    except ValueError as e:
+        return error_response(400, str(e))
 
     owner = model.User.get_by_username(username)
-    if not owner:
+    if not owner or owner.deactivated_at:
         return error_response(404)
 
+    # anyone nothing's been shared with sees the same profile, so that one is cached
+    is_public_view = status == 200 and viewer is not owner and not ph.has_access_to_any_of(viewer.id if viewer else None, owner.id)
+    if is_public_view:
+        cached = rc.cache.get('profile', f'{owner.id}?sort={sort}{rh.fieldset_key(fields)}', 'public')
+        if cached is not None:
+            return cached
+
     user_details = owner.to_dict()
     
+    # recipe lists are generators, streamed out in batches as they're read from the db
+    # as plain rows (dto_helper) rather than Recipes, which would each load every edit just for the card's title
     if viewer is not owner:
-        viewable_recipes = ph.get_viewable_recipes(owner.id, viewer.id if viewer else None)
-        user_details['recipes'] = [recipe.to_dict() for recipe in viewable_recipes]
+        viewable_recipes = ph.select_viewable_cards(owner.id, viewer.id if viewer else None, sort)
+        user_details['recipes'] = dh.iter_rows(viewable_recipes, dh.RecipeCard, fields)
     else:
         # return everything the user owns, plus everything shared with them
-        own_recipes = owner.recipes
-        shared_recipes = ph.get_shared_with_me(owner.id)
-        user_details['recipes'] = [recipe.to_dict() for recipe in own_recipes]
-        user_details['shared_with_me'] = [recipe.to_dict() for recipe in shared_recipes]
-    return user_details, status
-
-# DELETE -- Delete this user -- UNIMPLEMENTED, returns 501
-@app.route('/api/users/<id>', methods=['DELETE'])
+        user_details['recipes'] = dh.iter_rows(ph.select_own_cards(owner.id, sort), dh.RecipeCard, fields)
+        user_details['shared_with_me'] = dh.iter_rows(ph.select_shared_cards(owner.id, sort), dh.RecipeCard, fields)
+    if is_public_view:
+        return rc.cache.store(rh.stream_json(user_details), 'profile', f'{owner.id}?sort={sort}{rh.fieldset_key(fields)}', 'public',
+                              [f'profile:{owner.id}'])
+    return rh.stream_json(user_details, status)
+
+# DELETE -- Delete this user, in the background
+@api.route('/api/users/<int:id>', methods=['DELETE'])
 @token_auth.login_required()
 def delete_user(id):
+    """Delete the logged in user's account. They're logged out and their profile disappears right away;
+    the rest happens in the background:
+    each of their recipes goes to the collaborator with the highest permission on it, or is deleted if there's none,
+    and their edits and experiments on other people's recipes are kept, but no longer credited (commit_by: null).
+
+    Returns:    202, {job_id: <str>, status_url: <poll this (no auth needed) to follow progress>}
+    """
     submitter = token_auth.current_user()
     if submitter == 'expired': 
         return error_response(401)
     if submitter.id != id:
         return error_response(403)
-    # go through user's recipes
-    # get all permissions, and pass ownership to someone with highest permission 
-    # then delete all recipes
-    # then delete user
-    # their edits and experiments in other people's recipes will be kept but dis-associated (put 'deactivated user')
-    return error_response(501) # Not Implemented
+    job = acc.request_deletion(submitter)
+    tasks.run_after_commit(acc.run_deletion, job.id)
+    try:
+        model.db.session.commit()
+    except:
+        return error_response(500, 'Cannot commit to db')
+    status_url = f'/api/account-deletions/{job.id}'
+    return {'job_id': job.id, 'status_url': status_url}, 202, {'Location': status_url}
+
+# GET -- progress of an account deletion
+@api.route('/api/account-deletions/<job_id>')
+def read_account_deletion(job_id):
+    """Returns:    {id, status: <"pending", "running", "done" or "failed" (it will be retried)>,
+                    requested_at, updated_at, finished_at, error,
+                    recipes: {total, transferred, deleted},
+                    contributions: {total: <null until the recipes are done>, done}}
+    """
+    job = model.db.session.get(model.AccountDeletion, job_id)
+    if not job:
+        return error_response(404)
+    return job.to_dict(), 200
     
 
 # PATCH -- Edit user details
-@app.route('/api/users/<id>', methods=['PATCH'])
+@api.route('/api/users/<id>', methods=['PATCH'])
 @token_auth.login_required()
 def update_user(id):
     """Update a user's details.
@@ -274,17 +440,30 @@ def update_user(id):
     elif new_avatar:
         submitter.img_url = new_avatar
     elif file:
-        result = cloudinary.uploader.upload(file, 
-                                            api_key=CLOUDINARY_KEY,
-                                            api_secret=CLOUDINARY_SECRET,
-                                            cloud_name=CLOUD_NAME)
-        img_url = result['secure_url']
+        if not (current_app.config['CLOUDINARY_KEY'] and current_app.config['CLOUDINARY_SECRET']):
+            return error_response(503, 'Image uploads not configured')
+        import cloudinary.utils # only loaded once someone uploads an avatar; just to sign the upload
+        params = {'timestamp': int(time.time())}
+        params['signature'] = cloudinary.utils.api_sign_request(params, current_app.config['CLOUDINARY_SECRET'])
+        res = outbound.request('cloudinary', 'POST', f'/v1_1/{CLOUD_NAME}/image/upload',
+                               data=dict(params, api_key=current_app.config['CLOUDINARY_KEY']),
+                               files={'file': (file.filename, file.read(), file.mimetype)}) # bytes, so a retry resends them
+        if res.status_code != 200:
+            return error_response(400, 'Image upload failed')
+        img_url = res.json()['secure_url']
         submitter.img_url = img_url
-        return {'new_avatar':img_url}, 200
+        rc.cache.invalidate_after_commit(rc.user_tags(submitter.id)) # shown on their recipes and timeline items
+        try:
+            model.db.session.commit()
+            return {'new_avatar':img_url}, 200
+        except:
+            return error_response(500, 'Cannot commit to db')
     else:
         return {'message':'No change made'}, 400
 
     model.db.session.add(submitter)
+    if new_username or new_avatar:
+        rc.cache.invalidate_after_commit(rc.user_tags(submitter.id)) # shown on their recipes and timeline items
     
     try:
         model.db.session.commit()
@@ -295,23 +474,78 @@ def update_user(id):
     
 
 ################ Endpoint '/api/recipes' ############################
-# GET -- return details of featured recipes (hard coded by recipe id)
-@app.route('/api/recipes')
+MAX_BATCH_RECIPES = 100
+
+# GET -- return details of featured recipes (hard coded by recipe id), or of the recipes asked for
+@api.route('/api/recipes')
+@token_auth.login_required(optional=True)
 def get_featured_recipes():
+    """Query string: view=summary or fields=<comma-separated keys>, as in /api/users/<username> GET route
+                  ids=<comma-separated recipe ids, at most 100> -- these recipes instead of the featured ones; see read_recipes_by_id()
+    """
+    try:
+        fields = rh.requested_fields(request.args)
+    except ValueError as e:
+        return error_response(400, str(e))
+    if 'ids' in request.args:
+        return read_recipes_by_id(fields)
     # featured_ids = [20, 10, 12, 11]
     featured_ids = [1,2]
     featured = []
     for id in featured_ids:
-        featured.append(model.Recipe.get_by_id(id).to_dict())
+        recipe = model.db.session.get(model.Recipe, id, options=rh.load_fields(model.Recipe, fields))
+        featured.append(rh.only_fields(recipe.to_dict(), fields))
     return featured
 
+def read_recipes_by_id(fields: frozenset | None):
+    """Many recipes at once, e.g. for a list of shared recipes or fork parents. Token auth is optional, as for a single recipe.
+    Access to all of them is checked in one query, and the whole batch takes the same handful of queries however big it is.
+
+    Query string: ids=<comma-separated recipe ids, at most 100; repeats are dropped>
+    Returns:    {results: list of dicts, one per id, in order
+                    {id, status: <200, 403 if the viewer can't see it, 404 if there's no such recipe>,
+                     (recipe: <dict, same as in /api/users/<username> GET route: only if 200>)}}
+                200 even if some are 403 or 404; 400 if an id isn't a number; 413 if there are too many
+    """
+    viewer = token_auth.current_user()
+    status = 200
+    if viewer == 'expired':
+        status = 401
+        viewer = None
+    try:
+        recipe_ids = list(dict.fromkeys(int(id) for arg in request.args.getlist('ids') for id in arg.split(',') if id.strip()))
+    except ValueError:
+        return error_response(400, 'ids must be recipe ids, separated by commas')
+    if len(recipe_ids) > MAX_BATCH_RECIPES:
+        return error_response(413, f'At most {MAX_BATCH_RECIPES} recipes per request')
+
+    found = ph.get_recipes_for_viewer(viewer.id if viewer else None, recipe_ids,
+                                      rh.load_fields(model.Recipe, fields, card_edits=False))
+    heads = ph.get_head_edits([recipe_id for recipe_id, (_, can_view) in found.items() if can_view],
+                              rh.load_card_fields(fields))
+    results = []
+    for recipe_id in recipe_ids:
+        recipe, can_view = found.get(recipe_id, (None, False))
+        if recipe is None:
+            results.append({'id': recipe_id, 'status': 404})
+        elif not can_view:
+            results.append({'id': recipe_id, 'status': 403})
+        else:
+            results.append({'id': recipe_id, 'status': 200,
+                            'recipe': rh.only_fields(recipe.to_dict(head=heads.get(recipe_id)), fields)})
+    return {'results': results}, status
+
 # POST -- create a new recipe
-@app.route('/api/recipes', methods=['POST'])
+@api.route('/api/recipes', methods=['POST'])
 @token_auth.login_required()
+@idempotency.idempotent
 def create_new_recipe():
     """Create a new recipe
 
-    Expects:    {title, description, ingredients, instructions, url, forked_from, set_is_public, set_is_exps_public}
+    Expects:    {title, description, ingredients, instructions, url, forked_from, set_is_public, set_is_exps_public,
+                 structured_ingredients: <optional list of {name, quantity, unit}, as returned by /api/extract-recipe;
+                                          indexed instead of parsing the ingredients text>}
+    Headers:    Idempotency-Key: <optional, unique per attempt; a retry with the same key gets the first response back>
     Returns:    200 if successful
     """
     if token_auth.current_user() == 'expired': 
@@ -327,6 +561,7 @@ def create_new_recipe():
     img_url = params.get('img_url') 
     is_public = params.get('set_is_public')
     is_experiments_public = params.get('set_is_exps_public')
+    structured_ingredients = params.get('structured_ingredients')
 
     submitter = token_auth.current_user()
     now = datetime.utcnow()
@@ -339,8 +574,17 @@ def create_new_recipe():
     newRecipe = model.Recipe.create(owner=submitter, modified_on=now, 
                                     is_public=is_public, is_experiments_public=is_experiments_public,
                                     source_url=given_url, forked_from=forked_from_id) # create recipe
-    model.Edit.create(newRecipe, title, description, ingredients, instructions, img_url, now, submitter) # create first edit
+    first_edit = model.Edit.create(newRecipe, title, description, ingredients, instructions, img_url, now, submitter) # create first edit
     model.db.session.add(newRecipe)
+    model.db.session.flush()
+    model.Recipe.adjust_counts(newRecipe.id, edits=1)
+    if forked_from_id:
+        model.Recipe.adjust_counts(forked_from_id, forks=1)
+        rc.cache.invalidate_after_commit({f'recipe:{forked_from_id}'})
+    parsed = ih.from_structured(structured_ingredients) if structured_ingredients else None
+    ih.index_edit(first_edit, parsed)
+    sim.index_edit(first_edit, parsed)
+    rc.cache.invalidate_after_commit(rc.recipe_tags(newRecipe))
 
     try:
         model.db.session.commit()
@@ -348,9 +592,62 @@ def create_new_recipe():
     except:
         return error_response(500, 'Cannot commit to db')
 
+################ Endpoint '/api/recipes/search' ############################
+# GET -- find recipes by ingredient
+@api.route('/api/recipes/search')
+@token_auth.login_required(optional=True)
+def search_recipes_by_ingredient():
+    """Find recipes the viewer can see by what their current version uses, e.g. ?with=buttermilk&without=eggs
+    
+    Query string: with=<ingredient>, without=<ingredient> -- each can be repeated or comma-separated; at least one with= 
+                  sort=<same as in /api/users/<username> GET route>
+    Returns:    {recipes: <list of dicts, same as in /api/users/<username> GET route, newest first, at most 50>}
+    """
+    viewer = token_auth.current_user()
+    status = 200
+    if viewer == 'expired':
+        status = 401
+        viewer = None
+    with_terms = [term for arg in request.args.getlist('with') for term in arg.split(',') if term.strip()]
+    without_terms = [term for arg in request.args.getlist('without') for term in arg.split(',') if term.strip()]
+    sort = request.args.get('sort', 'recent')
+    if not with_terms:
+        return error_response(400, 'Give at least one ingredient to search for')
+    if sort not in ph.RECIPE_SORTS:
+        return error_response(400, f'sort must be one of {", ".join(ph.RECIPE_SORTS)}')
+    recipes = ih.find_recipes(viewer.id if viewer else None, with_terms, without_terms, sort)
+    return {'recipes': [recipe.to_dict() for recipe in recipes]}, status
+
+################ Endpoint '/api/recipes/<id>/similar' ############################
+# GET -- near-duplicates of a recipe
+@api.route('/api/recipes/<int:id>/similar')
+@token_auth.login_required(optional=True)
+def read_similar_recipes(id):
+    """Recipes the viewer can see whose current version is nearly the same as this one's (same ingredients, mostly
+    the same instructions) -- re-imports of the same page, or forks that barely changed
+
+    Returns:    {recipes: <list of dicts, same as in /api/users/<username> GET route, each with
+                           similarity: <float, 0.5 to 1, estimated share of ingredients and phrases in common>;
+                           most alike first, at most 20>}
+                403 if the viewer can't see the recipe, 404 if there's none
+    """
+    viewer = token_auth.current_user()
+    status = 200
+    if viewer == 'expired':
+        status = 401
+        viewer = None
+    recipe = ph.get_recipe_without_history(id)
+    if not recipe:
+        return error_response(404)
+    if not recipe.is_public and not (viewer and ph.can_user_view(viewer, recipe)):
+        return error_response(403, 'User cannot view this recipe')
+    similar = sim.find_similar_to_recipe(viewer.id if viewer else None, recipe.id)
+    return {'recipes': [dict(similar_recipe.to_dict(head=head), similarity=round(score, 2))
+                        for similar_recipe, head, score in similar]}, status
+
 ################ Endpoint '/api/recipes/<id>' ############################
 # GET -- return timeline-items list, can_edit bool, can_exp bool
-@app.route('/api/recipes/<id>')
+@api.route('/api/recipes/<id>')
 @token_auth.login_required(optional=True)
 def read_recipe_timeline(id):
     """Return all information needed for recipe details and timeline
@@ -367,6 +664,8 @@ def read_recipe_timeline(id):
                          commit_by, commit_by_avatar, commit_date,
                          title, description, ingredients, instructions:,
                          (included, but as yet unused: img_url, pending_approval)
+                         is_archived: <bool, if true ingredients and instructions are left out;
+                                       fetch them from /api/edits/<id>/body>
                         }
                     experiments: list of dicts 
                         {id:        <int, unique experiment id>,
@@ -375,42 +674,62 @@ def read_recipe_timeline(id):
                          commit_by, commit_by_avatar, commit_date,
                          commit_msg, notes,
                          (included, but as yet unused: create_date)
+                         is_archived: <bool, if true notes are left out; fetch them from /api/experiments/<id>/body>
                         }
                  },
                  can_edit: <bool>
                  can_experiment: <bool>
                 }
+    Query string: view=summary -- the recipe and its timeline items without description, ingredients, instructions or notes
+                  fields=<comma-separated keys> -- the recipe and each timeline item carry only these (and id, item_type)
     """
     current_user = token_auth.current_user()
     response_code = 200
     if current_user == 'expired': 
         current_user = None
         response_code = 401
+    try:
+        fields = rh.requested_fields(request.args)
+    except ValueError as e:
+        return error_response(400, str(e))
     query_owner = request.args.get('owner')
-    recipe = model.Recipe.get_by_id(id)
+    recipe = ph.get_recipe_without_history(id)
     if not recipe:
         return error_response(404)
     recipe_owner = recipe.owner.username
     if query_owner and query_owner != recipe_owner:
         return error_response(404)
-    timeline_items = ph.get_timeline(current_user.id if current_user else None, id)
+    viewer_class = ph.get_viewer_class(current_user.id if current_user else None, recipe) if response_code == 200 else None
+    # checked against the recipe as it is now, in case an entry cached before it changed hasn't been invalidated yet
+    if viewer_class == 'public' and not recipe.is_public:
+        viewer_class = None # a 403, never served from the cache
+    elif viewer_class == 'public' and not recipe.is_experiments_public:
+        viewer_class = 'public:no-experiments'
+    if viewer_class:
+        cached = rc.cache.get('timeline', f'{recipe.id}{rh.fieldset_key(fields)}', viewer_class)
+        if cached is not None:
+            return cached
+    timeline_items = ph.get_timeline(current_user.id if current_user else None, id, fields)
     if not timeline_items:
         return error_response(404)
     if not timeline_items[0]:
         return error_response(403, 'User cannot view this recipe')
-    response = recipe.to_dict()
-    response['timeline_items'] = timeline_items[0]
+    response = rh.only_fields(recipe.to_dict(head=ph.get_head_edit(recipe.id, rh.load_card_fields(fields))), fields)
+    response['timeline_items'] = timeline_items[0] # edits and experiments are streamed as they're read from the db
     response['can_experiment'] = timeline_items[1]
     response['can_edit'] = timeline_items[2]
-    return response, response_code
+    if viewer_class:
+        return rc.cache.store(rh.stream_json(response), 'timeline', f'{recipe.id}{rh.fieldset_key(fields)}', viewer_class,
+                              [f'recipe:{recipe.id}'])
+    return rh.stream_json(response, response_code)
 
 # DELETE -- Delete given recipe
-@app.route('/api/recipes/<id>', methods=['DELETE'])
+@api.route('/api/recipes/<id>', methods=['DELETE'])
 @token_auth.login_required()
 def delete_recipe(id):
     if token_auth.current_user() == 'expired':
         return error_response(401)
-    this_recipe = model.Recipe.get_by_id(id)
+    this_recipe = ph.get_recipe_without_history(id)
     if not this_recipe:
         return error_response(404)
 
@@ -418,7 +737,12 @@ def delete_recipe(id):
     if token_auth.current_user() != this_recipe.owner:
         return error_response(403)
     
-    model.db.session.delete(this_recipe)
+    if this_recipe.forked_from:
+        model.Recipe.adjust_counts(this_recipe.forked_from, forks=-1)
+        rc.cache.invalidate_after_commit(rc.recipe_tags(this_recipe.parent))
+    rc.cache.invalidate_after_commit(rc.recipe_tags(this_recipe))
+    for fork in model.Recipe.delete_with_history(this_recipe.id): # its history goes with it, in the same statement
+        rc.cache.invalidate_after_commit(rc.recipe_tags(fork)) # no longer "forked from" anything
     
     try:
         model.db.session.commit()
@@ -427,14 +751,142 @@ def delete_recipe(id):
         return error_response(500, 'Cannot commit to db')
 
 
+################ Endpoint '/api/recipes/<id>/fork' ############################
+# POST -- Fork a recipe server-side
+@api.route('/api/recipes/<id>/fork', methods=['POST'])
+@token_auth.login_required()
+def fork_recipe(id):
+    """Fork a recipe the submitter can view into a new recipe they own.
+
+    The fork's first edit points at the parent's current content instead of copying it; 
+    the content is only copied when the fork (or the parent's edit) is first changed.
+
+    Expects:    {set_is_public, set_is_exps_public} -- optional, both default to true
+    Returns:    201 and {id: <int, id of the new recipe>} if successful
+    """
+    if token_auth.current_user() == 'expired':
+        return error_response(401)
+    params = request.get_json(silent=True) or {}
+    submitter = token_auth.current_user()
+    parent = model.Recipe.get_by_id(id)
+    if not parent:
+        return error_response(404)
+    if not ph.can_user_view(submitter, parent):
+        return error_response(403)
+    now = datetime.utcnow()
+
+    # db changes
+    new_recipe = model.Recipe.create(owner=submitter, modified_on=now,
+                                     is_public=params.get('set_is_public'), 
+                                     is_experiments_public=params.get('set_is_exps_public'),
+                                     source_url=parent.source_url, forked_from=parent.id)
+    stub = model.Edit.create_fork_stub(new_recipe, parent.edits[0], now, submitter)
+    model.db.session.add(new_recipe)
+    model.db.session.flush()
+    model.Recipe.adjust_counts(new_recipe.id, edits=1)
+    model.Recipe.adjust_counts(parent.id, forks=1)
+    ih.index_edit(stub)
+    sim.index_edit(stub)
+    rc.cache.invalidate_after_commit(rc.recipe_tags(new_recipe) | rc.recipe_tags(parent))
+
+    try:
+        model.db.session.commit()
+        return {'message':'Recipe successfully forked', 'id': new_recipe.id}, 201
+    except:
+        return error_response(500, 'Cannot commit to db')
+
+################ Endpoint '/api/recipes/<id>/checkout' ############################
+# GET -- return the recipe as it was at a given edit or time
+@api.route('/api/recipes/<int:id>/checkout')
+@token_auth.login_required(optional=True)
+def checkout_recipe(id):
+    """Return a past version of a recipe, and the experiments logged while it was the current version.
+
+    Query string: ONE OF edit=<edit id> or at=<ISO 8601 datetime, UTC>
+    Returns:    {id, title, description, ..., as in /api/recipes/<id> GET route, but as of that version,
+                 edit: <dict, the version's edit, same as in timeline_items>,
+                 experiments: <list of dicts, same as in timeline_items; only if the viewer can see experiments>,
+                 is_current: <bool, whether this is still the current version>,
+                 next_edit_date: <datetime the version was replaced, or null>}
+                404 if the recipe has no such edit, or didn't exist yet at that time
+    """
+    viewer = token_auth.current_user()
+    status = 200
+    if viewer == 'expired':
+        status = 401
+        viewer = None
+    edit_id = request.args.get('edit', type=int)
+    at = request.args.get('at')
+    if (edit_id is None) == (at is None):
+        return error_response(400, 'Give one of edit= or at=')
+    if at is not None:
+        try:
+            at = datetime.fromisoformat(at.replace('Z', '+00:00'))
+        except ValueError:
+            return error_response(400, 'at= must be an ISO 8601 datetime')
+        if at.tzinfo is not None:
+            at = at.astimezone(timezone.utc).replace(tzinfo=None) # commit dates are stored as naive UTC
+    recipe = ph.get_recipe_without_history(id)
+    if not recipe:
+        return error_response(404)
+    viewer_class = ph.get_viewer_class(viewer.id if viewer else None, recipe)
+    if viewer_class == 'public' and not recipe.is_public:
+        return error_response(403, 'User cannot view this recipe')
+
+    version, next_commit_date = ph.get_version(recipe.id, edit_id, at)
+    if version is None:
+        return error_response(404)
+    response = recipe.to_dict(head=version)
+    response['edit'] = ah.full_dicts([version])[0] # old versions are likely archived; a checkout shows them whole
+    if viewer_class != 'public' or recipe.is_experiments_public:
+        stmt = ph.select_experiments_between(recipe.id, version.commit_date, next_commit_date)
+        response['experiments'] = ah.full_dicts(model.db.session.scalars(stmt).all())
+    response['is_current'] = next_commit_date is None
+    response['next_edit_date'] = next_commit_date
+    return response, status
+
+################ Endpoint '/api/recipes/<id>/events' ############################
+# GET -- stream changes to the timeline as they happen
+@api.route('/api/recipes/<int:id>/events')
+@token_auth.login_required(optional=True)
+def stream_recipe_events(id):
+    """Server-Sent Events: new, changed and deleted edits and experiments, as they're committed -- instead of polling
+    /api/recipes/<id>. Token auth is optional; the viewer gets the same items the timeline would show them.
+
+    Headers:    Last-Event-ID: <id of the last event received, to carry on after a reconnect; without it, the stream
+                                starts from about now>
+    Returns:    text/event-stream, for up to 5 minutes (then reconnect); see events_helper.stream_timeline() for the events
+                403 if the viewer can't see the recipe, 404 if there's none, 503 if this worker has too many streams open
+    """
+    viewer = token_auth.current_user()
+    if viewer == 'expired':
+        return error_response(401)
+    recipe = ph.get_recipe_without_history(id)
+    if not recipe:
+        return error_response(404)
+    if not eh.visible_types(viewer.id if viewer else None, recipe.id):
+        return error_response(403, 'User cannot view this recipe')
+    if pubsub.hub.subscriber_count() >= current_app.config['EVENTS_MAX_STREAMS']:
+        response = error_response(503, 'Too many open streams, try again shortly')
+        response.headers['Retry-After'] = str(eh.RETRY_MS // 1000)
+        return response
+    cursor = request.headers.get('Last-Event-ID', type=int)
+    if cursor is None:
+        cursor = sh.oldest_running_txid()
+    stream = eh.stream_timeline(viewer.id if viewer else None, recipe.id, cursor, current_app.config['EVENTS_STREAM_SECONDS'])
+    return Response(stream_with_context(stream), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}) # no proxy buffering
+
 ################ Endpoint '/api/recipes/<id>/experiments' ############################
 # POST -- Create a new experiment for a recipe
-@app.route('/api/recipes/<id>/experiments', methods=['POST'])
+@api.route('/api/recipes/<id>/experiments', methods=['POST'])
 @token_auth.login_required()
+@idempotency.idempotent
 def create_new_exp(id):
     """Create a new experiment for a recipe
 
     Expects:    {commit_msg, notes}
+    Headers:    Idempotency-Key: <optional, unique per attempt; a retry with the same key gets the first response back>
     Returns:    200 if successful
     """
 
@@ -463,6 +915,9 @@ def create_new_exp(id):
     model.db.session.flush()
     this_recipe.update_last_modified(now) # update recipe's last_modified field
     model.db.session.add(this_recipe)
+    model.Recipe.adjust_counts(this_recipe.id, experiments=1)
+    fh.fan_out([new_experiment]) # push to collaborators' activity feeds
+    rc.cache.invalidate_after_commit(rc.recipe_tags(this_recipe))
     try:
         model.db.session.commit()
         return {'id': new_experiment.id,
@@ -479,13 +934,16 @@ def create_new_exp(id):
 
 ################ Endpoint '/api/recipes/<id>/edits' ############################
 # POST -- Create a new edit for a recipe
-@app.route('/api/recipes/<id>/edits', methods=['POST'])
+@api.route('/api/recipes/<id>/edits', methods=['POST'])
 @token_auth.login_required()
+@idempotency.idempotent
 def create_new_edit(id):
-    """Create a new edit for a recipe
+    """Create a new edit for a recipe. Experimenters without edit access propose one instead: it's queued until
+    the owner or an editor approves it (see /api/recipes/<id>/pending-edits).
 
     Expects:    {title, description, ingredients, instructions, img-url}
-    Returns:    200 if successful
+    Headers:    Idempotency-Key: <optional, unique per attempt; a retry with the same key gets the first response back>
+    Returns:    200 if successful, 202 if the edit is pending approval
     """
     if token_auth.current_user() == 'expired':
         return error_response(401)
@@ -506,10 +964,25 @@ def create_new_edit(id):
     # check that submitter is allowed to add a new edit to given recipe
     if this_recipe.user_id != submitter.id:
         permission = model.Permission.get_by_user_and_recipe(submitter.id, id)
-        if not permission or not permission.can_edit:
+        if not permission or not (permission.can_edit or permission.can_experiment):
             return error_response(403)
+        pending_approval = not permission.can_edit
+
+    if pending_approval:
+        # queued as is: nothing about the recipe changes until it's approved
+        proposed_edit = model.Edit.create(this_recipe, title, description, ingredients, instructions, img_url,
+                                          now, submitter, pending_approval=True)
+        model.db.session.add(proposed_edit)
+        model.db.session.flush()
+        proposed = proposed_edit.to_dict() # before the commit expires it
+        try:
+            model.db.session.commit()
+            return proposed, 202
+        except:
+            return error_response(500,'Cannot commit to db')
 
     # db changes
+    this_recipe.materialize_fork() # first edit to a fork gets its own copy of the parent's content
     new_edit = model.Edit.create(this_recipe,
                                  title, description,
                                  ingredients, instructions,
@@ -519,6 +992,12 @@ def create_new_edit(id):
     if now:
         this_recipe.update_last_modified(now) # update recipe's last_modified field
     model.db.session.add_all([new_edit, this_recipe])
+    model.db.session.flush()
+    ih.index_edit(new_edit) # new edit is the current version
+    sim.index_edit(new_edit)
+    model.Recipe.adjust_counts(this_recipe.id, edits=1)
+    fh.fan_out([new_edit]) # push to collaborators' activity feeds
+    rc.cache.invalidate_after_commit(rc.recipe_tags(this_recipe))
     try:
         model.db.session.commit()
         return {'id': new_edit.id,
@@ -536,9 +1015,199 @@ def create_new_edit(id):
     except:
         return error_response(500,'Cannot commit to db')
 
+################ Endpoint '/api/recipes/<id>/pending-edits' ############################
+# GET -- list edits awaiting approval
+@api.route('/api/recipes/<int:id>/pending-edits')
+@token_auth.login_required()
+def read_pending_edits(id):
+    """List the edits proposed for a recipe that are waiting to be approved or rejected, oldest first.
+    Only for the recipe's owner and editors.
+
+    Returns:    {edits: <list of dicts, same as timeline_items edits, with pending_approval: true>}
+    """
+    if token_auth.current_user() == 'expired':
+        return error_response(401)
+    recipe = ph.get_recipe_without_history(id)
+    if not recipe:
+        return error_response(404)
+    if not ph.can_user_review(token_auth.current_user(), recipe):
+        return error_response(403)
+    return {'edits': [edit.to_dict() for edit in model.db.session.scalars(ph.select_pending_edits(recipe.id))]}, 200
+
+################ Endpoint '/api/edits/<id>/approve', '/api/edits/<id>/reject' ############################
+# POST -- merge a pending edit into the recipe
+@api.route('/api/edits/<int:id>/approve', methods=['POST'])
+@token_auth.login_required()
+def approve_edit(id):
+    """Approve a proposed edit: it becomes the recipe's current version, as of now. Owner and editors only.
+
+    Returns:    200 and the edit (same as timeline_items edits) if successful, 409 if it isn't pending
+    """
+    if token_auth.current_user() == 'expired':
+        return error_response(401)
+    this_edit = model.Edit.get_by_id(id)
+    if not this_edit:
+        return error_response(404)
+    this_recipe = this_edit.recipe
+    if not ph.can_user_review(token_auth.current_user(), this_recipe):
+        return error_response(403)
+    if not this_edit.pending_approval:
+        return error_response(409, 'Edit is not pending approval')
+    now = datetime.utcnow()
+
+    # db changes -- same as for a new edit, except the edit already exists
+    this_recipe.materialize_fork()
+    this_edit.pending_approval = False
+    this_edit.commit_date = now # merged now, so it's the newest version even if others were made since it was proposed
+    this_recipe.update_last_modified(now)
+    model.db.session.flush()
+    ih.index_edit(this_edit)
+    sim.index_edit(this_edit)
+    model.Recipe.adjust_counts(this_recipe.id, edits=1)
+    fh.fan_out([this_edit]) # push to collaborators' activity feeds
+    rc.cache.invalidate_after_commit(rc.recipe_tags(this_recipe))
+    approved = this_edit.to_dict() # before the commit expires it
+    try:
+        model.db.session.commit()
+        return approved, 200
+    except:
+        return error_response(500, 'Cannot commit to db')
+
+# POST -- discard a pending edit
+@api.route('/api/edits/<int:id>/reject', methods=['POST'])
+@token_auth.login_required()
+def reject_edit(id):
+    """Reject a proposed edit, deleting it. Owner and editors only (its proposer can withdraw it with DELETE /api/edits/<id>).
+
+    Returns:    200 if successful, 409 if it isn't pending
+    """
+    if token_auth.current_user() == 'expired':
+        return error_response(401)
+    this_edit = model.Edit.get_by_id(id)
+    if not this_edit:
+        return error_response(404)
+    if not ph.can_user_review(token_auth.current_user(), this_edit.recipe):
+        return error_response(403)
+    if not this_edit.pending_approval:
+        return error_response(409, 'Edit is not pending approval')
+    return reject_pending_edit(this_edit)
+
+def reject_pending_edit(this_edit: model.Edit):
+    # nothing else refers to a pending edit: no counts, index entries, feed items or forks
+    model.db.session.delete(this_edit)
+    try:
+        model.db.session.commit()
+        return {'message': 'Edit rejected'}, 200
+    except:
+        return error_response(500, 'Cannot commit to db')
+
+################ Endpoint '/api/batch' ############################
+MAX_BATCH_OPERATIONS = 200
+
+# POST -- Create many experiments and edits, across recipes, in one transaction
+@api.route('/api/batch', methods=['POST'])
+@token_auth.login_required()
+def create_batch():
+    """Create experiments and edits in bulk, e.g. to replay journal entries made offline.
+
+    Expects:    {mode: <"atomic" (default): all operations are applied or none are; 
+                        "partial": apply the valid operations, report the rest>,
+                 operations: list of dicts, applied in order
+                    {type: "experiment", recipe_id, commit_msg, notes} or
+                    {type: "edit", recipe_id, title, description, ingredients, instructions, img_url}}
+    Returns:    {results: list of dicts, one per operation, in order
+                    {index, status: <201 created, 400 bad operation, 403 not allowed, 404 no such recipe,
+                                     or 424 not applied because another operation in an atomic batch failed>,
+                     (id, item_type, recipe_id, commit_date: only if created)}}
+                200 if everything that could be applied was; 400 if an atomic batch was rejected
+    """
+    if token_auth.current_user() == 'expired':
+        return error_response(401)
+    params = request.get_json()
+    mode = params.get('mode', 'atomic')
+    operations = params.get('operations')
+    if mode not in ('atomic', 'partial') or not isinstance(operations, list):
+        return error_response(400)
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return error_response(413, f'At most {MAX_BATCH_OPERATIONS} operations per batch')
+    submitter = token_auth.current_user()
+    now = datetime.utcnow()
+
+    # one query for every recipe touched, and the submitter's permissions on each
+    recipe_ids = {op.get('recipe_id') for op in operations if isinstance(op, dict) and isinstance(op.get('recipe_id'), int)}
+    access = ph.get_recipes_with_access(submitter.id, list(recipe_ids))
+
+    # validate everything before writing anything
+    results = []
+    for index, op in enumerate(operations):
+        result = {'index': index}
+        if not isinstance(op, dict) or op.get('type') not in ('experiment', 'edit') or not isinstance(op.get('recipe_id'), int):
+            result['status'] = 400
+        elif op['recipe_id'] not in access:
+            result['status'] = 404
+        else:
+            _, can_experiment, can_edit = access[op['recipe_id']]
+            allowed = can_experiment if op['type'] == 'experiment' else can_edit
+            result['status'] = 201 if allowed else 403
+        results.append(result)
+    has_failures = any(result['status'] != 201 for result in results)
+    if mode == 'atomic' and has_failures:
+        for result in results:
+            if result['status'] == 201:
+                result['status'] = 424
+        return {'error': HTTP_STATUS_CODES[400], 'results': results}, 400
+
+    # db changes
+    new_items = []
+    touched_recipes = set()
+    for index, (op, result) in enumerate(zip(operations, results)):
+        if result['status'] != 201:
+            continue
+        recipe = access[op['recipe_id']][0]
+        # offset each item by a microsecond so items replayed onto the same recipe keep their order
+        commit_date = now + timedelta(microseconds=index)
+        if op['type'] == 'experiment':
+            item = model.Experiment.create(recipe, op.get('commit_msg'), op.get('notes'),
+                                           commit_date, commit_date, submitter)
+        else:
+            recipe.materialize_fork()
+            item = model.Edit.create(recipe, op.get('title'), op.get('description'),
+                                     op.get('ingredients'), op.get('instructions'), op.get('img_url'),
+                                     commit_date, submitter)
+        new_items.append((result, item))
+        touched_recipes.add(recipe)
+    model.db.session.add_all([item for _, item in new_items])
+    for recipe in touched_recipes:
+        recipe.update_last_modified(now + timedelta(microseconds=len(operations))) # once per recipe
+    model.db.session.flush()
+    added = {}
+    for _, item in new_items:
+        added.setdefault(item.recipe_id, Counter())['edits' if isinstance(item, model.Edit) else 'experiments'] += 1
+    for recipe_id, counts in added.items():
+        model.Recipe.adjust_counts(recipe_id, **counts)
+    newest_edits = {item.recipe_id: item for _, item in new_items if isinstance(item, model.Edit)} # later ones win
+    for edit in newest_edits.values():
+        ih.index_edit(edit)
+        sim.index_edit(edit)
+    if new_items:
+        fh.fan_out([item for _, item in new_items]) # push to collaborators' activity feeds
+    for recipe in touched_recipes:
+        rc.cache.invalidate_after_commit(rc.recipe_tags(recipe))
+
+    try:
+        model.db.session.commit()
+    except:
+        return error_response(500, 'Cannot commit to db')
+    for result, item in new_items:
+        result.update({'id': item.id,
+                       'item_type': 'experiment' if isinstance(item, model.Experiment) else 'edit',
+                       'recipe_id': item.recipe_id,
+                       'commit_date': item.commit_date})
+    return {'results': results}, 200
+
 ########### Endpoint '/api/recipes/<id>/permissions' ###################
 # GET -- return is_public, is_experiments_public, and list of users with permissions
-@app.route('/api/recipes/<recipe_id>/permissions')
+@api.route('/api/recipes/<recipe_id>/permissions')
 @token_auth.login_required()
 def read_permissions(recipe_id):
     """Returns permissions for a recipe -- both global and per-user.
@@ -574,7 +1243,7 @@ def read_permissions(recipe_id):
     return response
 
 # PUT -- edit permission level for recipe globally
-@app.route('/api/recipes/<recipe_id>/permissions', methods=['PUT'])
+@api.route('/api/recipes/<recipe_id>/permissions', methods=['PUT'])
 @token_auth.login_required()
 def update_global_permissions(recipe_id):
     """Change a recipe's global permissions.
@@ -605,6 +1274,7 @@ def update_global_permissions(recipe_id):
         recipe.is_public = is_public
         recipe.is_experiments_public = is_experiments_public
         model.db.session.add(recipe)
+        rc.cache.invalidate_after_commit(rc.recipe_tags(recipe))
         model.db.session.commit()
 
         return {'message':'Global permissions successfully updated'}, 200
@@ -613,12 +1283,14 @@ def update_global_permissions(recipe_id):
 
 
 # POST -- create new permission (give new user a new permission)
-@app.route('/api/recipes/<recipe_id>/permissions', methods=['POST'])
+@api.route('/api/recipes/<recipe_id>/permissions', methods=['POST'])
 @token_auth.login_required()
+@idempotency.idempotent
 def create_permission(recipe_id):
     """Give a certain user permission for a certain recipe.
 
     Expects:    {username: str, can_experiment: bool, can_edit: bool}
+    Headers:    Idempotency-Key: <optional, unique per attempt; a retry with the same key gets the first response back>
     Returns:    200 if successful
     """
     if token_auth.current_user() == 'expired':
@@ -633,7 +1305,7 @@ def create_permission(recipe_id):
     
     # check that user they want to add exists
     new_user = model.User.get_by_username(new_user_name)
-    if not new_user:
+    if not new_user or new_user.deactivated_at:
         return error_response(404)
     
     ## input validation
@@ -652,6 +1324,8 @@ def create_permission(recipe_id):
     # otherwise, make a new permission row
     new_permission = model.Permission.create(new_user.id, recipe_id,can_experiment,can_edit)
     model.db.session.add(new_permission)
+    model.Recipe.adjust_counts(recipe.id, collaborators=1)
+    rc.cache.invalidate_after_commit(rc.recipe_tags(recipe))
     try:
         model.db.session.commit()
         return {'message':'New permission added','user_id':new_user.id}, 200
@@ -660,7 +1334,7 @@ def create_permission(recipe_id):
 
 ########### Endpoint '/api/recipes/<id>/permissions/<user_id>' ###################
 # DELETE -- revoke a user's permission to a recipe
-@app.route('/api/recipes/<recipe_id>/permissions/<user_id>', methods=['DELETE'])
+@api.route('/api/recipes/<recipe_id>/permissions/<user_id>', methods=['DELETE'])
 @token_auth.login_required()
 def delete_permission(recipe_id, user_id):
     if token_auth.current_user() == 'expired':
@@ -679,6 +1353,9 @@ def delete_permission(recipe_id, user_id):
         # delete the permission
         # if permission doesn't exist, there's no permission to delete but the user won't have access anyway
         model.db.session.delete(permission)
+        fh.remove_recipe_for_user(permission.user_id, permission.recipe_id)
+        model.Recipe.adjust_counts(recipe.id, collaborators=-1)
+        rc.cache.invalidate_after_commit(rc.recipe_tags(recipe))
 
     try:
         model.db.session.commit()
@@ -687,7 +1364,7 @@ def delete_permission(recipe_id, user_id):
         return error_response(500, 'Cannot commit to db')
 
 # PUT - edit permission level for a user
-@app.route('/api/recipes/<recipe_id>/permissions/<user_id>', methods=['PUT'])
+@api.route('/api/recipes/<recipe_id>/permissions/<user_id>', methods=['PUT'])
 @token_auth.login_required()
 def update_or_delete_permission(recipe_id, user_id):
     """Update a certain user's permission for a certain recipe.
@@ -714,6 +1391,8 @@ def update_or_delete_permission(recipe_id, user_id):
     permission = model.Permission.get_by_user_and_recipe(user_id, recipe_id)
     if not permission:
         permission = model.Permission.create(user_id, recipe_id, can_experiment, can_edit)
+        model.Recipe.adjust_counts(recipe.id, collaborators=1)
+        rc.cache.invalidate_after_commit(rc.recipe_tags(recipe))
     else:
         # if association exists, update permission
         permission.can_edit = can_edit
@@ -725,9 +1404,165 @@ def update_or_delete_permission(recipe_id, user_id):
     except:
         return error_response(500, 'Cannot commit to db')
 
+################ Endpoint '/api/permissions/batch' ############################
+# POST -- grant, update and revoke many permissions at once, e.g. share a whole cookbook with a family
+@api.route('/api/permissions/batch', methods=['POST'])
+@token_auth.login_required()
+def batch_permissions():
+    """Grant, update or revoke permissions for many (user, recipe) pairs in one call.
+
+    Expects:    {mode: <"atomic" (default) or "partial", same as in /api/batch POST route>,
+                 operations: list of dicts
+                    {action: "grant", recipe_id, username (or user_id), can_experiment: bool, can_edit: bool} or
+                    {action: "revoke", recipe_id, username (or user_id)}}
+    Returns:    {results: list of dicts, one per operation, in order
+                    {index, status: <201 granted, 200 updated or revoked, 400 bad operation, 403 not allowed,
+                                     404 no such recipe or user, 409 same pair as an earlier operation,
+                                     or 424 not applied because another operation in an atomic batch failed>,
+                     (outcome: "created", "updated", "revoked" or "not_shared" -- only if applied)}}
+                200 if everything that could be applied was; 400 if an atomic batch was rejected
+    """
+    if token_auth.current_user() == 'expired':
+        return error_response(401)
+    params = request.get_json()
+    mode = params.get('mode', 'atomic')
+    operations = params.get('operations')
+    if mode not in ('atomic', 'partial') or not isinstance(operations, list):
+        return error_response(400)
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return error_response(413, f'At most {MAX_BATCH_OPERATIONS} operations per batch')
+    submitter = token_auth.current_user()
+    ops = [op if isinstance(op, dict) else {} for op in operations]
+
+    # one query for every recipe touched and the submitter's access to each, one for every user named
+    access = ph.get_recipes_with_access(submitter.id, list({op.get('recipe_id') for op in ops if isinstance(op.get('recipe_id'), int)}))
+    usernames = {op['username'] for op in ops if isinstance(op.get('username'), str)}
+    user_ids = {op['user_id'] for op in ops if isinstance(op.get('user_id'), int)}
+    found = ph.find_users(usernames, user_ids)
+    ids_by_username = {username: user_id for user_id, username in found}
+    existing_ids = {user_id for user_id, _ in found}
+
+    # validate everything before writing anything
+    results, pairs = [], []
+    seen = set()
+    for index, op in enumerate(ops):
+        user_id = ids_by_username.get(op['username']) if 'username' in op else op.get('user_id')
+        pair = (user_id, op.get('recipe_id'))
+        if (op.get('action') not in ('grant', 'revoke') or not isinstance(op.get('recipe_id'), int)
+                or not isinstance(op.get('username', op.get('user_id')), (str, int))
+                or (op['action'] == 'grant' and op.get('can_edit') and not op.get('can_experiment'))):
+            status = 400
+        elif op['recipe_id'] not in access or user_id not in existing_ids:
+            status = 404
+        elif not access[op['recipe_id']][2] or submitter.is_temp_user:
+            status = 403 # only the owner and editors can share
+        elif pair in seen:
+            status = 409
+        else:
+            status = 201 if op['action'] == 'grant' else 200
+            seen.add(pair)
+        results.append({'index': index, 'status': status})
+        pairs.append(pair)
+    has_failures = any(result['status'] not in (200, 201) for result in results)
+    if mode == 'atomic' and has_failures:
+        for result in results:
+            if result['status'] in (200, 201):
+                result['status'] = 424
+        return {'error': HTTP_STATUS_CODES[400], 'results': results}, 400
+
+    # db changes: one upsert for the grants, one delete for the revokes
+    applied = [(op, result, pair) for op, result, pair in zip(ops, results, pairs) if result['status'] in (200, 201)]
+    grants = [{'user_id': user_id, 'recipe_id': recipe_id,
+               'can_experiment': bool(op.get('can_experiment')), 'can_edit': bool(op.get('can_edit'))}
+              for op, _, (user_id, recipe_id) in applied if op['action'] == 'grant']
+    created = ph.upsert_permissions(grants)
+    revoked = ph.delete_permissions([pair for op, _, pair in applied if op['action'] == 'revoke'])
+    fh.remove_recipes_for_users(list(revoked))
+    # Core statements skip the ORM events that keep the change log
+    model.log_changes([model.permission_change_row(recipe_id, user_id, 'upsert') for user_id, recipe_id in created]
+                      + [model.permission_change_row(recipe_id, user_id, 'delete') for user_id, recipe_id in revoked])
+    collaborators = Counter(recipe_id for (_, recipe_id), is_new in created.items() if is_new)
+    collaborators.subtract(recipe_id for _, recipe_id in revoked)
+    for recipe_id, change in collaborators.items():
+        if change:
+            model.Recipe.adjust_counts(recipe_id, collaborators=change)
+    for recipe_id in {recipe_id for _, recipe_id in created} | {recipe_id for _, recipe_id in revoked}:
+        rc.cache.invalidate_after_commit(rc.recipe_tags(access[recipe_id][0]))
+    for op, result, pair in applied:
+        if op['action'] == 'grant':
+            result['status'], result['outcome'] = (201, 'created') if created[pair] else (200, 'updated')
+        else:
+            result['outcome'] = 'revoked' if pair in revoked else 'not_shared'
+
+    try:
+        model.db.session.commit()
+    except:
+        return error_response(500, 'Cannot commit to db')
+    return {'results': results}, 200
+
+################ Endpoint '/api/feed' ############################
+# GET -- return a page of the logged in user's activity feed
+@api.route('/api/feed')
+@token_auth.login_required()
+def read_feed():
+    """Returns new edits and experiments by others on recipes the user owns or has a permission on, newest first.
+
+    Query string: before=<cursor from a previous page, optional>, limit=<int, default 20, max 100>
+    Returns:    {items: list of dicts
+                    {id, recipe_id, item_id, 
+                     item_type: "edit" or "experiment",
+                     summary: <edit title or experiment commit_msg>,
+                     actor, actor_avatar, created_at},
+                 next_cursor: <int to pass as before= for the next page, or null if this is the last page>}
+    """
+    if token_auth.current_user() == 'expired':
+        return error_response(401)
+    before = request.args.get('before', type=int)
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    items, next_cursor = fh.get_feed_page(token_auth.current_user().id, before, limit)
+    return {'items': items, 'next_cursor': next_cursor}, 200
+
+################ Endpoint '/api/sync' ############################
+# GET -- return what changed in the logged in user's recipes since their last sync
+@api.route('/api/sync')
+@token_auth.login_required()
+def sync_changes():
+    """Lets a client keep a local copy of the recipes a user owns or has been shared, without refetching everything.
+
+    Query string: token=<token from the previous sync; leave out for a first, full sync>
+    Returns:    {token: <int, to send with the next sync>,
+                 full: <bool, true if this is a full snapshot: replace the local copy rather than patch it>,
+                 recipes: list of dicts, same as in /api/users/<username> GET route,
+                 edits, experiments: lists of dicts, same as timeline_items in /api/recipes/<id> GET route,
+                 permissions: list of dicts {recipe_id, user_id, username, can_experiment, can_edit},
+                 deleted: list of dicts {type: "recipe"|"edit"|"experiment", id} or {type: "permission", recipe_id, user_id}}
+                410 if the token is too old -- sync again without a token
+    """
+    if token_auth.current_user() == 'expired':
+        return error_response(401)
+    token = request.args.get('token')
+    if token is not None and not token.isdigit():
+        return error_response(400, 'Invalid sync token')
+    try:
+        return sh.get_changes_since(token_auth.current_user().id, int(token) if token else None), 200
+    except sh.SyncTokenExpired:
+        return error_response(410, 'Sync token expired, sync again without a token')
+
+################ Endpoint '/api/metrics' ############################
+# GET -- this worker's counters
+@api.route('/api/metrics')
+def read_metrics():
+    """Counters kept by this worker since it started (each gunicorn worker answers for itself).
+
+    Returns:    {counters: {<name>: <int>},
+                 cache: {<endpoint>: {hits, misses, hit_ratio}},
+                 event_streams: <int, /api/recipes/<id>/events streams open>}
+    """
+    return dict(metrics.snapshot(), cache=rc.cache.stats(), event_streams=pubsub.hub.subscriber_count()), 200
+
 ################ Endpoint '/api/edits/<id>' ############################
 # DELETE -- delete given edit
-@app.route('/api/edits/<id>', methods=['DELETE'])
+@api.route('/api/edits/<id>', methods=['DELETE'])
 @token_auth.login_required()
 def delete_edit(id):
     if token_auth.current_user() == 'expired':
@@ -738,6 +1573,11 @@ def delete_edit(id):
     # handle if edit does not exist
     if not this_edit:
         return error_response(404)
+    # not part of the recipe yet: its proposer can withdraw it, and reviewers can reject it
+    if this_edit.pending_approval:
+        if this_edit.commit_by != submitter.id and not ph.can_user_review(submitter, this_edit.recipe):
+            return error_response(403)
+        return reject_pending_edit(this_edit)
     # NOT ALLOWED TO DELETE THE FIRST (CREATION) EDIT
     if this_edit == this_edit.recipe.edits[-1]:
         return error_response(409, 'Cannot delete creation edit')
@@ -750,16 +1590,55 @@ def delete_edit(id):
             return error_response(403)
     
     # delete edit
+    model.Edit.materialize_copies_of([this_edit.id]) # forks keep their content
+    if this_edit == this_edit.recipe.edits[0]:
+        ah.restore(this_edit.recipe.edits[1]) # the current version is always kept hot
+        ih.index_edit(this_edit.recipe.edits[1]) # previous edit becomes the current version again
+        sim.index_edit(this_edit.recipe.edits[1])
     model.db.session.delete(this_edit)
+    model.Recipe.adjust_counts(this_edit.recipe_id, edits=-1)
+    fh.remove_item('edit', this_edit.id)
+    rc.cache.invalidate_after_commit(rc.recipe_tags(this_edit.recipe))
     try:
         model.db.session.commit()
         return {'message': 'Edit successfully deleted'}, 200
     except:
         return error_response(500, 'Cannot commit to db')
 
+################ Endpoints '/api/edits/<id>/body', '/api/experiments/<id>/body' ############################
+# GET -- the full text of a timeline item, for items archived to cold storage (which the timeline only stubs)
+@api.route('/api/edits/<int:id>/body')
+@token_auth.login_required(optional=True)
+def read_edit_body(id):
+    """Returns:    {id, ingredients, instructions}"""
+    viewer = token_auth.current_user()
+    if viewer == 'expired':
+        return error_response(401)
+    this_edit = model.Edit.get_by_id(id)
+    if not this_edit or this_edit.pending_approval:
+        return error_response(404)
+    if not this_edit.recipe.is_public and ph.get_viewer_class(viewer.id if viewer else None, this_edit.recipe) == 'public':
+        return error_response(403, 'User cannot view this recipe')
+    return dict(ah.get_body(this_edit), id=this_edit.id), 200
+
+@api.route('/api/experiments/<int:id>/body')
+@token_auth.login_required(optional=True)
+def read_experiment_body(id):
+    """Returns:    {id, notes}"""
+    viewer = token_auth.current_user()
+    if viewer == 'expired':
+        return error_response(401)
+    this_experiment = model.Experiment.get_by_id(id)
+    if not this_experiment:
+        return error_response(404)
+    recipe = this_experiment.recipe
+    if not recipe.is_experiments_public and ph.get_viewer_class(viewer.id if viewer else None, recipe) == 'public':
+        return error_response(403, 'User cannot view these experiments')
+    return dict(ah.get_body(this_experiment), id=this_experiment.id), 200
+
 ################ Endpoint '/api/experiments/<id>' ############################
 # DELETE -- delete given experiment
-@app.route('/api/experiments/<id>', methods=['DELETE'])
+@api.route('/api/experiments/<id>', methods=['DELETE'])
 @token_auth.login_required()
 def delete_experiment(id):
     if token_auth.current_user() == 'expired':
@@ -780,6 +1659,9 @@ def delete_experiment(id):
     
     # delete experiment
     model.db.session.delete(this_experiment)
+    model.Recipe.adjust_counts(this_experiment.recipe_id, experiments=-1)
+    fh.remove_item('experiment', this_experiment.id)
+    rc.cache.invalidate_after_commit(rc.recipe_tags(this_experiment.recipe))
     try:
         model.db.session.commit()
         return {'message': 'Experiment successfully deleted'}, 200
@@ -787,7 +1669,7 @@ def delete_experiment(id):
         return error_response(500, 'Cannot commit to db')
 
 # PUT -- edit an experiment -- NOT HOOKED UP TO FRONTEND YET
-@app.route('/api/experiments/<id>', methods=['PUT'])
+@api.route('/api/experiments/<id>', methods=['PUT'])
 @token_auth.login_required()
 def edit_experiment(id):
     if token_auth.current_user() == 'expired':
@@ -812,10 +1694,12 @@ def edit_experiment(id):
     committer = params.get('commit_by')
 
     # edit experiment
+    ah.restore(this_experiment)
     this_experiment.commit_msg = commit_msg
     this_experiment.notes = notes
     this_experiment.commit_date = date
     this_experiment.commit_by = committer
+    rc.cache.invalidate_after_commit(rc.recipe_tags(this_experiment.recipe))
     
     try:
         model.db.session.commit(this_experiment)
@@ -825,35 +1709,51 @@ def edit_experiment(id):
 
 ################ Endpoint '/api/extract-recipe' ############################
 # GET, with url as a query string
-@app.route('/api/extract-recipe')
+@api.route('/api/extract-recipe')
+@limiter.limit('extract')
+@token_auth.login_required(optional=True)
 def extract_recipe_from_url():
-    """Uses Spoonacular API to extract recipe details from given url. Expects url to be extracted from as a GET query string"""
+    """Uses Spoonacular API to extract recipe details from given url. Expects url to be extracted from as a GET query string.
+    
+    structured_ingredients ({name, quantity, unit} dicts) can be passed back to /api/recipes POST to index them as-is.
+    similar_recipes lists recipes the viewer can see that are near-duplicates of the extracted one (as in
+    /api/recipes/<id>/similar), so the client can offer to open or fork one of those instead of saving another copy.
+    502 if Spoonacular keeps failing, 503 while it's being given a rest after that, 504 if it doesn't answer in time."""
     given_url = request.args.get('url')
     # return info from spoonacular 
     # (just title, desc, ingredients, instructions, img)
 
-    url = f'https://api.spoonacular.com/recipes/extract'
-    res = requests.get(url, {'apiKey':SPOONACULAR_KEY,
-                             'url': given_url,
-                             'forceExtraction':'false',
-                             'analyze': 'false',
-                             'includeNutrition':'false',
-                             'includeTaste':'false'})
+    res = outbound.request('spoonacular', 'GET', '/recipes/extract',
+                           params={'apiKey':current_app.config['SPOONACULAR_KEY'],
+                                   'url': given_url,
+                                   'forceExtraction':'false',
+                                   'analyze': 'false',
+                                   'includeNutrition':'false',
+                                   'includeTaste':'false'})
     
     if res.status_code != 200:
         return error_response(400,'External API call failed')
     
     recipe_details = res.json()
+    structured_ingredients = ih.from_spoonacular(recipe_details.get('extendedIngredients'))
+    viewer = token_auth.current_user()
+    viewer_id = viewer.id if isinstance(viewer, model.User) else None
+    signature = sim.signature_of([ingredient['name'] for ingredient in structured_ingredients], recipe_details.get('instructions'))
 
     return {'title': recipe_details.get('title'),
             'desc': f"Grabbed via Spoonacular from {recipe_details.get('sourceName')}\nGiven summary: {recipe_details.get('summary')}\nGiven license: {recipe_details.get('license')}",
             'ingredients': recipe_details.get('extendedIngredients'),
+            'structured_ingredients': structured_ingredients,
             'instructions': recipe_details.get('instructions'),
-            'imgUrl': recipe_details.get('image')}, 200
+            'imgUrl': recipe_details.get('image'),
+            'similar_recipes': [dict(recipe.to_dict(head=head), similarity=round(score, 2))
+                                for recipe, head, score in sim.find_similar(viewer_id, signature)]}, 200
 
 
 
 if __name__ == '__main__':
-    model.connect_to_db(app, DEV_URI, False)     # for local dev
+    from dotenv import load_dotenv
+    load_dotenv()
+    app = create_app({'DB_URI': os.environ['DEV_URI']}) # for local dev
     app.run(host='0.0.0.0', debug=True)
-    # app.run(host='0.0.0.0', debug=False)
\ No newline at end of file
+    # app.run(host='0.0.0.0', debug=False)
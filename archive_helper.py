@@ -0,0 +1,94 @@
+"""Cold storage for old edit and experiment bodies: moved out of the hot tables, compressed, and read back on demand"""
+
+from sqlalchemy import select, update, insert, delete, exists
+from sqlalchemy.orm import aliased
+from datetime import datetime, timedelta
+import json
+import zlib
+
+from model import db, Edit, Experiment, EditArchive, ExperimentArchive
+
+ARCHIVE_AFTER_DAYS = 180 # edits and experiments committed before this are archived, unless still needed hot
+ARCHIVES = {Edit: (EditArchive, EditArchive.edit_id), Experiment: (ExperimentArchive, ExperimentArchive.experiment_id)}
+
+def pack(body: dict) -> bytes:
+    return zlib.compress(json.dumps(body, separators=(',', ':')).encode())
+
+def unpack(payload: bytes) -> dict:
+    return json.loads(zlib.decompress(payload))
+
+def _archivable(model_class, cutoff: datetime):
+    """Rows old enough to archive, minus the ones something still reads the body of directly:
+    a recipe's current version (the ingredient index, forks and the recipe card), edits un-materialized
+    forks point at, and edits still pending approval"""
+    stmt = (select(model_class.id).where(model_class.commit_date < cutoff)
+            .where(model_class.is_archived == False).order_by(model_class.id))
+    if model_class is Edit:
+        newer, stub = aliased(Edit), aliased(Edit)
+        stmt = (stmt.where(Edit.pending_approval.isnot(True))
+                .where(exists().where(newer.recipe_id == Edit.recipe_id).where(newer.commit_date > Edit.commit_date)
+                       .where(newer.pending_approval.isnot(True)))
+                .where(~exists().where(stub.source_edit_id == Edit.id)))
+    return stmt
+
+def _archive_batch(model_class, ids: list[int], now: datetime) -> None:
+    archive, key = ARCHIVES[model_class]
+    fields = model_class.archived_fields
+    rows = db.session.execute(select(model_class.id, *(getattr(model_class, field) for field in fields))
+                              .where(model_class.id.in_(ids))).all()
+    db.session.execute(insert(archive), [{key.key: row[0], 'archived_at': now, 'payload': pack(dict(zip(fields, row[1:])))}
+                                         for row in rows])
+    db.session.execute(update(model_class).where(model_class.id.in_(ids))
+                       .values({**{field: None for field in fields}, 'is_archived': True})
+                       .execution_options(synchronize_session=False))
+
+def archive_old_bodies(older_than_days: int = ARCHIVE_AFTER_DAYS, batch_size: int = 500) -> int:
+    """Move the bodies of edits and experiments older than older_than_days into the archive tables,
+    batch_size rows per transaction. Safe to stop and rerun. Returns how many rows were archived."""
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    archived = 0
+    for model_class in ARCHIVES:
+        last_id = 0
+        while True:
+            ids = db.session.scalars(_archivable(model_class, cutoff).where(model_class.id > last_id).limit(batch_size)).all()
+            if not ids:
+                break
+            _archive_batch(model_class, ids, datetime.utcnow())
+            db.session.commit()
+            archived += len(ids)
+            last_id = ids[-1]
+    return archived
+
+def get_bodies(model_class, ids: list[int]) -> dict[int, dict]:
+    """id -> archived fields, for whichever of the given rows are archived"""
+    archive, key = ARCHIVES[model_class]
+    if not ids:
+        return {}
+    return {row_id: unpack(payload)
+            for row_id, payload in db.session.execute(select(key, archive.payload).where(key.in_(ids)))}
+
+def get_body(item: Edit | Experiment) -> dict:
+    """The item's archived fields, from the archive or the row itself"""
+    if item.is_archived:
+        return get_bodies(type(item), [item.id]).get(item.id, {})
+    return {field: getattr(item.content_edit if isinstance(item, Edit) else item, field) for field in item.archived_fields}
+
+def full_dicts(items: list[Edit | Experiment]) -> list[dict]:
+    """to_dict() of each item, with the body filled back in where it's archived. One query per type, at most."""
+    dicts = [item.to_dict() for item in items]
+    for model_class in ARCHIVES:
+        bodies = get_bodies(model_class, [item.id for item in items if type(item) is model_class and item.is_archived])
+        for item, dicted in zip(items, dicts):
+            if type(item) is model_class and item.id in bodies:
+                dicted.update(bodies[item.id])
+    return dicts
+
+def restore(item: Edit | Experiment) -> None:
+    """Move an archived item's body back into its row, e.g. when it becomes the current version again"""
+    if not item.is_archived:
+        return
+    archive, key = ARCHIVES[type(item)]
+    for field, value in get_body(item).items():
+        setattr(item, field, value)
+    item.is_archived = False
+    db.session.execute(delete(archive).where(key == item.id))
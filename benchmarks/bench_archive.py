@@ -0,0 +1,106 @@
+"""Cold storage benchmark: table sizes and buffer reads for recent timelines, before and after archiving old bodies.
+
+    python3 benchmarks/bench_archive.py <username:password@host:port/scratch_db_name> [--recipes N] [--edits N] [--experiments N]
+
+DROPS AND RECREATES every table in the given database. Each recipe gets a history spread over the last two years,
+with realistically sized ingredient lists, instructions and notes; then archive_old_bodies() runs. The tables are
+rewritten before each measurement (CLUSTER, VACUUM FULL) so neither side carries dead rows or layout accidents.
+"""
+
+import argparse
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import insert, text
+
+import model
+import archive_helper
+
+WORDS = ('butter flour sugar egg milk salt pepper garlic onion tomato basil lemon cream cheese rice chicken '
+         'stir fold whisk simmer bake until golden and the a with into over for minutes').split()
+
+def _prose(rng: random.Random, n_words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(n_words))
+
+def seed(n_recipes: int, n_edits: int, n_experiments: int) -> None:
+    rng = random.Random(0)
+    now = datetime.utcnow()
+    model.db.drop_all()
+    model.db.create_all()
+    user = model.User.create('bench@example.com', 'bench', 'bench')
+    model.db.session.add(user)
+    model.db.session.flush()
+    model.db.session.execute(insert(model.Recipe), [{'user_id': user.id, 'is_public': True, 'is_experiments_public': True,
+                                                      'last_modified': now} for _ in range(n_recipes)])
+    recipe_ids = model.db.session.scalars(text('SELECT id FROM recipes ORDER BY id')).all()
+    for recipe_id in recipe_ids:
+        # spread over two years, oldest first; the last few land inside the archive cutoff
+        dates = sorted(now - timedelta(days=rng.uniform(0, 730)) for _ in range(n_edits + n_experiments))
+        edit_dates, experiment_dates = dates[::2][:n_edits], dates[1::2][:n_experiments]
+        model.db.session.execute(insert(model.Edit), [
+            {'recipe_id': recipe_id, 'title': _prose(rng, 5), 'description': _prose(rng, 20),
+             'ingredients': '\n'.join(_prose(rng, 4) for _ in range(15)), 'instructions': _prose(rng, 250),
+             'commit_date': date, 'commit_by': user.id} for date in edit_dates])
+        model.db.session.execute(insert(model.Experiment), [
+            {'recipe_id': recipe_id, 'commit_msg': _prose(rng, 6), 'notes': _prose(rng, 120),
+             'commit_date': date, 'commit_by': user.id} for date in experiment_dates])
+    model.db.session.commit()
+
+def sizes() -> dict:
+    stmt = text('SELECT pg_relation_size(:t), pg_total_relation_size(:t)')
+    return {table: model.db.session.execute(stmt, {'t': table}).one()
+            for table in ('edits', 'experiments', 'edit_archives', 'experiment_archives')}
+
+def timeline_buffers(recipe_ids: list[int]) -> int:
+    """Shared buffers touched reading the (hot part of) each recipe's timeline, the way ph.get_timeline does"""
+    total = 0
+    for recipe_id in recipe_ids:
+        for table in ('edits', 'experiments'):
+            plan = model.db.session.execute(text(f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) SELECT * FROM {table} '
+                                                 f'WHERE recipe_id = :id ORDER BY commit_date DESC'), {'id': recipe_id}).scalar()
+            node = plan[0]['Plan']
+            total += node['Shared Hit Blocks'] + node['Shared Read Blocks']
+    return total
+
+def rewrite_tables() -> None:
+    """Compact every table, with each recipe's rows in timeline order -- so before and after compare row sizes,
+    not where the archiving UPDATEs happened to leave the new row versions"""
+    model.db.session.commit() # CLUSTER waits on any transaction that has read the tables
+    with model.db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(text('CLUSTER edits USING ix_edits_recipe_id_commit_date'))
+        conn.execute(text('CLUSTER experiments USING ix_experiments_recipe_id_commit_date'))
+        for table in ('edits', 'experiments', 'edit_archives', 'experiment_archives'):
+            conn.execute(text(f'VACUUM FULL ANALYZE {table}'))
+
+def report(label: str, measured: dict, buffers: int) -> None:
+    print(label)
+    for table, (heap, total) in measured.items():
+        print(f'  {table:<20} heap {heap / 1024:9.0f} kB   total (with toast, indexes) {total / 1024:9.0f} kB')
+    print(f'  timeline reads: {buffers} buffers')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('db_uri')
+    parser.add_argument('--recipes', type=int, default=2000)
+    parser.add_argument('--edits', type=int, default=12)
+    parser.add_argument('--experiments', type=int, default=12)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    model.connect_to_db(app, args.db_uri, False)
+    with app.app_context():
+        seed(args.recipes, args.edits, args.experiments)
+        rewrite_tables()
+        sample = random.Random(1).sample(model.db.session.scalars(text('SELECT id FROM recipes')).all(), 200)
+        report('before archiving:', sizes(), timeline_buffers(sample))
+        archived = archive_helper.archive_old_bodies()
+        rewrite_tables()
+        report(f'after archiving {archived} rows:', sizes(), timeline_buffers(sample))
+
+if __name__ == '__main__':
+    main()
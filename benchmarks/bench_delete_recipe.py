@@ -0,0 +1,92 @@
+"""Recipe deletion benchmark: ORM-loaded cascades (the old way) vs. ON DELETE CASCADE in one statement (Recipe.delete_with_history).
+
+    python3 benchmarks/bench_delete_recipe.py <username:password@host:port/scratch_db_name> [--items N] [--runs N]
+
+DROPS AND RECREATES every table in the given database. Each run seeds a recipe with N history items (half edits,
+half experiments) and a few collaborators, then deletes it; statements sent and wall time are reported.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import event, insert, select
+
+import model
+
+def seed(owner_id: int, collaborator_ids: list[int], n_items: int) -> int:
+    now = datetime.utcnow()
+    recipe_id = model.db.session.scalar(insert(model.Recipe).values(user_id=owner_id, last_modified=now, is_public=True,
+                                                                    is_experiments_public=True).returning(model.Recipe.id))
+    model.db.session.execute(insert(model.Edit), [
+        {'recipe_id': recipe_id, 'title': f'v{i}', 'ingredients': 'flour\nwater', 'instructions': 'knead',
+         'commit_date': now - timedelta(minutes=i), 'commit_by': owner_id} for i in range(n_items // 2)])
+    model.db.session.execute(insert(model.Experiment), [
+        {'recipe_id': recipe_id, 'commit_msg': f'try {i}', 'notes': 'fine', 'commit_date': now - timedelta(minutes=i),
+         'commit_by': owner_id} for i in range(n_items - n_items // 2)])
+    model.db.session.execute(insert(model.Permission), [{'user_id': user_id, 'recipe_id': recipe_id, 'can_experiment': True,
+                                                         'can_edit': False} for user_id in collaborator_ids])
+    model.db.session.commit()
+    model.db.session.expunge_all()
+    return recipe_id
+
+def delete_orm_cascade(recipe_id: int) -> None:
+    """What cascade='save-update, merge, delete' did: load every child, then one DELETE per row"""
+    recipe = model.db.session.get(model.Recipe, recipe_id)
+    for child in recipe.edits + recipe.experiments + recipe.pending_edits + recipe.permissions:
+        model.db.session.delete(child)
+    model.db.session.delete(recipe)
+    model.db.session.commit()
+
+def delete_in_database(recipe_id: int) -> None:
+    model.Recipe.delete_with_history(recipe_id)
+    model.db.session.commit()
+
+def measure(delete, recipe_id: int) -> tuple[int, int, float]:
+    """(round trips, rows named in DELETE parameters, seconds)"""
+    counts = {'round_trips': 0, 'rows': 0}
+    def count(conn, cursor, statement, parameters, context, executemany):
+        counts['round_trips'] += 1
+        if statement.startswith('DELETE'):
+            counts['rows'] += len(parameters) if executemany else 1
+    event.listen(model.db.engine, 'before_cursor_execute', count)
+    started = time.perf_counter()
+    try:
+        delete(recipe_id)
+    finally:
+        event.remove(model.db.engine, 'before_cursor_execute', count)
+    return counts['round_trips'], counts['rows'], time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('db_uri')
+    parser.add_argument('--items', type=int, default=5000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    model.connect_to_db(app, args.db_uri, False)
+    with app.app_context():
+        model.db.drop_all()
+        model.db.create_all()
+        users = [model.User(email=f'bench{i}@example.com', username=f'bench{i}') for i in range(4)]
+        model.db.session.add_all(users)
+        model.db.session.commit()
+        user_ids = [user.id for user in users]
+        print(f'Deleting a recipe with {args.items} history items and {len(user_ids) - 1} collaborators, median of {args.runs}:')
+        for label, delete in (('ORM-loaded cascade', delete_orm_cascade), ('ON DELETE CASCADE', delete_in_database)):
+            results = [measure(delete, seed(user_ids[0], user_ids[1:], args.items)) for _ in range(args.runs)]
+            round_trips, rows, _ = results[0]
+            seconds = statistics.median(result[2] for result in results)
+            print(f'  {label:<20} {round_trips:5} round trips, {rows:5} rows deleted by the app, {seconds * 1000:8.1f} ms')
+        remaining = model.db.session.scalar(select(model.db.func.count(model.Edit.id)))
+        print(f'  (edits left over: {remaining})')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""List read benchmark: a big profile and a long timeline read as ORM objects (to_dict()) vs. as Core rows (dto_helper).
+
+    python3 benchmarks/bench_list_reads.py <username:password@host:port/scratch_db_name> [--recipes N] [--edits N] [--runs N]
+
+DROPS AND RECREATES every table in the given database. Seeds one user with N recipes of a few edits each, and one
+recipe with a long history, then serializes each list to JSON both ways. Each list is read each way in its own process,
+so the peak RSS reported (growth over the process's size before the first read) is that read's alone; wall time is the median of the runs.
+"""
+
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import desc, insert, select
+
+import model
+import dto_helper as dh
+import permissions_helper as ph
+
+BODY = 'a line of ingredients or instructions, long enough to look like a real recipe\n' * 20 # ~1.6KB
+
+def seed(n_recipes: int, n_edits: int) -> None:
+    owner = model.User(email='bench@example.com', username='bench')
+    model.db.session.add(owner)
+    model.db.session.commit()
+    now = datetime.utcnow()
+    recipe_ids = model.db.session.scalars(insert(model.Recipe).returning(model.Recipe.id), [
+        {'user_id': owner.id, 'last_modified': now - timedelta(minutes=i), 'is_public': True, 'is_experiments_public': True,
+         'edit_count': 4} for i in range(n_recipes + 1)]).all()
+    rows = [{'recipe_id': recipe_id, 'title': f'Recipe {recipe_id} v{i}', 'description': 'desc', 'ingredients': BODY,
+             'instructions': BODY, 'commit_date': now - timedelta(minutes=i), 'commit_by': owner.id}
+            for recipe_id in recipe_ids[1:] for i in range(4)]
+    rows += [{'recipe_id': recipe_ids[0], 'title': f'Long v{i}', 'description': 'desc', 'ingredients': BODY,
+              'instructions': BODY, 'commit_date': now - timedelta(minutes=i), 'commit_by': owner.id} for i in range(n_edits)]
+    model.db.session.execute(insert(model.Edit), rows)
+    model.db.session.commit()
+
+def iter_dicts(stmt):
+    """The ORM baseline: each object's to_dict(), loaded a batch at a time"""
+    for obj in model.db.session.scalars(stmt, execution_options={'yield_per': dh.YIELD_PER}):
+        yield obj.to_dict()
+
+def reads(path: str) -> dict:
+    """The two lists, read one way: {name: function returning a generator of dicts}"""
+    owner_id = model.db.session.scalar(select(model.User.id).where(model.User.username == 'bench'))
+    long_id = model.db.session.scalar(select(model.Recipe.id).order_by(model.Recipe.id).limit(1))
+    if path == 'orm':
+        return {'profile': lambda: iter_dicts(select(model.Recipe).where(model.Recipe.user_id == owner_id)
+                                              .order_by(desc(model.Recipe.last_modified))),
+                'timeline': lambda: iter_dicts(select(model.Edit).where(model.Edit.recipe_id == long_id)
+                                               .where(model.Edit.pending_approval.isnot(True)).order_by(desc(model.Edit.commit_date)))}
+    return {'profile': lambda: dh.iter_rows(ph.select_own_cards(owner_id), dh.RecipeCard),
+            'timeline': lambda: dh.iter_rows(dh.select_edit_rows(long_id), dh.EditRow)}
+
+def measure(db_uri: str, path: str, name: str, runs: int) -> None:
+    """In a child process: time one read, and print [median seconds, peak RSS growth in KB] as JSON"""
+    app = Flask(__name__)
+    model.connect_to_db(app, db_uri, False)
+    with app.app_context():
+        read = reads(path)[name] # connects, before the baseline
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        seconds = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            for item in read():
+                json.dumps(item, default=str)
+            seconds.append(time.perf_counter() - started)
+            model.db.session.expunge_all()
+        print(json.dumps([statistics.median(seconds), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline]))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('db_uri')
+    parser.add_argument('--recipes', type=int, default=5000)
+    parser.add_argument('--edits', type=int, default=20000)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--measure', nargs=2, help=argparse.SUPPRESS) # <orm | rows> <profile | timeline>: a child process
+    args = parser.parse_args()
+    if args.measure:
+        return measure(args.db_uri, *args.measure, args.runs)
+
+    app = Flask(__name__)
+    model.connect_to_db(app, args.db_uri, False)
+    with app.app_context():
+        model.db.drop_all()
+        model.db.create_all()
+        seed(args.recipes, args.edits)
+    print(f'Serializing a profile of {args.recipes} recipes and a timeline of {args.edits} edits, median of {args.runs}:')
+    for name in ('profile', 'timeline'):
+        for label, path in (('ORM to_dict()', 'orm'), ('Core rows', 'rows')):
+            output = subprocess.run([sys.executable, __file__, args.db_uri, '--runs', str(args.runs), '--measure', path, name],
+                                    check=True, capture_output=True, text=True).stdout
+            seconds, peak_kb = json.loads(output.splitlines()[-1])
+            print(f'  {name:<9} {label:<14} {seconds * 1000:8.1f} ms, peak RSS +{peak_kb / 1024:6.1f} MB')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Cold start benchmark for the API: how long a fresh worker takes to import, build the app, and answer its first requests.
+
+    python3 benchmarks/bench_startup.py [<username:password@host:port/db_name>] [--runs N]
+
+Each run is a fresh interpreter, so nothing is cached between runs. Without a db uri, only the first request
+that doesn't touch the db is timed.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs in the child interpreter; prints one JSON line of timings (seconds)
+CHILD = '''
+import json, sys, time
+t0 = time.perf_counter()
+import api_server
+t1 = time.perf_counter()
+app = api_server.create_app({'DB_URI': sys.argv[1] or '/unused'})
+t2 = time.perf_counter()
+client = app.test_client()
+client.get('/api/metrics')
+t3 = time.perf_counter()
+timings = {'import': t1 - t0, 'create_app': t2 - t1, 'first_request': t3 - t2,
+           'lazy_clients_loaded': any(name in sys.modules for name in ('requests', 'cloudinary'))}
+if sys.argv[1]:
+    client.get('/api/users/no-such-user') # first query: opens the first db connection
+    timings['first_db_request'] = time.perf_counter() - t3
+print(json.dumps(timings))
+'''
+
+def run_once(db_uri: str) -> dict:
+    result = subprocess.run([sys.executable, '-c', CHILD, db_uri], cwd=REPO_DIR, 
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('db_uri', nargs='?', default='')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [run_once(args.db_uri) for _ in range(args.runs)]
+    print(f'{args.runs} cold starts, median (min-max) in ms:')
+    for key in ('import', 'create_app', 'first_request', 'first_db_request'):
+        if key in runs[0]:
+            values = [run[key] * 1000 for run in runs]
+            print(f'  {key:<18}{statistics.median(values):8.1f}  ({min(values):.1f}-{max(values):.1f})')
+    print(f'  requests/cloudinary imported at startup: {runs[0]["lazy_clients_loaded"]}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Per-request deadlines: each request gets a time budget (by route), which caps how long its db statements
+(SET LOCAL statement_timeout) and outbound HTTP calls may take. Running out raises DeadlineExceeded."""
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+import time
+
+import metrics
+
+# view function name -> seconds; override with app.config['DEADLINE_BUDGETS']. Everything else gets DEADLINE_SECONDS.
+# All of them should stay well under gunicorn's timeout (30s), which kills the whole worker instead.
+DEFAULT_BUDGETS = {
+    'extract_recipe_from_url': 20, # waits on Spoonacular
+    'update_user': 20, # an avatar upload waits on Cloudinary
+    'create_batch': 20,
+    'batch_permissions': 20,
+    'stream_recipe_events': 5, # just the opening checks; each check after that gets events_helper.CHECK_SECONDS
+}
+QUERY_CANCELED = '57014' # SQLSTATE Postgres sends when statement_timeout cancels a statement
+
+class DeadlineExceeded(Exception):
+    """The request ran out of time. source is what noticed: 'db' (statement_timeout), 'http' (an outbound call)
+    or 'app' (nothing left to start the next step with). Counted in metrics when raised."""
+    def __init__(self, source: str):
+        super().__init__(f'Request deadline exceeded ({source})')
+        self.source = source
+        metrics.incr('deadline.exceeded')
+        metrics.incr(f'deadline.exceeded.{source}')
+
+def start(seconds: float) -> None:
+    """Give the current request seconds from now"""
+    g.deadline = time.monotonic() + seconds
+
+def remaining() -> float | None:
+    """Seconds the current request has left, or None if it has no deadline (or this isn't a request)"""
+    if not has_request_context() or 'deadline' not in g:
+        return None
+    return g.deadline - time.monotonic()
+
+def check() -> float | None:
+    """remaining(), or raise DeadlineExceeded if there's nothing left"""
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded('app')
+    return left
+
+def http_timeout(connect: float = 3.05, read: float = 10) -> tuple[float, float]:
+    """(connect, read) timeouts for requests, cut down to what's left of the request's budget.
+    requests applies them per socket operation, so a slow trickle can still outlast them -- but not by much."""
+    left = check()
+    if left is None:
+        return connect, read
+    return min(connect, left), min(read, left)
+
+def _start_request() -> None:
+    name = request.endpoint.rpartition('.')[2] if request.endpoint else None
+    budget = current_app.config['DEADLINE_BUDGETS'].get(name) or DEFAULT_BUDGETS.get(name)
+    start(budget or current_app.config['DEADLINE_SECONDS'])
+
+def init_app(app) -> None:
+    app.config.setdefault('DEADLINE_SECONDS', 10)
+    app.config.setdefault('DEADLINE_BUDGETS', {})
+    app.before_request(_start_request)
+
+@event.listens_for(Session, 'after_begin')
+def _set_statement_timeout(session, transaction, connection):
+    """Each transaction a request begins gets what's left of its budget as statement_timeout.
+    SET LOCAL, so it ends with the transaction and never leaks to the connection's next user."""
+    left = check()
+    if left is not None:
+        connection.exec_driver_sql(f'SET LOCAL statement_timeout = {max(1, int(left * 1000))}') # 0 would mean none
+
+@event.listens_for(Engine, 'handle_error')
+def _raise_deadline_exceeded(context):
+    if getattr(context.original_exception, 'pgcode', None) == QUERY_CANCELED and remaining() is not None:
+        raise DeadlineExceeded('db') from context.original_exception
@@ -0,0 +1,109 @@
+"""Read-only rows for list endpoints: the columns a recipe card or timeline item shows, selected with Core and mapped
+into namedtuples, so a long profile or timeline is serialized without building (and identity-mapping) ORM objects.
+Each row's to_dict() gives the same dict as the model's to_dict()."""
+
+from collections import namedtuple
+from sqlalchemy import select, desc, case, null, true
+from sqlalchemy.orm import aliased
+
+from model import db, User, Recipe, Edit, Experiment
+from response_helper import YIELD_PER, READ_BY_TO_DICT, only_fields
+
+RECIPE_COLUMNS = tuple(Recipe.__table__.columns.keys())
+EDIT_COLUMNS = tuple(Edit.__table__.columns.keys())
+EXPERIMENT_COLUMNS = tuple(Experiment.__table__.columns.keys())
+
+class RecipeCard(namedtuple('RecipeCard', (*RECIPE_COLUMNS, 'title', 'description', 'img_url', 'owner', 'owner_avatar',
+                                           'forked_from_username', 'forked_from_avatar'))):
+    """A recipe as lists show it: its columns, its head edit's title, description and picture, and who owns it (and its parent)"""
+    __slots__ = ()
+
+    def to_dict(self) -> dict:
+        dicted = self._asdict()
+        if not self.forked_from:
+            del dicted['forked_from_username'], dicted['forked_from_avatar']
+        return dicted
+
+class _TimelineRow:
+    """to_dict() for timeline rows, whose last two values are the committer's username and avatar"""
+    __slots__ = ()
+    item_type = None
+    archived_fields = ()
+
+    def to_dict(self) -> dict:
+        dicted = self._asdict()
+        username, avatar = dicted.pop('committer'), dicted.pop('committer_avatar')
+        dicted['item_type'] = self.item_type
+        if self.is_archived: # stub: the client fetches the body if it's expanded
+            for field in self.archived_fields:
+                dicted.pop(field, None)
+        if username is not None:
+            dicted['commit_by'] = username
+            dicted['commit_by_avatar'] = avatar
+        return dicted
+
+class EditRow(_TimelineRow, namedtuple('EditRow', (*EDIT_COLUMNS, 'committer', 'committer_avatar'))):
+    __slots__ = ()
+    item_type = 'edit'
+    archived_fields = Edit.archived_fields
+
+class ExperimentRow(_TimelineRow, namedtuple('ExperimentRow', (*EXPERIMENT_COLUMNS, 'committer', 'committer_avatar'))):
+    __slots__ = ()
+    item_type = 'experiment'
+    archived_fields = Experiment.archived_fields
+
+def iter_rows(stmt, row_class, fields: frozenset | None = None, batch_size: int = YIELD_PER):
+    """Lazily run one of the select_*() statements below and yield each row's to_dict() (cut down to fields),
+    fetching batch_size rows at a time from a server-side cursor"""
+    for row in db.session.execute(stmt, execution_options={'yield_per': batch_size}):
+        yield only_fields(row_class._make(row).to_dict(), fields)
+
+def select_recipe_cards(*criteria, order_by=()):
+    """Statement for RecipeCards of the recipes matching criteria (e.g. Recipe.user_id == 3), in one query"""
+    # SELECT recipes.*, <head's content>, owner.username, owner.img_url, parent_owner.username, parent_owner.img_url
+    # FROM recipes LEFT JOIN LATERAL (SELECT ... FROM edits WHERE recipe_id = recipes.id ORDER BY commit_date DESC LIMIT 1) head
+    # LEFT JOIN edits source ON source.id = head.source_edit_id LEFT JOIN users owner ... WHERE <criteria>
+    source, owner, parent, parent_owner = aliased(Edit), aliased(User), aliased(Recipe), aliased(User)
+    head = (select(Edit.title, Edit.description, Edit.img_url, Edit.source_edit_id)
+            .where(Edit.recipe_id == Recipe.id).where(Edit.pending_approval.isnot(True))
+            .order_by(desc(Edit.commit_date)).limit(1).lateral('head'))
+    content = [case((head.c.source_edit_id.isnot(None), getattr(source, key)), else_=head.c[key]) # fork stubs show their source
+               for key in ('title', 'description', 'img_url')]
+    return (select(*(getattr(Recipe, key) for key in RECIPE_COLUMNS), *content, owner.username, owner.img_url,
+                   parent_owner.username, parent_owner.img_url)
+            .select_from(Recipe)
+            .outerjoin(head, true())
+            .outerjoin(source, source.id == head.c.source_edit_id)
+            .outerjoin(owner, owner.id == Recipe.user_id)
+            .outerjoin(parent, parent.id == Recipe.forked_from)
+            .outerjoin(parent_owner, parent_owner.id == parent.user_id)
+            .where(*criteria).order_by(*order_by))
+
+def _item_columns(model_class, keys: tuple, fields: frozenset | None, source=None) -> list:
+    """The model's columns in row order; ones outside the fieldset are NULL instead, so big bodies stay in the db"""
+    columns = []
+    for key in keys:
+        if fields is not None and key not in fields and key not in READ_BY_TO_DICT[model_class]:
+            columns.append(null().label(key))
+        elif source is not None and key in Edit.content_fields:
+            columns.append(case((Edit.source_edit_id.isnot(None), getattr(source, key)), else_=getattr(Edit, key)).label(key))
+        else:
+            columns.append(getattr(model_class, key))
+    return columns
+
+def select_edit_rows(recipe_id: int, fields: frozenset | None = None):
+    """Statement for EditRows of a recipe's timeline (not counting pending edits), newest first"""
+    source, committer = aliased(Edit), aliased(User)
+    return (select(*_item_columns(Edit, EDIT_COLUMNS, fields, source), committer.username, committer.img_url)
+            .outerjoin(source, source.id == Edit.source_edit_id)
+            .outerjoin(committer, committer.id == Edit.commit_by)
+            .where(Edit.recipe_id == recipe_id).where(Edit.pending_approval.isnot(True))
+            .order_by(desc(Edit.commit_date)))
+
+def select_experiment_rows(recipe_id: int, fields: frozenset | None = None):
+    """Statement for ExperimentRows of a recipe's timeline, newest first"""
+    committer = aliased(User)
+    return (select(*_item_columns(Experiment, EXPERIMENT_COLUMNS, fields), committer.username, committer.img_url)
+            .outerjoin(committer, committer.id == Experiment.commit_by)
+            .where(Experiment.recipe_id == recipe_id)
+            .order_by(desc(Experiment.commit_date)))
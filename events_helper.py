@@ -0,0 +1,104 @@
+"""Live timeline updates as Server-Sent Events, read from the change log whenever pubsub says a recipe has changed"""
+
+from sqlalchemy import select
+import json
+import time
+
+from model import db, Edit, Experiment, Change, Permission
+import permissions_helper as ph
+from sync_helper import oldest_running_txid
+import deadline
+from pubsub import hub
+import metrics
+
+KEEPALIVE_SECONDS = 15 # re-check (and write a comment, so dead connections are noticed) at least this often
+RETRY_MS = 2000 # how long EventSource waits before reconnecting
+CHECK_SECONDS = 5 # deadline for each check's queries (the stream as a whole runs much longer)
+MODELS = {'edit': Edit, 'experiment': Experiment}
+
+def format_event(event: str | None = None, data: dict | None = None, id: int | None = None) -> str:
+    lines = []
+    if event:
+        lines.append(f'event: {event}')
+    if data is not None:
+        lines.append(f'data: {json.dumps(data, default=str, separators=(",", ":"))}')
+    if id is not None:
+        lines.append(f'id: {id}')
+    return '\n'.join(lines) + '\n\n'
+
+def visible_types(viewer_id: int | None, recipe_id: int) -> tuple | None:
+    """The item types the viewer sees right now, () if they've lost access, or None if the recipe is gone"""
+    recipe = ph.get_recipe_without_history(recipe_id)
+    if recipe is None:
+        return None
+    if recipe.user_id == viewer_id:
+        return ph.visible_item_types(recipe, True, None)
+    permission = Permission.get_by_user_and_recipe(viewer_id, recipe_id) if viewer_id is not None else None
+    return ph.visible_item_types(recipe, False, permission)
+
+def _events_for(changes: list[Change], visible: tuple) -> list[str]:
+    """One upsert (with the item's current to_dict()) or delete event per changed item, in the order of its last change"""
+    latest = {}
+    for change in changes:
+        if change.entity_type in visible:
+            latest.pop((change.entity_type, change.entity_id), None)
+            latest[(change.entity_type, change.entity_id)] = change.op # re-inserted, so dict order is last-change order
+    items = {}
+    for entity_type, model_class in MODELS.items():
+        ids = [entity_id for (changed_type, entity_id), op in latest.items() if changed_type == entity_type and op == 'upsert']
+        if ids:
+            stmt = select(model_class).where(model_class.id.in_(ids))
+            if model_class is Edit:
+                stmt = stmt.where(Edit.pending_approval.isnot(True))
+            items.update({(entity_type, item.id): item.to_dict() for item in db.session.scalars(stmt)})
+    events = []
+    for (entity_type, entity_id), op in latest.items():
+        item = items.get((entity_type, entity_id))
+        if item is None: # deleted, or gone since
+            events.append(format_event('delete', {'item_type': entity_type, 'id': entity_id}))
+        else:
+            events.append(format_event('upsert', {'item_type': entity_type, 'id': entity_id, 'item': item}))
+    return events
+
+def stream_timeline(viewer_id: int | None, recipe_id: int, cursor: int, max_seconds: float):
+    """Generator of SSE text: changes to the recipe's edits and experiments logged at or after transaction id cursor
+    (a sync token, see sync_helper), as they commit,
+    for max_seconds; the client then reconnects with the last id it got (Last-Event-ID) and carries on from there.
+
+    Events:   upsert {item_type, id, item: <same as in the timeline>}, delete {item_type, id}
+              revoked {} -- the viewer can't see the recipe any more; deleted {} -- the recipe is gone. Both end the stream.
+    Ids are checkpoints into the change log. Changes right after one may be sent again on reconnect;
+    an upsert or delete is safe to apply twice.
+
+    No db connection is held between checks, and visibility is re-checked every time, so revoked access ends the stream.
+    """
+    subscription = hub.subscribe(recipe_id) # before the first read, so nothing committed after it is missed
+    ends_at = time.monotonic() + max_seconds
+    sent = set() # ids of changes already sent that the cursor hasn't passed yet, so they aren't sent again
+    metrics.incr('events.streams')
+    try:
+        yield f'retry: {RETRY_MS}\n\n'
+        while True:
+            deadline.start(CHECK_SECONDS)
+            visible = visible_types(viewer_id, recipe_id)
+            if not visible:
+                yield format_event('deleted' if visible is None else 'revoked', {})
+                return
+            new_cursor = max(cursor, oldest_running_txid()) # before reading: what this check can't see is at or after it
+            changes = db.session.scalars(select(Change).where(Change.recipe_id == recipe_id).where(Change.txid >= cursor)
+                                         .order_by(Change.id)).all()
+            events = _events_for([change for change in changes if change.id not in sent], visible)
+            sent = {change.id for change in changes if change.txid >= new_cursor}
+            db.session.rollback() # give the connection back to the pool while waiting
+            if events or new_cursor != cursor:
+                yield ''.join(events) + (format_event(id=new_cursor) if new_cursor != cursor else '')
+                metrics.incr('events.sent', len(events))
+                cursor = new_cursor
+            remaining = ends_at - time.monotonic()
+            if remaining <= 0:
+                return
+            if not subscription.wait(min(KEEPALIVE_SECONDS, remaining)):
+                yield ': keepalive\n\n'
+    finally:
+        hub.unsubscribe(subscription)
+        db.session.rollback()
@@ -0,0 +1,103 @@
+from model import (db, User, Recipe, Edit, Experiment, Permission, FeedItem)
+from sqlalchemy import select, union, insert, delete, desc, func, tuple_
+import tasks
+
+FEED_MAX_ITEMS = 500        # entries kept per user; older ones are trimmed on every fan-out
+INLINE_FANOUT_LIMIT = 25    # recipes shared with more users than this get fanned out by a background worker
+
+def get_recipe_audience(recipe_ids: list[int]) -> dict[int, set[int]]:
+    """Given recipe ids, return {recipe_id: set of user ids} of everyone who owns or holds a Permission on each"""
+
+    # SELECT id, user_id FROM recipes WHERE id IN <recipe_ids>
+    # UNION
+    # SELECT recipe_id, user_id FROM permissions WHERE recipe_id IN <recipe_ids>
+    select_owners = select(Recipe.id.label('recipe_id'), Recipe.user_id).where(Recipe.id.in_(recipe_ids))
+    select_collaborators = select(Permission.recipe_id, Permission.user_id).where(Permission.recipe_id.in_(recipe_ids))
+    audience = {recipe_id: set() for recipe_id in recipe_ids}
+    for row in db.session.execute(union(select_owners, select_collaborators)):
+        audience[row.recipe_id].add(row.user_id)
+    return audience
+
+def _entry_for(item: Edit | Experiment) -> dict:
+    is_edit = isinstance(item, Edit)
+    return {'recipe_id': item.recipe_id,
+            'item_type': 'edit' if is_edit else 'experiment',
+            'item_id': item.id,
+            'actor_id': item.commit_by,
+            'summary': item.title if is_edit else item.commit_msg,
+            'created_at': item.commit_date}
+
+def _write_entries(entries: list[dict], audience: dict[int, set[int]]) -> None:
+    """Insert one feed row per (entry, recipient), skipping the actor, then trim the touched feeds"""
+    rows = [dict(entry, user_id=user_id)
+            for entry in entries
+            for user_id in audience.get(entry['recipe_id'], ())
+            if user_id != entry['actor_id']]
+    if not rows:
+        return
+    db.session.execute(insert(FeedItem), rows)
+    trim_feeds({row['user_id'] for row in rows})
+
+def fan_out(items: list[Edit | Experiment]) -> None:
+    """Push newly created edits/experiments (already flushed, so they have ids) to their recipes' audiences.
+
+    Small audiences are written in the caller's transaction; if the total audience is over INLINE_FANOUT_LIMIT,
+    the write is handed to a background worker once the caller commits.
+    """
+    entries = [_entry_for(item) for item in items]
+    audience = get_recipe_audience(list({entry['recipe_id'] for entry in entries}))
+    if sum(len(users) for users in audience.values()) > INLINE_FANOUT_LIMIT:
+        tasks.run_after_commit(_fan_out_job, entries)
+    else:
+        _write_entries(entries, audience)
+
+def _fan_out_job(entries: list[dict]) -> None:
+    # audience is re-read, since permissions may have changed since the request
+    audience = get_recipe_audience(list({entry['recipe_id'] for entry in entries}))
+    _write_entries(entries, audience)
+    db.session.commit()
+
+def trim_feeds(user_ids: set[int], max_items: int = FEED_MAX_ITEMS) -> None:
+    """Delete all but the newest max_items entries from each given user's feed"""
+    ranked = select(FeedItem.id,
+                    func.row_number().over(partition_by=FeedItem.user_id, order_by=desc(FeedItem.id)).label('rank')
+                    ).where(FeedItem.user_id.in_(user_ids)).subquery()
+    db.session.execute(delete(FeedItem).where(FeedItem.id.in_(select(ranked.c.id).where(ranked.c.rank > max_items))))
+
+def remove_item(item_type: str, item_id: int) -> None:
+    """Remove a deleted edit/experiment from every feed it was fanned out to"""
+    db.session.execute(delete(FeedItem).where(FeedItem.item_type == item_type).where(FeedItem.item_id == item_id))
+
+def remove_recipe_for_user(user_id: int, recipe_id: int) -> None:
+    """Remove a recipe's entries from a user's feed, e.g. when their permission is revoked"""
+    db.session.execute(delete(FeedItem).where(FeedItem.user_id == user_id).where(FeedItem.recipe_id == recipe_id))
+
+def remove_recipes_for_users(pairs: list[tuple]) -> None:
+    """remove_recipe_for_user() for many (user_id, recipe_id) pairs at once"""
+    if pairs:
+        db.session.execute(delete(FeedItem).where(tuple_(FeedItem.user_id, FeedItem.recipe_id).in_(pairs)))
+
+def get_feed_page(user_id: int, before: int | None, limit: int) -> tuple[list[dict], int | None]:
+    """Given a user's id, return (entries newest first, cursor for the next page or None)"""
+
+    # SELECT feed_items.*, users.username, users.img_url FROM feed_items LEFT JOIN users ON actor_id = users.id
+    # WHERE feed_items.user_id = <user_id> AND feed_items.id < <before>
+    # ORDER BY feed_items.id DESC LIMIT <limit + 1>
+    stmt = (select(FeedItem, User.username, User.img_url)
+            .outerjoin(User, FeedItem.actor_id == User.id)
+            .where(FeedItem.user_id == user_id)
+            .order_by(desc(FeedItem.id))
+            .limit(limit + 1)) # one extra row tells us whether there's a next page
+    if before is not None:
+        stmt = stmt.where(FeedItem.id < before)
+    rows = db.session.execute(stmt).all()
+    page = [{'id': entry.id,
+             'recipe_id': entry.recipe_id,
+             'item_type': entry.item_type,
+             'item_id': entry.item_id,
+             'summary': entry.summary,
+             'created_at': entry.created_at,
+             'actor': username,
+             'actor_avatar': img_url} for entry, username, img_url in rows[:limit]]
+    next_cursor = page[-1]['id'] if len(rows) > limit else None
+    return page, next_cursor
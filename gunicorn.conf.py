@@ -0,0 +1,15 @@
+"""gunicorn settings for the Forkd API: gunicorn -c gunicorn.conf.py 'api_server:create_app()'"""
+
+import os
+
+bind = ':5000'
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# threaded workers: an open /api/recipes/<id>/events stream ties up one thread, not a whole worker.
+# Streams hold no db connection while they wait, and at most EVENTS_MAX_STREAMS (12) are let in per worker
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+# build the app once in the master and fork it into each worker: faster worker (re)starts, shared memory pages.
+# create_app() doesn't open db connections, and each worker drops any it inherits (see api_server._after_fork)
+preload_app = True
+timeout = 30
+accesslog = '-'
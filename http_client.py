@@ -0,0 +1,175 @@
+"""Outbound HTTP to the APIs Forkd depends on (Spoonacular, Cloudinary): a pooled keep-alive session per upstream,
+timeouts capped by the request's deadline, a few retries with jittered backoff, and a circuit breaker per upstream
+that fails fast while it's down -- so a slow upstream can't tie up every worker thread"""
+
+from flask import current_app
+import logging
+import random
+import threading
+import time
+
+import deadline
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# upstream name -> settings; override any of them with app.config['HTTP_UPSTREAMS'] (e.g. to use upstream_stubs.py)
+DEFAULT_UPSTREAMS = {
+    'spoonacular': {'base_url': 'https://api.spoonacular.com', 'connect_timeout': 3.05, 'read_timeout': 10, 'retries': 2},
+    'cloudinary': {'base_url': 'https://api.cloudinary.com', 'connect_timeout': 3.05, 'read_timeout': 20, 'retries': 2},
+}
+RETRY_STATUSES = {429, 502, 503, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'} # anything else is only retried if it never got sent
+BACKOFF_SECONDS = 0.2 # the first retry waits up to this long, the second up to twice as long, ...
+
+class UpstreamError(Exception):
+    """The upstream failed on every attempt: 502, or 504 if it timed out"""
+    def __init__(self, upstream: str, message: str, status_code: int = 502):
+        super().__init__(f'{upstream}: {message}')
+        self.upstream = upstream
+        self.status_code = status_code
+
+class CircuitOpen(UpstreamError):
+    """Not even tried: the upstream's been failing, and its breaker stays open for another retry_after seconds"""
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(upstream, 'unavailable, not retrying yet', 503)
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Opens after threshold failures in a row, and then fails calls at once. After reset_seconds it lets one call
+    through: if that works it closes again, if not it stays open for another reset_seconds."""
+    def __init__(self, threshold: int, reset_seconds: float):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._trying = False # a call is testing the upstream while half-open
+        self._lock = threading.Lock()
+
+    def allow(self) -> float:
+        """0 if a call may go ahead, else seconds until one may"""
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            waited = time.monotonic() - self._opened_at
+            if waited < self.reset_seconds:
+                return self.reset_seconds - waited
+            if self._trying:
+                return 1
+            self._trying = True
+            return 0
+
+    def record(self, ok: bool) -> bool:
+        """Count a call's outcome. Returns whether it opened the breaker."""
+        with self._lock:
+            self._trying = False
+            if ok:
+                self._failures = 0
+                self._opened_at = None
+                return False
+            self._failures += 1
+            if self._opened_at is None and self._failures < self.threshold:
+                return False
+            opened = self._opened_at is None
+            self._opened_at = time.monotonic()
+            return opened
+
+class HttpClient:
+    """Flask extension. Call upstreams with client.request('<upstream>', method, path, ...) rather than with requests.
+
+    Sessions and breakers are per process (and per upstream); requests itself is only imported on the first call.
+    """
+    def __init__(self, app=None):
+        self._sessions = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        app.config.setdefault('HTTP_UPSTREAMS', {})
+        app.config.setdefault('HTTP_POOL_SIZE', 16) # connections kept open per upstream: one per gunicorn thread
+        app.config.setdefault('HTTP_BREAKER_FAILURES', 5)
+        app.config.setdefault('HTTP_BREAKER_RESET_SECONDS', 30)
+
+    def settings(self, upstream: str) -> dict:
+        return dict(DEFAULT_UPSTREAMS[upstream], **current_app.config['HTTP_UPSTREAMS'].get(upstream, {}))
+
+    def reset(self) -> None:
+        """Forget the sessions and breakers, e.g. in a forked child (the parent's sockets aren't closed)"""
+        with self._lock:
+            self._sessions = {}
+            self._breakers = {}
+
+    def _session(self, upstream: str):
+        with self._lock:
+            if upstream not in self._sessions:
+                import requests # only loaded once something calls out
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=current_app.config['HTTP_POOL_SIZE'], max_retries=0)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[upstream] = session
+            return self._sessions[upstream]
+
+    def breaker(self, upstream: str) -> CircuitBreaker:
+        with self._lock:
+            if upstream not in self._breakers:
+                self._breakers[upstream] = CircuitBreaker(current_app.config['HTTP_BREAKER_FAILURES'],
+                                                          current_app.config['HTTP_BREAKER_RESET_SECONDS'])
+            return self._breakers[upstream]
+
+    def request(self, upstream: str, method: str, path: str, **kwargs):
+        """Send method path (plus requests kwargs: params, data, files...) to the upstream, and return its response.
+        Timeouts, connection errors and 429/502/503/504 are retried, but never past the request's deadline.
+
+        Raises CircuitOpen if the upstream's breaker is open, UpstreamError if every attempt failed,
+        or deadline.DeadlineExceeded if the request ran out of time first.
+        """
+        import requests
+        settings = self.settings(upstream)
+        deadline.check() # out of time already isn't the upstream's fault, so it shouldn't count against it
+        breaker = self.breaker(upstream)
+        wait = breaker.allow()
+        if wait:
+            metrics.incr(f'http.{upstream}.short_circuited')
+            raise CircuitOpen(upstream, wait)
+        session = self._session(upstream)
+        retry_any = method.upper() in IDEMPOTENT_METHODS
+        ok = False
+        try:
+            for attempt in range(settings['retries'] + 1):
+                if attempt:
+                    pause = random.uniform(0, BACKOFF_SECONDS * 2 ** (attempt - 1)) # "full jitter"
+                    left = deadline.remaining()
+                    if left is not None and left <= pause:
+                        break
+                    metrics.incr(f'http.{upstream}.retries')
+                    time.sleep(pause)
+                timeout = deadline.http_timeout(settings['connect_timeout'], settings['read_timeout'])
+                started = time.perf_counter()
+                try:
+                    response = session.request(method, settings['base_url'] + path, timeout=timeout, **kwargs)
+                except requests.ConnectTimeout: # never got sent, so safe to send again
+                    failure, status_code, retry = 'connect timeout', 504, True
+                except requests.Timeout:
+                    failure, status_code, retry = 'timeout', 504, retry_any
+                except requests.ConnectionError:
+                    failure, status_code, retry = 'connection error', 502, retry_any
+                else:
+                    if response.status_code < 500 and response.status_code not in RETRY_STATUSES:
+                        ok = True
+                        return response
+                    failure, status_code, retry = f'status {response.status_code}', 502, retry_any and response.status_code in RETRY_STATUSES
+                finally:
+                    metrics.observe(f'http.{upstream}', time.perf_counter() - started)
+                metrics.incr(f'http.{upstream}.failures')
+                if not retry:
+                    break
+            if status_code == 504 and timeout[1] < settings['read_timeout']: # cut short by the deadline
+                raise deadline.DeadlineExceeded('http')
+            raise UpstreamError(upstream, failure, status_code)
+        finally:
+            if breaker.record(ok):
+                metrics.incr(f'http.{upstream}.breaker_opened')
+                logger.warning('%s keeps failing; failing calls to it fast for %ss', upstream, breaker.reset_seconds)
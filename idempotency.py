@@ -0,0 +1,125 @@
+"""Idempotency-Key support for POST endpoints: the first successful response to a key is kept (for IDEMPOTENCY_TTL),
+and a retry with the same key gets it back instead of running again"""
+
+from flask import Response, current_app, make_response, request
+from werkzeug.exceptions import Conflict, UnprocessableEntity
+from sqlalchemy import delete, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+from datetime import datetime, timedelta
+from functools import wraps
+import hashlib
+import time
+
+from model import db, IdempotencyKey
+import deadline
+import metrics
+
+MAX_KEY_LENGTH = 255
+PRUNE_BATCH = 100 # expired keys dropped every time a response is kept, so the table trims itself
+POLL_SECONDS = 0.05 # how often a duplicate checks whether the first request's response is in yet
+
+def prune_keys() -> int:
+    """Drop every expired key (storing a response already drops a few; this catches up in one go)"""
+    removed = db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at < datetime.utcnow())).rowcount
+    db.session.commit()
+    return removed
+
+def _request_hash() -> str:
+    digest = hashlib.sha256(f'{request.method} {request.full_path}\n'.encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+def _entry_filter(user_id: int, key: str):
+    return (IdempotencyKey.user_id == user_id) & (IdempotencyKey.key == key)
+
+class Idempotency:
+    """Flask extension. Decorate POST routes with @idempotency.idempotent (inside the auth decorator), and tell it
+    who's asking with @idempotency.user_id_loader. Requests without an Idempotency-Key header, or from nobody, just run.
+
+    The key is claimed with an INSERT in the request's own transaction, so it commits along with whatever the route
+    writes, and a concurrent duplicate blocks on that row until the first request commits or rolls back.
+    Only successful (2xx/3xx) responses are kept: an error changed nothing, so retrying it just runs it again.
+    """
+    def __init__(self, app=None):
+        self._user_id = lambda: None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        app.config.setdefault('IDEMPOTENCY_ENABLED', True)
+        app.config.setdefault('IDEMPOTENCY_TTL', 86400) # seconds a key (and its response) is kept
+
+    def user_id_loader(self, f):
+        self._user_id = f
+        return f
+
+    def _claim(self, user_id: int, key: str, request_hash: str) -> IdempotencyKey | None:
+        """Claim the key for this request (returns None), or return the unexpired entry that already holds it"""
+        now = datetime.utcnow()
+        stmt = insert(IdempotencyKey).values(user_id=user_id, key=key, request_hash=request_hash, created_at=now,
+                                             expires_at=now + timedelta(seconds=current_app.config['IDEMPOTENCY_TTL']))
+        stmt = stmt.on_conflict_do_update(index_elements=['user_id', 'key'], where=IdempotencyKey.expires_at < now,
+                                          set_={'request_hash': stmt.excluded.request_hash, 'status_code': None,
+                                                'content_type': None, 'body': None, 'created_at': stmt.excluded.created_at,
+                                                'expires_at': stmt.excluded.expires_at}) # an expired key is reused
+        while True:
+            if db.session.execute(stmt.returning(IdempotencyKey.key)).first():
+                return None
+            entry = db.session.get(IdempotencyKey, (user_id, key), populate_existing=True)
+            if entry is not None: # else it was released in between; claim it again
+                return entry
+
+    def _store(self, user_id: int, key: str, response: Response) -> None:
+        """Keep the response, on a connection of its own: the route has committed, and the session may be past its deadline"""
+        db.session.rollback() # no-op if the route committed; if it didn't, there's no claim to fill in
+        now = datetime.utcnow()
+        expired = (select(IdempotencyKey.user_id, IdempotencyKey.key).where(IdempotencyKey.expires_at < now)
+                   .limit(PRUNE_BATCH).with_for_update(skip_locked=True))
+        with db.engine.begin() as conn:
+            conn.execute(update(IdempotencyKey).where(_entry_filter(user_id, key))
+                         .values(status_code=response.status_code, content_type=response.content_type,
+                                 body=response.get_data()))
+            conn.execute(delete(IdempotencyKey).where(tuple_(IdempotencyKey.user_id, IdempotencyKey.key).in_(expired)))
+
+    def _release(self, user_id: int, key: str) -> None:
+        """Let the key be used again, after the route failed"""
+        db.session.rollback() # drops the claim, unless the route got as far as committing it
+        with db.engine.begin() as conn:
+            conn.execute(delete(IdempotencyKey).where(_entry_filter(user_id, key)).where(IdempotencyKey.status_code.is_(None)))
+
+    def idempotent(self, f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            key = request.headers.get('Idempotency-Key')
+            user_id = self._user_id() if key is not None and current_app.config['IDEMPOTENCY_ENABLED'] else None
+            if user_id is None:
+                return f(*args, **kwargs)
+            if not key or len(key) > MAX_KEY_LENGTH:
+                raise UnprocessableEntity(f'Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters')
+            request_hash = _request_hash()
+            while (entry := self._claim(user_id, key, request_hash)) is not None:
+                if entry.request_hash != request_hash:
+                    raise UnprocessableEntity('This Idempotency-Key was already used for a different request')
+                if entry.status_code is not None:
+                    response = Response(entry.body, status=entry.status_code, content_type=entry.content_type)
+                    response.headers['Idempotent-Replayed'] = 'true'
+                    db.session.rollback() # let go of the row
+                    metrics.incr('idempotency.replayed')
+                    return response
+                # the first request has committed, but its response isn't stored yet
+                db.session.rollback()
+                if (deadline.remaining() or 0) < POLL_SECONDS:
+                    metrics.incr('idempotency.conflicts')
+                    raise Conflict('A request with this Idempotency-Key is still in progress, retry shortly')
+                time.sleep(POLL_SECONDS)
+            try:
+                response = make_response(f(*args, **kwargs))
+            except Exception:
+                self._release(user_id, key)
+                raise
+            if response.status_code < 400 and not response.is_streamed:
+                self._store(user_id, key, response)
+            else:
+                self._release(user_id, key)
+            return response
+        return decorated
@@ -0,0 +1,178 @@
+from model import (db, Recipe, Edit, Permission, RecipeIngredient)
+from permissions_helper import RECIPE_SORTS
+from sqlalchemy import select, insert, delete, desc, exists, or_, func
+from sqlalchemy.orm import aliased, lazyload, selectinload
+from fractions import Fraction
+import re
+
+UNITS = {
+    'cup': ('c', 'cup', 'cups'),
+    'tbsp': ('tbsp', 'tbs', 'tbl', 'tablespoon', 'tablespoons', 'T'),
+    'tsp': ('tsp', 'teaspoon', 'teaspoons', 't'),
+    'g': ('g', 'gram', 'grams', 'gr'),
+    'kg': ('kg', 'kilogram', 'kilograms'),
+    'mg': ('mg', 'milligram', 'milligrams'),
+    'ml': ('ml', 'milliliter', 'milliliters', 'millilitre', 'millilitres'),
+    'l': ('l', 'liter', 'liters', 'litre', 'litres'),
+    'oz': ('oz', 'ounce', 'ounces'),
+    'fl oz': ('fl oz', 'fluid ounce', 'fluid ounces'),
+    'lb': ('lb', 'lbs', 'pound', 'pounds'),
+    'pint': ('pt', 'pint', 'pints'),
+    'quart': ('qt', 'quart', 'quarts'),
+    'gallon': ('gal', 'gallon', 'gallons'),
+    'pinch': ('pinch', 'pinches'),
+    'dash': ('dash', 'dashes'),
+    'clove': ('clove', 'cloves'),
+    'can': ('can', 'cans'),
+    'package': ('package', 'packages', 'pkg'),
+    'stick': ('stick', 'sticks'),
+    'slice': ('slice', 'slices'),
+    'bunch': ('bunch', 'bunches'),
+    'sprig': ('sprig', 'sprigs'),
+    'handful': ('handful', 'handfuls'),
+}
+UNIT_ALIASES = {alias: unit for unit, aliases in UNITS.items() for alias in aliases}
+UNICODE_FRACTIONS = {'½': '1/2', '⅓': '1/3', '⅔': '2/3', '¼': '1/4', '¾': '3/4',
+                     '⅕': '1/5', '⅛': '1/8', '⅜': '3/8', '⅝': '5/8', '⅞': '7/8'}
+MAX_SEARCH_RESULTS = 50
+
+# "1", "1.5", "1/2", "1 1/2", optionally a range "2-3" (the lower bound is kept)
+QUANTITY_RE = re.compile(r'^(\d+\s+\d+/\d+|\d+/\d+|\d+(?:\.\d+)?)(?:\s*(?:-|to)\s*(?:\d+\s+\d+/\d+|\d+/\d+|\d+(?:\.\d+)?))?\s*')
+UNIT_RE = re.compile(r'^(' + '|'.join(sorted(map(re.escape, UNIT_ALIASES), key=len, reverse=True)) + r')\.?(?:\s+|$)', re.IGNORECASE)
+BULLET_RE = re.compile(r'^\s*(?:[-*•·]|\d+[.)](?=\s))\s*')
+
+def singularize(word: str) -> str:
+    """Good-enough English singular for ingredient names: 'berries' -> 'berry', 'tomatoes' -> 'tomato', 'eggs' -> 'egg'"""
+    if len(word) > 3 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 3 and (word.endswith('oes') or word.endswith(('ches', 'shes', 'sses', 'xes'))):
+        return word[:-2]
+    if len(word) > 2 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        return word[:-1]
+    return word
+
+def normalize_name(name: str) -> str:
+    """Lowercase, drop parentheticals and anything after a comma, and singularize: 'Large Eggs, beaten' -> 'large egg'"""
+    name = re.sub(r'\(.*?\)', ' ', name.lower()).split(',')[0]
+    name = re.sub(r'\b(to taste|as needed|for serving|optional)\b', ' ', name)
+    words = re.sub(r'[^a-z\s-]', ' ', name).split()
+    if words and words[0] == 'of':
+        words = words[1:]
+    return ' '.join(words[:-1] + [singularize(words[-1])]) if words else ''
+
+def parse_quantity(text: str) -> float | None:
+    """'1 1/2' -> 1.5; None for a number that isn't one, like '1/0'"""
+    try:
+        return float(sum(Fraction(part) for part in text.split()))
+    except (ZeroDivisionError, ValueError):
+        return None
+
+def parse_ingredient_line(line: str) -> dict | None:
+    """Parse one line of an ingredient list into {name, term, quantity, unit}, or None if it's blank.
+    quantity and unit are None when the line doesn't have them, e.g. 'salt to taste'; quantity is also None
+    when it can't be read, e.g. '1/0 cup flour'."""
+    for symbol, fraction in UNICODE_FRACTIONS.items():
+        line = line.replace(symbol, f' {fraction}')
+    line = BULLET_RE.sub('', line).strip()
+    quantity = unit = None
+    match = QUANTITY_RE.match(line)
+    if match: # an unparseable quantity is dropped, leaving the line's unit and name
+        quantity = parse_quantity(match.group(1))
+        line = line[match.end():]
+    match = UNIT_RE.match(line) if match else None
+    if match:
+        unit = UNIT_ALIASES.get(match.group(1)) or UNIT_ALIASES[match.group(1).lower()]
+        line = line[match.end():]
+    name = normalize_name(line)
+    if not name:
+        return None
+    return {'name': name, 'term': name.split()[-1], 'quantity': quantity, 'unit': unit}
+
+def parse_ingredients(text: str | None) -> list[dict]:
+    """Parse a newline-separated ingredient list"""
+    parsed = (parse_ingredient_line(line) for line in (text or '').splitlines())
+    return [ingredient for ingredient in parsed if ingredient]
+
+def from_structured(ingredients: list[dict] | None) -> list[dict]:
+    """Normalize already-structured ingredients ({name, quantity, unit} dicts) into the same shape as parse_ingredients()"""
+    parsed = []
+    for item in ingredients or []:
+        if not isinstance(item, dict):
+            continue
+        name = normalize_name(str(item.get('name') or ''))
+        if not name:
+            continue
+        unit = str(item.get('unit') or '').strip()
+        quantity = item.get('quantity')
+        parsed.append({'name': name, 'term': name.split()[-1],
+                       'quantity': quantity if isinstance(quantity, (int, float)) else None,
+                       'unit': UNIT_ALIASES.get(unit, UNIT_ALIASES.get(unit.lower(), unit)) if unit else None})
+    return parsed
+
+def from_spoonacular(extended_ingredients: list[dict] | None) -> list[dict]:
+    """Normalize Spoonacular's extendedIngredients into the same shape as parse_ingredients()"""
+    return from_structured([{'name': item.get('nameClean') or item.get('name'),
+                             'quantity': item.get('amount'),
+                             'unit': item.get('unit')} for item in extended_ingredients or []])
+
+def index_edit(edit: Edit, parsed: list[dict] | None = None) -> None:
+    """Make the given (current) edit's ingredients the recipe's entries in the ingredient index.
+    parsed can be passed in if the ingredients are already structured, e.g. from Spoonacular."""
+    if parsed is None:
+        parsed = parse_ingredients(edit.content_edit.ingredients)
+    db.session.execute(delete(RecipeIngredient).where(RecipeIngredient.recipe_id == edit.recipe_id))
+    if parsed:
+        db.session.execute(insert(RecipeIngredient),
+                           [dict(ingredient, recipe_id=edit.recipe_id, edit_id=edit.id, position=position)
+                            for position, ingredient in enumerate(parsed)])
+
+def _matches(term: str):
+    """Recipe ids whose current version has an ingredient matching the search term"""
+    term = normalize_name(term)
+    return select(RecipeIngredient.recipe_id).where(or_(RecipeIngredient.term == term, RecipeIngredient.name == term))
+
+def find_recipes(viewer_id: int | None, with_terms: list[str], without_terms: list[str], sort: str = 'recent') -> list[Recipe]:
+    """Return recipes the viewer can see whose current version uses all of with_terms and none of without_terms,
+    newest first (or by one of permissions_helper.RECIPE_SORTS). Answered from the ingredient index; with_terms must not be empty."""
+    # SELECT <Recipe> FROM recipes WHERE id IN <matches term 1> AND id IN <matches term 2> ...
+    #   AND id NOT IN <matches excluded term 1> ...
+    #   AND (is_public OR user_id = <viewer_id> OR EXISTS <permission for viewer>)
+    stmt = select(Recipe)
+    for term in with_terms:
+        stmt = stmt.where(Recipe.id.in_(_matches(term)))
+    for term in without_terms:
+        stmt = stmt.where(Recipe.id.not_in(_matches(term)))
+    has_permission = exists().where(Permission.recipe_id == Recipe.id).where(Permission.user_id == viewer_id)
+    stmt = stmt.where(or_(Recipe.is_public == True, Recipe.user_id == viewer_id, has_permission))
+    stmt = stmt.order_by(*RECIPE_SORTS[sort]).limit(MAX_SEARCH_RESULTS)
+    # what to_dict() reads, loaded for all the results at once rather than per owner or fork
+    stmt = stmt.options(selectinload(Recipe.edits).selectinload(Edit.source_edit), selectinload(Recipe.owner),
+                        selectinload(Recipe.parent).options(lazyload(Recipe.edits), selectinload(Recipe.owner)))
+    return db.session.scalars(stmt).all()
+
+def backfill_index(batch_size: int = 500) -> int:
+    """(Re)build the ingredient index for every recipe, batch_size recipes per transaction. Returns how many were indexed."""
+    source = aliased(Edit)
+    # current version of each recipe: SELECT DISTINCT ON (recipe_id) ... ORDER BY recipe_id, commit_date DESC
+    # un-materialized fork edits take their ingredients from their source edit
+    select_heads = (select(Edit.id, Edit.recipe_id, func.coalesce(source.ingredients, Edit.ingredients).label('ingredients'))
+                    .outerjoin(source, Edit.source_edit_id == source.id)
+                    .where(Edit.pending_approval.isnot(True))
+                    .distinct(Edit.recipe_id)
+                    .order_by(Edit.recipe_id, desc(Edit.commit_date)))
+    last_id = 0
+    indexed = 0
+    while True:
+        heads = db.session.execute(select_heads.where(Edit.recipe_id > last_id).limit(batch_size)).all()
+        if not heads:
+            return indexed
+        recipe_ids = [head.recipe_id for head in heads]
+        db.session.execute(delete(RecipeIngredient).where(RecipeIngredient.recipe_id.in_(recipe_ids)))
+        rows = [dict(ingredient, recipe_id=head.recipe_id, edit_id=head.id, position=position)
+                for head in heads
+                for position, ingredient in enumerate(parse_ingredients(head.ingredients))]
+        if rows:
+            db.session.execute(insert(RecipeIngredient), rows)
+        db.session.commit()
+        indexed += len(heads)
+        last_id = recipe_ids[-1]
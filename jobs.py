@@ -0,0 +1,42 @@
+"""Maintenance jobs for Forkd, meant to be run by hand or from cron:
+
+    python3 jobs.py <job name> <username:password@host:port/db_name>
+"""
+
+import sys
+
+import model
+from api_server import create_app
+import sync_helper
+import ingredients_helper
+import similarity_helper
+import rate_limit
+import response_cache
+import archive_helper
+import account_helper
+import idempotency
+
+JOBS = {
+    'prune-change-log': sync_helper.prune_change_log, # drop change log rows past their retention period
+    'prune-rate-limits': rate_limit.prune_buckets, # drop rate limit buckets nobody has used in a day
+    'prune-response-cache': response_cache.prune_cache, # drop expired cache entries (database cache backend only)
+    'prune-idempotency-keys': idempotency.prune_keys, # drop expired Idempotency-Key responses
+    'resume-account-deletions': account_helper.resume_deletions, # finish account deletions interrupted by a restart or error
+    'reconcile-counts': model.Recipe.reconcile_counts, # recount every recipe's edits, experiments, forks and collaborators
+    'archive-bodies': archive_helper.archive_old_bodies, # move bodies of old edits and experiments to cold storage
+    'backfill-ingredients': ingredients_helper.backfill_index, # (re)build the ingredient index from every recipe's current version
+    'backfill-similarity': similarity_helper.backfill_index, # (re)build the near-duplicate index from every recipe's current version
+}
+
+def run(job_name: str, db_uri: str):
+    """Run one of JOBS, in an app set up just like the server's -- so, for one, the cache entries a job invalidates
+    are the ones the server reads. Background tasks run inline, since the process exits once the job is done."""
+    app = create_app({'DB_URI': db_uri, 'TASKS_INLINE': True})
+    with app.app_context():
+        return JOBS[job_name]()
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] not in JOBS:
+        print(f'Usage: python3 jobs.py <{"|".join(JOBS)}> <db_uri>')
+        sys.exit(1)
+    print(f'{sys.argv[1]}: {run(sys.argv[1], sys.argv[2])}')
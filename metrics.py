@@ -0,0 +1,34 @@
+"""In-process counters and timings, exposed at /api/metrics. Each gunicorn worker keeps (and reports) its own."""
+
+from collections import Counter
+import threading
+
+_counters = Counter()
+_timings = {} # name -> [count, total seconds, max seconds]
+_lock = threading.Lock()
+
+def incr(name: str, by: int = 1) -> None:
+    with _lock:
+        _counters[name] += by
+
+def get(name: str) -> int:
+    return _counters[name]
+
+def observe(name: str, seconds: float) -> None:
+    """Record how long something took, e.g. a call to an upstream API"""
+    with _lock:
+        timing = _timings.setdefault(name, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+
+def snapshot() -> dict:
+    with _lock:
+        return {'counters': dict(_counters),
+                'timings': {name: {'count': count, 'mean_ms': round(total / count * 1000, 1), 'max_ms': round(longest * 1000, 1)}
+                            for name, (count, total, longest) in _timings.items()}}
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _timings.clear()
@@ -0,0 +1,2 @@
+-- Copy-on-write forks: a fork's first edit can point at the parent's edit instead of copying its content
+ALTER TABLE edits ADD COLUMN source_edit_id INTEGER REFERENCES edits(id);
@@ -0,0 +1,5 @@
+-- Denormalized per-recipe counts; fill them in afterwards with: python3 jobs.py reconcile-counts <db_uri>
+ALTER TABLE recipes ADD COLUMN edit_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE recipes ADD COLUMN experiment_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE recipes ADD COLUMN fork_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE recipes ADD COLUMN collaborator_count INTEGER NOT NULL DEFAULT 0;
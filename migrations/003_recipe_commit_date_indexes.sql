@@ -0,0 +1,3 @@
+-- A recipe's edits and experiments in commit order: timelines, head edits, and point-in-time checkouts
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_edits_recipe_id_commit_date ON edits (recipe_id, commit_date);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_experiments_recipe_id_commit_date ON experiments (recipe_id, commit_date);
@@ -0,0 +1,2 @@
+-- Queue of edits awaiting approval: a partial index, holding only the pending rows
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_edits_pending_recipe_id_commit_date ON edits (recipe_id, commit_date) WHERE pending_approval;
@@ -0,0 +1,4 @@
+-- Cold storage: old edit and experiment bodies can be moved to edit_archives / experiment_archives
+-- (those tables are created by model.py); these flags mark which rows have been
+ALTER TABLE edits ADD COLUMN is_archived BOOLEAN NOT NULL DEFAULT false;
+ALTER TABLE experiments ADD COLUMN is_archived BOOLEAN NOT NULL DEFAULT false;
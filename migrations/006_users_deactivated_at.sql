@@ -0,0 +1,8 @@
+-- Account deletion: users are deactivated at once, then removed by a background job
+-- (the account_deletions table that tracks it is created by model.py)
+ALTER TABLE users ADD COLUMN deactivated_at TIMESTAMP;
+
+-- Finding everything a user committed (account deletion, and cache invalidation when they rename)
+-- CONCURRENTLY can't run inside a transaction: run this file with plain psql, not psql -1
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_edits_commit_by ON edits (commit_by);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_experiments_commit_by ON experiments (commit_by);
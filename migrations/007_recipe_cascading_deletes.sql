@@ -0,0 +1,17 @@
+-- Deleting a recipe takes its edits, experiments and permissions with it, and leaves its forks without a parent,
+-- in the database rather than in the ORM. NOT VALID then VALIDATE: the re-check of existing rows doesn't block writes.
+BEGIN;
+ALTER TABLE edits DROP CONSTRAINT edits_recipe_id_fkey,
+    ADD CONSTRAINT edits_recipe_id_fkey FOREIGN KEY (recipe_id) REFERENCES recipes (id) ON DELETE CASCADE NOT VALID;
+ALTER TABLE experiments DROP CONSTRAINT experiments_recipe_id_fkey,
+    ADD CONSTRAINT experiments_recipe_id_fkey FOREIGN KEY (recipe_id) REFERENCES recipes (id) ON DELETE CASCADE NOT VALID;
+ALTER TABLE permissions DROP CONSTRAINT permissions_recipe_id_fkey,
+    ADD CONSTRAINT permissions_recipe_id_fkey FOREIGN KEY (recipe_id) REFERENCES recipes (id) ON DELETE CASCADE NOT VALID;
+ALTER TABLE recipes DROP CONSTRAINT recipes_forked_from_fkey,
+    ADD CONSTRAINT recipes_forked_from_fkey FOREIGN KEY (forked_from) REFERENCES recipes (id) ON DELETE SET NULL NOT VALID;
+COMMIT;
+
+ALTER TABLE edits VALIDATE CONSTRAINT edits_recipe_id_fkey;
+ALTER TABLE experiments VALIDATE CONSTRAINT experiments_recipe_id_fkey;
+ALTER TABLE permissions VALIDATE CONSTRAINT permissions_recipe_id_fkey;
+ALTER TABLE recipes VALIDATE CONSTRAINT recipes_forked_from_fkey;
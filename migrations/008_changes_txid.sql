@@ -0,0 +1,10 @@
+-- Sync tokens are points in commit order: each change log row records the transaction that wrote it, and a token is
+-- the oldest transaction still running when the client synced. Tokens handed out before this were change ids, which
+-- can't be told apart from transaction ids: clients holding one have to sync again without a token.
+ALTER TABLE changes ADD COLUMN txid BIGINT NOT NULL DEFAULT pg_current_xact_id()::text::bigint;
+
+-- CONCURRENTLY can't run inside a transaction: run this file with plain psql, not psql -1
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_changes_recipe_id_txid ON changes (recipe_id, txid);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_changes_user_id_txid ON changes (user_id, txid);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_changes_txid ON changes (txid);
+DROP INDEX CONCURRENTLY IF EXISTS ix_changes_user_id_id;
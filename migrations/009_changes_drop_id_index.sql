@@ -0,0 +1,2 @@
+-- Live event streams read the change log by transaction id too (see 008), so the (recipe_id, id) index is unused
+DROP INDEX CONCURRENTLY IF EXISTS ix_changes_recipe_id_id;
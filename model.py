@@ -1,7 +1,9 @@
 """Models for Forkd (recipe journaling app)"""
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import Mapped
+from sqlalchemy import event, insert, update, delete, select, func, or_
+from sqlalchemy.orm import Mapped, Session, aliased
+from sqlalchemy.dialects.postgresql import ARRAY
 from datetime import datetime, timedelta
 from passlib.hash import argon2
 import base64
@@ -31,6 +33,7 @@ class User(DictableColumn, db.Model):
     username = db.Column(db.String, unique = True)
     img_url = db.Column(db.String)
     is_temp_user = db.Column(db.Boolean)
+    deactivated_at = db.Column(db.DateTime) # set when they ask to delete their account; the row goes once that's done
     
     # for login
     token = db.Column(db.String(32), index=True, unique=True)
@@ -77,7 +80,7 @@ class User(DictableColumn, db.Model):
 
     # Instance Login methods
     def is_password_correct(self, given_password: str) -> bool:
-        return argon2.verify(given_password, self.password)
+        return self.deactivated_at is None and argon2.verify(given_password, self.password)
     
     def change_password(self, new_password: str) -> bool:
         new_password = argon2.hash(new_password)
@@ -98,7 +101,7 @@ class User(DictableColumn, db.Model):
     @staticmethod
     def check_token(token):
         user = User.query.filter_by(token=token).first()
-        if user is None:
+        if user is None or user.deactivated_at:
             return None
         elif user.token_expiration < datetime.utcnow():
             return 'expired'
@@ -112,6 +115,7 @@ class User(DictableColumn, db.Model):
         del dirty_dict['email']
         del dirty_dict['token']
         del dirty_dict['token_expiration']
+        dirty_dict.pop('deactivated_at', None)
 
         return dirty_dict
 
@@ -126,16 +130,29 @@ class Recipe(DictableColumn, db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     source_url = db.Column(db.String)
     last_modified = db.Column(db.DateTime)
-    forked_from = db.Column(db.Integer, db.ForeignKey('recipes.id'))
+    forked_from = db.Column(db.Integer, db.ForeignKey('recipes.id', ondelete='SET NULL')) # forks outlive their parent
     is_public = db.Column(db.Boolean) # default true
     is_experiments_public = db.Column(db.Boolean) # default true
+    # denormalized counts, kept up to date by the routes that add or remove what they count (see adjust_counts)
+    edit_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    experiment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    fork_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    collaborator_count = db.Column(db.Integer, nullable=False, default=0, server_default='0') # users it's shared with
 
     # Relationships
+    # passive_deletes: deleting a recipe leaves its history to the database's ON DELETE CASCADE, instead of
+    # loading every row into the session to delete it one by one
     owner = db.relationship('User', back_populates='recipes') # one corresponding User object
-    experiments = db.relationship('Experiment', back_populates='recipe', order_by='desc(Experiment.commit_date)', cascade='save-update, merge, delete') # list of corresponding Experiment objects
-    edits = db.relationship('Edit', back_populates='recipe', order_by='desc(Edit.commit_date)', cascade='save-update, merge, delete', lazy='selectin') # list of corresponding Edit objects
-    parent = db.relationship('Recipe', backref='children', remote_side=[id])
-    permissions = db.relationship('Permission', back_populates='recipe')
+    experiments = db.relationship('Experiment', back_populates='recipe', order_by='desc(Experiment.commit_date)', 
+                                  cascade='save-update, merge, delete', passive_deletes=True) # list of corresponding Experiment objects
+    edits = db.relationship('Edit', back_populates='recipe', order_by='desc(Edit.commit_date)', cascade='save-update, merge, delete', lazy='selectin',
+                            passive_deletes=True,
+                            primaryjoin='and_(Recipe.id == Edit.recipe_id, Edit.pending_approval.isnot(True))') # list of corresponding Edit objects, not counting ones pending approval
+    pending_edits = db.relationship('Edit', order_by='Edit.commit_date', cascade='save-update, merge, delete', overlaps='edits,recipe',
+                                    passive_deletes=True,
+                                    primaryjoin='and_(Recipe.id == Edit.recipe_id, Edit.pending_approval == True)') # proposed edits, oldest first
+    parent = db.relationship('Recipe', backref=db.backref('children', passive_deletes='all'), remote_side=[id]) # forked_from is SET NULL by the db
+    permissions = db.relationship('Permission', back_populates='recipe', cascade='save-update, merge, delete', passive_deletes=True)
 
     ### Methods
     def __repr__(self):
@@ -156,15 +173,74 @@ class Recipe(DictableColumn, db.Model):
     def get_by_id(cls, id: int) -> 'Recipe':
         return cls.query.get(id)
 
+    @classmethod
+    def adjust_counts(cls, recipe_id: int, edits: int = 0, experiments: int = 0, forks: int = 0, collaborators: int = 0) -> None:
+        """Add to a recipe's counts, e.g. adjust_counts(3, edits=1). Done as edit_count = edit_count + 1 in SQL, 
+        so concurrent requests can't overwrite each other's changes; loaded Recipe objects see it after the commit."""
+        deltas = {cls.edit_count: edits, cls.experiment_count: experiments, 
+                  cls.fork_count: forks, cls.collaborator_count: collaborators}
+        values = {column: column + delta for column, delta in deltas.items() if delta}
+        if values:
+            db.session.execute(update(cls).where(cls.id == recipe_id).values(values)
+                               .execution_options(synchronize_session=False))
+            log_changes([recipe_change_row(recipe_id)]) # not an ORM flush, so not logged automatically
+
+    @classmethod
+    def reconcile_counts(cls, batch_size: int = 1000) -> int:
+        """Recount every recipe's edits, experiments, forks and collaborators, batch_size recipes per transaction,
+        fixing any that have drifted. Returns how many recipes were fixed."""
+        fork = aliased(cls)
+        # UPDATE recipes SET edit_count = (SELECT count(*) FROM edits WHERE edits.recipe_id = recipes.id), ...
+        # WHERE id > <last id> AND id <= <last id + batch_size> AND (edit_count != <recount> OR ...)
+        recounts = {cls.edit_count: select(func.count()).where(Edit.recipe_id == cls.id)
+                                    .where(Edit.pending_approval.isnot(True)).scalar_subquery(),
+                    cls.experiment_count: select(func.count()).where(Experiment.recipe_id == cls.id).scalar_subquery(),
+                    cls.fork_count: select(func.count()).select_from(fork).where(fork.forked_from == cls.id).scalar_subquery(),
+                    cls.collaborator_count: select(func.count()).where(Permission.recipe_id == cls.id).scalar_subquery()}
+        drifted = or_(*(column != recount for column, recount in recounts.items()))
+        max_id = db.session.scalar(select(func.max(cls.id))) or 0
+        fixed = 0
+        for last_id in range(0, max_id, batch_size):
+            fixed_ids = db.session.scalars(update(cls).where(cls.id > last_id, cls.id <= last_id + batch_size).where(drifted)
+                                           .values(recounts).returning(cls.id)
+                                           .execution_options(synchronize_session=False)).all()
+            log_changes([recipe_change_row(recipe_id) for recipe_id in fixed_ids])
+            db.session.commit()
+            fixed += len(fixed_ids)
+        return fixed
+
+    @classmethod
+    def delete_with_history(cls, recipe_id: int) -> list:
+        """Delete a recipe in one statement: its edits, experiments, permissions, feed entries and index rows go with it
+        (ON DELETE CASCADE), and its forks are kept, after taking their own copy of any content they still share with it.
+        Returns (id, user_id) rows of those forks, which now have no parent."""
+        Edit.materialize_copies_of(select(Edit.id).where(Edit.recipe_id == recipe_id))
+        forks = db.session.execute(select(cls.id, cls.user_id).where(cls.forked_from == recipe_id)).all()
+        # the tombstone goes only to those who synced it: its owner and everyone it was shared with
+        audience = db.session.scalars(select(cls.user_id).where(cls.id == recipe_id)
+                                      .union(select(Permission.user_id).where(Permission.recipe_id == recipe_id))).all()
+        db.session.execute(delete(cls).where(cls.id == recipe_id)) # also marks the Recipe deleted, if it's loaded
+        log_changes([recipe_change_row(recipe_id, 'delete', user_id) for user_id in audience if user_id is not None]
+                    + [recipe_change_row(fork.id) for fork in forks])
+        return forks
+
     # instance methods
     def update_last_modified(self, modified_date: datetime) -> None:
         self.last_modified = modified_date
     
-    def to_dict(self):
+    def materialize_fork(self) -> None:
+        """If this is a fork whose creation edit still points at the parent's content, copy that content in"""
+        for edit in self.edits:
+            if edit.source_edit_id:
+                edit.materialize()
+
+    def to_dict(self, head: 'Edit' = None):
+        """head: the current edit, if already loaded separately -- saves loading every edit just to read the newest"""
         dirty_dict = super().to_dict()
-        dirty_dict['title'] = self.edits[0].title
-        dirty_dict['description'] = self.edits[0].description
-        dirty_dict['img_url'] = self.edits[0].img_url
+        head = (head or self.edits[0]).content_edit
+        dirty_dict['title'] = head.title
+        dirty_dict['description'] = head.description
+        dirty_dict['img_url'] = head.img_url
         dirty_dict['owner'] = self.owner.username
         dirty_dict['owner_avatar'] = self.owner.img_url
         if self.forked_from:
@@ -182,14 +258,15 @@ class Experiment(DictableColumn, db.Model):
     __tablename__ = 'experiments'
 
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
-    recipe_id = db.Column(db.Integer, db.ForeignKey('recipes.id'))
+    recipe_id = db.Column(db.Integer, db.ForeignKey('recipes.id', ondelete='CASCADE'))
     commit_msg = db.Column(db.String)
     notes = db.Column(db.Text)
     commit_date = db.Column(db.DateTime)
-    commit_by = db.Column(db.Integer, db.ForeignKey('users.id')) # to allow experiments submitted by collaborators
+    commit_by = db.Column(db.Integer, db.ForeignKey('users.id'), index=True) # to allow experiments submitted by collaborators
 
     ## planning an experiment - as yet unused
     create_date = db.Column(db.DateTime) # to allow planning experiments in advance
+    is_archived = db.Column(db.Boolean, nullable=False, default=False, server_default='false') # notes moved to experiment_archives
 
     # Relationships
     recipe = db.relationship('Recipe', back_populates='experiments') # one corresponsding Recipe object
@@ -197,6 +274,9 @@ class Experiment(DictableColumn, db.Model):
 
     # misc class variable
     htmlclass = 'experiment'
+    archived_fields = ('notes',) # big, and rarely read once old
+
+    __table_args__ = (db.Index('ix_experiments_recipe_id_commit_date', 'recipe_id', 'commit_date'),)
 
     ### Methods
     def __repr__(self):
@@ -205,6 +285,9 @@ class Experiment(DictableColumn, db.Model):
     def to_dict(self):
         dicted = super().to_dict()
         dicted['item_type'] = 'experiment'
+        if self.is_archived: # stub: the client fetches the body if it's expanded
+            for field in self.archived_fields:
+                dicted.pop(field, None)
         if self.committer: 
             dicted['commit_by'] = self.committer.username
             dicted['commit_by_avatar'] = self.committer.img_url
@@ -231,32 +314,60 @@ class Edit(DictableColumn, db.Model):
     __tablename__ = 'edits'
 
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
-    recipe_id = db.Column(db.Integer, db.ForeignKey('recipes.id'))
+    recipe_id = db.Column(db.Integer, db.ForeignKey('recipes.id', ondelete='CASCADE'))
     title = db.Column(db.String)
     description = db.Column(db.String)
     ingredients = db.Column(db.Text)
     instructions = db.Column(db.Text)
     commit_date = db.Column(db.DateTime)
     img_url = db.Column(db.String)
-    commit_by = db.Column(db.Integer, db.ForeignKey('users.id')) # to allow edits submitted by collaborators
+    commit_by = db.Column(db.Integer, db.ForeignKey('users.id'), index=True) # to allow edits submitted by collaborators
+    source_edit_id = db.Column(db.Integer, db.ForeignKey('edits.id')) # copy-on-write forks: content lives in this edit until materialized
     pending_approval = db.Column(db.Boolean) # for users with no edit access, to be approved
+    is_archived = db.Column(db.Boolean, nullable=False, default=False, server_default='false') # body moved to edit_archives
     # on submission: pending_approval -> true
     # if approved: pending_approval -> null, treated as normal edit
 
     # Relationships
     recipe = db.relationship('Recipe', back_populates='edits') # one corresponding Recipe object
     committer = db.relationship('User', back_populates='committed_edits',lazy="selectin")
+    source_edit = db.relationship('Edit', remote_side=[id]) # one Edit object, only for un-materialized fork edits
 
     # misc class variable
     htmlclass = 'edit'
+    content_fields = ('title', 'description', 'ingredients', 'instructions', 'img_url')
+    archived_fields = ('ingredients', 'instructions') # big, and rarely read once old
+
+    __table_args__ = (
+        # a recipe's versions in order: the timeline, the head edit, and point-in-time checkouts
+        db.Index('ix_edits_recipe_id_commit_date', 'recipe_id', 'commit_date'),
+        # the queue of proposed edits; only pending rows are indexed, so it stays tiny
+        db.Index('ix_edits_pending_recipe_id_commit_date', 'recipe_id', 'commit_date', postgresql_where=db.text('pending_approval')),
+    )
 
     ### Methods
     def __repr__(self):
         return f'<Edit id={self.id} commit_date={self.commit_date}>'
     
+    @property
+    def content_edit(self) -> 'Edit':
+        """The edit that actually holds this edit's content: itself, or the parent's edit for an un-materialized fork"""
+        return self.source_edit if self.source_edit_id else self
+
+    def materialize(self) -> None:
+        """Copy content in from the source edit, so this edit no longer depends on it"""
+        for field in self.content_fields:
+            setattr(self, field, getattr(self.source_edit, field))
+        self.source_edit = None
+
     def to_dict(self):
         dicted = super().to_dict()
         dicted['item_type'] = 'edit'
+        if self.source_edit_id:
+            dicted.update({field: getattr(self.source_edit, field) for field in self.content_fields})
+        if self.is_archived: # stub: the client fetches the body if it's expanded
+            for field in self.archived_fields:
+                dicted.pop(field, None)
         if self.committer:
             dicted['commit_by'] = self.committer.username
             dicted['commit_by_avatar'] = self.committer.img_url
@@ -267,14 +378,37 @@ class Edit(DictableColumn, db.Model):
     def create(cls, recipe: Recipe, title: str, desc: str, ingredients: str, 
                instructions: str, img_url: str, commit_date: datetime|None, 
                committer: User|None=None, pending_approval: bool = False) -> 'Edit':
+        if pending_approval: # by id, so it isn't added to the recipe's (current) edits in the session
+            return cls(recipe_id=recipe.id, title=title, description=desc,
+                       ingredients=ingredients, instructions=instructions,
+                       img_url=img_url, pending_approval=True,
+                       commit_date=commit_date, committer=committer)
         return cls(recipe=recipe, title=title, description=desc,
                    ingredients=ingredients, instructions=instructions,
                    img_url=img_url, pending_approval=pending_approval,
                    commit_date=commit_date, committer=committer)
     
+    @classmethod
+    def create_fork_stub(cls, recipe: Recipe, source: 'Edit', commit_date: datetime, committer: User) -> 'Edit':
+        """Create a fork's first edit, which refers to the source edit's content instead of copying it"""
+        return cls(recipe=recipe, source_edit=source.content_edit,
+                   commit_date=commit_date, committer=committer)
+    
     @classmethod
     def get_by_id(cls, id: int) -> 'Edit':
         return cls.query.get(id)
+
+    @classmethod
+    def materialize_copies_of(cls, edit_ids) -> None:
+        """Materialize every fork edit that points at one of the given edits (a list of ids, or a select of them), e.g. before they're deleted"""
+        source = aliased(cls)
+        # UPDATE edits SET title = source.title, ..., source_edit_id = NULL 
+        # FROM edits AS source WHERE edits.source_edit_id = source.id AND source.id IN <edit_ids>
+        stmt = (update(cls).where(cls.source_edit_id == source.id).where(source.id.in_(edit_ids))
+                .values({**{getattr(cls, field): getattr(source, field) for field in cls.content_fields},
+                         cls.source_edit_id: None})
+                .execution_options(synchronize_session=False))
+        db.session.execute(stmt)
     
 
 # Permissions
@@ -285,7 +419,7 @@ class Permission(db.Model):
     __tablename__ = 'permissions'
     
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
-    recipe_id = db.Column(db.Integer, db.ForeignKey('recipes.id'), primary_key=True)
+    recipe_id = db.Column(db.Integer, db.ForeignKey('recipes.id', ondelete='CASCADE'), primary_key=True)
     can_experiment = db.Column(db.Boolean)
     can_edit = db.Column(db.Boolean)
 
@@ -303,6 +437,257 @@ class Permission(db.Model):
     def create(cls, user_id, recipe_id, can_experiment=True, can_edit=True):
         return cls(user_id=user_id,recipe_id=recipe_id, can_experiment=can_experiment, can_edit=can_edit)
 
+# Cold storage for old edit and experiment bodies
+class EditArchive(db.Model):
+    """The archived_fields of an old edit, zlib-compressed JSON, moved out of the edits table"""
+
+    ### SQL-side setup
+    __tablename__ = 'edit_archives'
+
+    edit_id = db.Column(db.Integer, db.ForeignKey('edits.id', ondelete='CASCADE'), primary_key=True)
+    payload = db.Column(db.LargeBinary)
+    archived_at = db.Column(db.DateTime)
+
+class ExperimentArchive(db.Model):
+    """The archived_fields of an old experiment, zlib-compressed JSON, moved out of the experiments table"""
+
+    ### SQL-side setup
+    __tablename__ = 'experiment_archives'
+
+    experiment_id = db.Column(db.Integer, db.ForeignKey('experiments.id', ondelete='CASCADE'), primary_key=True)
+    payload = db.Column(db.LargeBinary)
+    archived_at = db.Column(db.DateTime)
+
+# Ingredient index
+class RecipeIngredient(db.Model):
+    """One parsed ingredient line of a recipe's current version. Rebuilt whenever the current version changes.
+
+    Indexed by name and term, so it doubles as an inverted index of ingredient -> recipes.
+    """
+
+    ### SQL-side setup
+    __tablename__ = 'recipe_ingredients'
+
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    recipe_id = db.Column(db.Integer, db.ForeignKey('recipes.id', ondelete='CASCADE'), nullable=False, index=True)
+    edit_id = db.Column(db.Integer, db.ForeignKey('edits.id', ondelete='CASCADE')) # edit it was parsed from
+    position = db.Column(db.Integer) # line number within the ingredient list
+    name = db.Column(db.String, index=True) # normalized, e.g. 'large egg'
+    term = db.Column(db.String, index=True) # last word of name, e.g. 'egg', so searching 'eggs' finds 'large eggs'
+    quantity = db.Column(db.Float)
+    unit = db.Column(db.String) # canonical unit, e.g. 'tbsp'
+
+    ### Methods
+    def __repr__(self):
+        return f'<RecipeIngredient recipe_id={self.recipe_id} name={self.name}>'
+
+# Near-duplicate index
+class RecipeSignature(db.Model):
+    """MinHash signature of a recipe's current version (ingredients and instructions). Rebuilt whenever the current
+    version changes; see similarity_helper."""
+
+    ### SQL-side setup
+    __tablename__ = 'recipe_signatures'
+
+    recipe_id = db.Column(db.Integer, db.ForeignKey('recipes.id', ondelete='CASCADE'), primary_key=True)
+    edit_id = db.Column(db.Integer, db.ForeignKey('edits.id', ondelete='CASCADE')) # edit it was computed from
+    minhashes = db.Column(ARRAY(db.BigInteger), nullable=False)
+
+class RecipeBucket(db.Model):
+    """One LSH band of a recipe's signature: recipes sharing a bucket are candidate near-duplicates"""
+
+    ### SQL-side setup
+    __tablename__ = 'recipe_buckets'
+
+    bucket = db.Column(db.BigInteger, primary_key=True) # hash of the band number and the band's minhashes
+    recipe_id = db.Column(db.Integer, db.ForeignKey('recipes.id', ondelete='CASCADE'), primary_key=True, index=True)
+
+# Activity feed
+class FeedItem(db.Model):
+    """An entry in a user's activity feed, fanned out to collaborators when an edit or experiment is committed"""
+
+    ### SQL-side setup
+    __tablename__ = 'feed_items'
+
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False) # whose feed this entry is in
+    recipe_id = db.Column(db.Integer, db.ForeignKey('recipes.id', ondelete='CASCADE'), nullable=False)
+    item_type = db.Column(db.String) # 'edit' or 'experiment'
+    item_id = db.Column(db.Integer)
+    actor_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE')) # who committed the item
+    summary = db.Column(db.String) # edit title or experiment commit_msg, copied so reads don't need to join
+    created_at = db.Column(db.DateTime)
+
+    # feed reads are always "this user's newest entries before <cursor>"
+    __table_args__ = (db.Index('ix_feed_items_user_id_id', 'user_id', 'id'),)
+
+    ### Methods
+    def __repr__(self):
+        return f'<FeedItem id={self.id} user_id={self.user_id} item_type={self.item_type}>'
+
+# Change log, for incremental sync
+class Change(db.Model):
+    """A row in the change log: a recipe, edit, experiment or permission was created, modified or deleted.
+
+    Rows are never updated, and have no foreign keys so they outlive what they describe (tombstones).
+    """
+
+    ### SQL-side setup
+    __tablename__ = 'changes'
+
+    id = db.Column(db.BigInteger, autoincrement=True, primary_key=True)
+    recipe_id = db.Column(db.Integer) # recipe the changed row belongs to
+    user_id = db.Column(db.Integer) # for permissions: whose permission it is; for recipe deletions: who the tombstone is for
+    entity_type = db.Column(db.String) # 'recipe', 'edit', 'experiment' or 'permission'
+    entity_id = db.Column(db.Integer) # for permissions, same as user_id
+    op = db.Column(db.String) # 'upsert' or 'delete'
+    changed_at = db.Column(db.DateTime)
+    # id of the transaction that logged it, set by the db: the sync token is a point in commit order, not in id order
+    txid = db.Column(db.BigInteger, nullable=False, server_default=db.text('pg_current_xact_id()::text::bigint'))
+
+    __table_args__ = (db.Index('ix_changes_recipe_id_txid', 'recipe_id', 'txid'),
+                      db.Index('ix_changes_user_id_txid', 'user_id', 'txid'),
+                      db.Index('ix_changes_txid', 'txid'))
+
+    ### Methods
+    def __repr__(self):
+        return f'<Change id={self.id} {self.op} {self.entity_type}={self.entity_id}>'
+
+SYNCED_TYPES = {Recipe: 'recipe', Edit: 'edit', Experiment: 'experiment', Permission: 'permission'}
+
+def change_row(obj, op: str) -> dict:
+    """Describe a change to a Recipe, Edit, Experiment or Permission as a row for the change log"""
+    entity_type = SYNCED_TYPES[type(obj)]
+    row = {'entity_type': entity_type, 'op': op, 'user_id': None, 'changed_at': datetime.utcnow()}
+    if entity_type == 'recipe':
+        row.update(recipe_id=obj.id, entity_id=obj.id)
+    elif entity_type == 'permission':
+        row.update(recipe_id=obj.recipe_id, entity_id=obj.user_id, user_id=obj.user_id)
+    else:
+        row.update(recipe_id=obj.recipe_id, entity_id=obj.id)
+    return row
+
+def recipe_change_row(recipe_id: int, op: str = 'upsert', user_id: int = None) -> dict:
+    """Same as change_row(), for a recipe changed by a Core statement rather than through a loaded object.
+    A deletion is logged once per user who synced the recipe (user_id), since once it's gone there's no telling who did."""
+    return {'entity_type': 'recipe', 'op': op, 'recipe_id': recipe_id, 'entity_id': recipe_id,
+            'user_id': user_id, 'changed_at': datetime.utcnow()}
+
+def item_change_row(entity_type: str, recipe_id: int, entity_id: int, op: str = 'upsert') -> dict:
+    """Same as change_row(), for an edit or experiment changed by a Core statement"""
+    return {'entity_type': entity_type, 'op': op, 'recipe_id': recipe_id, 'entity_id': entity_id,
+            'user_id': None, 'changed_at': datetime.utcnow()}
+
+def permission_change_row(recipe_id: int, user_id: int, op: str) -> dict:
+    """Same as change_row(), for a permission changed by a Core statement"""
+    return {'entity_type': 'permission', 'op': op, 'recipe_id': recipe_id, 'entity_id': user_id,
+            'user_id': user_id, 'changed_at': datetime.utcnow()}
+
+def log_changes(rows: list[dict], session=None) -> None:
+    """Append rows to the change log. Writes that go through the ORM are logged automatically; 
+    bulk Core statements (which skip ORM events) should call this themselves."""
+    if rows:
+        session = session or db.session
+        session.connection().execute(insert(Change), rows)
+        # streams watching these recipes are woken once this commits (see pubsub)
+        session.info.setdefault('changed_recipe_ids', set()).update(row['recipe_id'] for row in rows)
+
+def _is_synced(obj) -> bool:
+    # edits pending approval aren't part of the recipe yet; they're logged once approved
+    return type(obj) in SYNCED_TYPES and not (type(obj) is Edit and obj.pending_approval)
+
+@event.listens_for(Session, 'after_flush')
+def _log_flushed_changes(session, flush_context):
+    rows = [change_row(obj, 'upsert') for obj in session.new if _is_synced(obj)]
+    rows += [change_row(obj, 'upsert') for obj in session.dirty 
+             if _is_synced(obj) and session.is_modified(obj, include_collections=False)]
+    rows += [change_row(obj, 'delete') for obj in session.deleted if _is_synced(obj)]
+    log_changes(rows, session)
+
+# Rate limiting
+class RateLimitBucket(db.Model):
+    """State of one token bucket (e.g. logins from one IP), shared by every worker"""
+
+    ### SQL-side setup
+    __tablename__ = 'rate_limit_buckets'
+
+    key = db.Column(db.String, primary_key=True) # '<route>:<ip|user>:<who>'
+    tokens = db.Column(db.Float)
+    allowed = db.Column(db.Boolean) # whether the last request was let through
+    updated_at = db.Column(db.DateTime(timezone=True))
+
+# Response cache (shared backend)
+class ResponseCacheEntry(db.Model):
+    """A cached response body, shared by every worker. Dropped when anything it's tagged with changes."""
+
+    ### SQL-side setup
+    __tablename__ = 'response_cache_entries'
+
+    key = db.Column(db.String, primary_key=True) # '<endpoint>:<object>:<viewer class>'
+    body = db.Column(db.LargeBinary)
+    tags = db.Column(ARRAY(db.String)) # e.g. ['recipe:3'] -- what the body was built from
+    expires_at = db.Column(db.DateTime)
+
+    __table_args__ = (db.Index('ix_response_cache_entries_tags', 'tags', postgresql_using='gin'),)
+
+class ResponseCacheInvalidation(db.Model):
+    """When each tag was last invalidated, so a response built from data read before then isn't cached after it"""
+
+    ### SQL-side setup
+    __tablename__ = 'response_cache_invalidations'
+
+    tag = db.Column(db.String, primary_key=True)
+    invalidated_at = db.Column(db.DateTime)
+
+# Account deletion
+class AccountDeletion(db.Model):
+    """A request to delete a user's account, worked through in batches in the background (see account_helper)"""
+
+    ### SQL-side setup
+    __tablename__ = 'account_deletions'
+
+    id = db.Column(db.String(32), primary_key=True) # random; knowing it is what lets you poll the status
+    user_id = db.Column(db.Integer, index=True) # no foreign key: this outlives the user
+    status = db.Column(db.String) # 'pending', 'running', 'done' or 'failed' (retried by the resume job)
+    requested_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # progress
+    recipes_total = db.Column(db.Integer, nullable=False, default=0)
+    recipes_transferred = db.Column(db.Integer, nullable=False, default=0)
+    recipes_deleted = db.Column(db.Integer, nullable=False, default=0)
+    contributions_total = db.Column(db.Integer) # edits and experiments on others' recipes; counted once the recipes are done
+    contributions_done = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String)
+
+    ### Methods
+    def __repr__(self):
+        return f'<AccountDeletion id={self.id} user_id={self.user_id} status={self.status}>'
+
+    def to_dict(self):
+        return {'id': self.id, 'status': self.status, 'requested_at': self.requested_at,
+                'updated_at': self.updated_at, 'finished_at': self.finished_at, 'error': self.error,
+                'recipes': {'total': self.recipes_total, 'transferred': self.recipes_transferred,
+                            'deleted': self.recipes_deleted},
+                'contributions': {'total': self.contributions_total, 'done': self.contributions_done}}
+
+# Idempotency keys
+class IdempotencyKey(db.Model):
+    """A POST sent with an Idempotency-Key header, and the response it got, so a retry gets that response back
+    instead of doing it again (see idempotency.py)"""
+
+    ### SQL-side setup
+    __tablename__ = 'idempotency_keys'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True) # keys are per user
+    key = db.Column(db.String(255), primary_key=True)
+    request_hash = db.Column(db.String(64), nullable=False) # of method, path and body: a key can't be reused for another request
+    status_code = db.Column(db.Integer) # null while the first request is still running
+    content_type = db.Column(db.String)
+    body = db.Column(db.LargeBinary)
+    created_at = db.Column(db.DateTime)
+    expires_at = db.Column(db.DateTime, index=True)
+
 # CONNECTING TO DB
 def connect_to_db(flask_app, db_uri="/test", echo=True):
     flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{db_uri}'
@@ -316,12 +701,10 @@ def connect_to_db(flask_app, db_uri="/test", echo=True):
     print(f"Connected to the db!")
 
 if __name__ == '__main__':
-    from api_server import app
+    from api_server import create_app
     import sys
 
+    app = create_app({'DB_URI': sys.argv[1] if sys.argv[1:2] else '/test'})
     with app.app_context():
         if sys.argv[1:2]:
-            connect_to_db(app, sys.argv[1])
-            db.create_all()
-        else:
-            connect_to_db(app)
\ No newline at end of file
+            db.create_all()
\ No newline at end of file
@@ -1,31 +1,34 @@
-from model import (db, connect_to_db, User, 
+from model import (db, User, 
                    Recipe, Edit, Experiment, Permission)
-from sqlalchemy import select, union, desc
+from sqlalchemy import select, delete, desc, exists, false, or_, tuple_, literal_column
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import lazyload, selectinload
+from datetime import datetime
+import dto_helper
 
-def get_shared_with_me(me_id: int) -> list('Recipe'):
-    """
-    Given a user's id, return recipes that have been shared with them. 
-    
-    Essentially, all recipes that are associated with that user in the Permissions table.
-    """
-   
-    # SELECT <Recipe> FROM recipes JOIN permissions WHERE permissions.user_id == <me_id>
-    select_shared_with_me = select(Recipe).join(Recipe.permissions).where(Permission.user_id==me_id)
-    return db.session.scalars(select_shared_with_me).all()
-
-def get_viewable_recipes(owner_id: int, viewer_id: int | None) -> list[Recipe]:
-    """Given an owner and a viewer, returns a list of Recipe objects owned by the owner that the viewer has permission to view"""
-
-    # SELECT <Recipe> FROM recipes WHERE user_id = <owner_id> AND is_public = True
-    select_owners_public_recipes = select(Recipe).where(Recipe.user_id == owner_id).where(Recipe.is_public == True)
-    # UNION
-    # SELECT <Recipe> FROM recipes AS r JOIN permissions AS p
-    # WHERE p.user_id = <viewer_id> AND r.user_id = <owner_id>
-    # ORDER BY Recipe.last_modified 
-    select_shared_with_viewer = select(Recipe).join(Recipe.permissions).where(Permission.user_id==viewer_id).where(Recipe.user_id==owner_id)
-    union_query = union(select_owners_public_recipes, select_shared_with_viewer).order_by(desc(Recipe.last_modified))
-    union_query = select(Recipe).from_statement(union_query)
-    return db.session.scalars(union_query).all()
+# ?sort= values for recipe lists -> ORDER BY; all read columns on recipes, so no counting at query time
+RECIPE_SORTS = {
+    'recent': (desc(Recipe.last_modified),),
+    'edits': (desc(Recipe.edit_count), desc(Recipe.last_modified)),
+    'experiments': (desc(Recipe.experiment_count), desc(Recipe.last_modified)),
+    'forks': (desc(Recipe.fork_count), desc(Recipe.last_modified)),
+    'collaborators': (desc(Recipe.collaborator_count), desc(Recipe.last_modified)),
+}
+
+def select_own_cards(owner_id: int, sort: str = 'recent'):
+    """Statement for all of a user's recipes, newest first (or by one of RECIPE_SORTS), as dto_helper.RecipeCards"""
+    return dto_helper.select_recipe_cards(Recipe.user_id == owner_id, order_by=RECIPE_SORTS[sort])
+
+def select_viewable_cards(owner_id: int, viewer_id: int | None, sort: str = 'recent'):
+    """Statement for the owner's recipes that the viewer has permission to view, as dto_helper.RecipeCards"""
+    # ... WHERE recipes.user_id = <owner_id> AND (recipes.is_public OR EXISTS (<permission for viewer_id>))
+    return dto_helper.select_recipe_cards(Recipe.user_id == owner_id,
+                                          or_(Recipe.is_public == True, Recipe.permissions.any(Permission.user_id == viewer_id)),
+                                          order_by=RECIPE_SORTS[sort])
+
+def select_shared_cards(me_id: int, sort: str = 'recent'):
+    """Statement for the recipes that have been shared with a user (have a Permission for them), as dto_helper.RecipeCards"""
+    return dto_helper.select_recipe_cards(Recipe.permissions.any(Permission.user_id == me_id), order_by=RECIPE_SORTS[sort])
 
 def get_recipe_shared_with(recipe: Recipe) -> list[tuple]:
     """Given a Recipe, returns a list of tuples: (username, can_edit, can_experiment)"""
@@ -34,30 +37,177 @@ def get_recipe_shared_with(recipe: Recipe) -> list[tuple]:
 
 def can_user_view(user: User, recipe: Recipe) -> bool:
     """Returns whether the User can view the given Recipe"""
-    if recipe.is_public:
+    if recipe.is_public or recipe.user_id == user.id:
         return True
     select_permission = select(Permission).where(Permission.user_id==user.id).where(Permission.recipe_id==recipe.id)
     return bool(db.session.execute(select_permission).one_or_none())
 
-def get_timeline(viewer_id: int | None, recipe_id: int): # -> list('Edit'|'Experiment'):
+def get_recipes_with_access(user_id: int, recipe_ids: list[int]) -> dict[int, tuple]:
+    """Given a user and a list of recipe ids, load the recipes and the user's access to each in one query.
+
+    Returns {recipe_id: (Recipe, can_experiment: bool, can_edit: bool)}; ids that don't exist are left out.
+    """
+    # SELECT <Recipe>, permissions.can_experiment, permissions.can_edit FROM recipes 
+    # LEFT JOIN permissions ON permissions.recipe_id = recipes.id AND permissions.user_id = <user_id>
+    # WHERE recipes.id IN <recipe_ids>
+    stmt = (select(Recipe, Permission.can_experiment, Permission.can_edit)
+            .outerjoin(Permission, (Permission.recipe_id == Recipe.id) & (Permission.user_id == user_id))
+            .where(Recipe.id.in_(recipe_ids)))
+    access = {}
+    for recipe, can_experiment, can_edit in db.session.execute(stmt):
+        is_owner = recipe.user_id == user_id
+        access[recipe.id] = (recipe, is_owner or bool(can_experiment), is_owner or bool(can_edit))
+    return access
+
+def get_recipes_for_viewer(viewer_id: int | None, recipe_ids: list[int], options: list = ()) -> dict[int, tuple]:
+    """Given a viewer (None if anonymous) and a list of recipe ids, load the recipes and whether the viewer can see each
+    in one query, plus one each for their owners, parents and parents' owners -- however many ids there are.
+    Their edits aren't loaded; pair with get_head_edits() for to_dict(). options: more loader options for the recipes
+
+    Returns {recipe_id: (Recipe, can_view: bool)}; ids that don't exist are left out.
+    """
+    # SELECT <Recipe>, EXISTS (SELECT 1 FROM permissions WHERE recipe_id = recipes.id AND user_id = <viewer_id>)
+    # FROM recipes WHERE recipes.id IN <recipe_ids>
+    is_shared = (exists().where(Permission.recipe_id == Recipe.id).where(Permission.user_id == viewer_id)
+                 if viewer_id is not None else false())
+    stmt = (select(Recipe, is_shared).where(Recipe.id.in_(recipe_ids))
+            .options(lazyload(Recipe.edits), selectinload(Recipe.owner),
+                     selectinload(Recipe.parent).options(lazyload(Recipe.edits), selectinload(Recipe.owner)), *options))
+    return {recipe.id: (recipe, recipe.is_public or recipe.user_id == viewer_id or shared)
+            for recipe, shared in db.session.execute(stmt)}
+
+def find_users(usernames: set[str], user_ids: set[int]) -> list[tuple]:
+    """(id, username) of every user named by username or id, in one query; ones that don't exist (or are being deleted) are left out"""
+    return db.session.execute(select(User.id, User.username).where(User.deactivated_at.is_(None))
+                              .where(or_(User.username.in_(usernames), User.id.in_(user_ids)))).all()
+
+def upsert_permissions(rows: list[dict]) -> dict[tuple, bool]:
+    """Grant or update many permissions ({user_id, recipe_id, can_experiment, can_edit} dicts, at most one per pair)
+    in one statement. Returns {(user_id, recipe_id): True if the permission was created, False if it was updated}."""
+    if not rows:
+        return {}
+    # INSERT INTO permissions ... ON CONFLICT (user_id, recipe_id) DO UPDATE SET can_experiment = excluded.can_experiment, ...
+    # RETURNING user_id, recipe_id, xmax = 0  -- xmax is only 0 on a freshly inserted row
+    table = Permission.__table__ # a Core insert: the ORM one can't return xmax
+    stmt = insert(table).values(rows)
+    stmt = (stmt.on_conflict_do_update(index_elements=['user_id', 'recipe_id'],
+                                       set_={'can_experiment': stmt.excluded.can_experiment, 'can_edit': stmt.excluded.can_edit})
+            .returning(table.c.user_id, table.c.recipe_id, literal_column('xmax = 0')))
+    return {(user_id, recipe_id): created for user_id, recipe_id, created in db.session.execute(stmt)}
+
+def delete_permissions(pairs: list[tuple]) -> set[tuple]:
+    """Revoke many (user_id, recipe_id) permissions in one statement. Returns the pairs that existed."""
+    if not pairs:
+        return set()
+    stmt = (delete(Permission).where(tuple_(Permission.user_id, Permission.recipe_id).in_(pairs))
+            .returning(Permission.user_id, Permission.recipe_id)
+            .execution_options(synchronize_session=False))
+    return {tuple(row) for row in db.session.execute(stmt)}
+
+def get_viewer_class(viewer_id: int | None, recipe: Recipe) -> str:
+    """Which version of the recipe's timeline the viewer is shown: 'owner', 'shared:<x if can_experiment><e if can_edit>'
+    for anyone it's been shared with, or 'public' for everyone else (including anonymous viewers)"""
+    if recipe.user_id == viewer_id:
+        return 'owner'
+    permission = Permission.get_by_user_and_recipe(viewer_id, recipe.id) if viewer_id is not None else None
+    if permission is None:
+        return 'public'
+    return f"shared:{'x' if permission.can_experiment else ''}{'e' if permission.can_edit else ''}"
+
+def has_access_to_any_of(viewer_id: int | None, owner_id: int) -> bool:
+    """Whether any of the owner's recipes have been shared with the viewer, i.e. whether the viewer sees more of
+    the owner's profile than the public does"""
+    if viewer_id is None:
+        return False
+    # SELECT 1 FROM permissions JOIN recipes WHERE permissions.user_id = <viewer_id> AND recipes.user_id = <owner_id> LIMIT 1
+    select_shared = (select(Permission.recipe_id).join(Permission.recipe)
+                     .where(Permission.user_id == viewer_id).where(Recipe.user_id == owner_id).limit(1))
+    return db.session.execute(select_shared).first() is not None
+
+def get_recipe_without_history(recipe_id: int) -> Recipe | None:
+    """Given a recipe id, return the Recipe without loading its edits -- pair with get_head_edit() for to_dict()"""
+    return db.session.get(Recipe, recipe_id, options=[lazyload(Recipe.edits)])
+
+def get_head_edit(recipe_id: int, options: list = ()) -> Edit | None:
+    """Given a recipe id, return its current (newest) edit, without loading the rest. options: loader options for the edit"""
+    return db.session.scalars(select(Edit).where(Edit.recipe_id == recipe_id).where(Edit.pending_approval.isnot(True))
+                              .order_by(desc(Edit.commit_date)).limit(1).options(*options)).first()
+
+def get_head_edits(recipe_ids: list[int], options: list = ()) -> dict[int, Edit]:
+    """Given a list of recipe ids, return {recipe_id: current (newest) edit} in one query, plus one for the content of
+    any un-materialized fork edits among them. options: more loader options for the edits"""
+    # SELECT DISTINCT ON (recipe_id) <Edit> FROM edits WHERE recipe_id IN <recipe_ids> AND pending_approval IS NOT true
+    # ORDER BY recipe_id, commit_date DESC
+    stmt = (select(Edit).where(Edit.recipe_id.in_(recipe_ids)).where(Edit.pending_approval.isnot(True))
+            .distinct(Edit.recipe_id).order_by(Edit.recipe_id, desc(Edit.commit_date))
+            .options(selectinload(Edit.source_edit), *options))
+    return {edit.recipe_id: edit for edit in db.session.scalars(stmt)}
+
+def get_version(recipe_id: int, edit_id: int | None = None, at: datetime | None = None) -> tuple:
+    """Given a recipe id and either one of its edit ids or a point in time, return the edit that was current then,
+    and when the edit after it was made (None if it's still current). (None, None) if there's no such version.
+
+    Every edit holds the whole recipe (or points at the parent edit that does, for an un-materialized fork),
+    so there's nothing to replay: each is a single lookup on the (recipe_id, commit_date) index.
+    """
+    if edit_id is not None:
+        version = db.session.get(Edit, edit_id)
+        if version is None or version.recipe_id != recipe_id or version.pending_approval:
+            return (None, None)
+    else:
+        # SELECT <Edit> FROM edits WHERE recipe_id = <recipe_id> AND commit_date <= <at> ORDER BY commit_date DESC LIMIT 1
+        version = db.session.scalars(select(Edit).where(Edit.recipe_id == recipe_id).where(Edit.commit_date <= at)
+                                     .where(Edit.pending_approval.isnot(True))
+                                     .order_by(desc(Edit.commit_date)).limit(1)).first()
+        if version is None:
+            return (None, None)
+    # SELECT commit_date FROM edits WHERE recipe_id = <recipe_id> AND commit_date > <version's> ORDER BY commit_date LIMIT 1
+    next_commit_date = db.session.scalar(select(Edit.commit_date).where(Edit.recipe_id == recipe_id)
+                                         .where(Edit.commit_date > version.commit_date).where(Edit.pending_approval.isnot(True))
+                                         .order_by(Edit.commit_date).limit(1))
+    return (version, next_commit_date)
+
+def select_pending_edits(recipe_id: int):
+    """Statement for a recipe's edits awaiting approval, oldest first -- read from the partial index of pending edits"""
+    # SELECT <Edit> FROM edits WHERE recipe_id = <recipe_id> AND pending_approval ORDER BY commit_date
+    return (select(Edit).where(Edit.recipe_id == recipe_id).where(Edit.pending_approval == True)
+            .order_by(Edit.commit_date))
+
+def can_user_review(user: User, recipe: Recipe) -> bool:
+    """Whether the user can approve or reject proposed edits to the recipe: its owner, or anyone with edit access"""
+    if recipe.user_id == user.id:
+        return True
+    permission = Permission.get_by_user_and_recipe(user.id, recipe.id)
+    return bool(permission and permission.can_edit)
+
+def select_experiments_between(recipe_id: int, start: datetime, end: datetime | None):
+    """Statement for a recipe's experiments logged from start up to (not including) end, newest first"""
+    stmt = select(Experiment).where(Experiment.recipe_id == recipe_id).where(Experiment.commit_date >= start)
+    if end is not None:
+        stmt = stmt.where(Experiment.commit_date < end)
+    return stmt.order_by(desc(Experiment.commit_date))
+
+def get_timeline(viewer_id: int | None, recipe_id: int, fields: frozenset | None = None): # -> list('Edit'|'Experiment'):
     """Given a user's id and a recipe id, return a list of timeline items (experiments and edits) in descending chrono order that the user is allowed to view
+    fields: only load and include these (see response_helper.requested_fields()); None for everything
     
     Returns a tuple:
-        (dict ->    {edits: list,
-                    experiments: list -- will not be included if no permission to view experiments},
+        (dict ->    {edits: generator of dicts,
+                    experiments: generator of dicts -- will not be included if no permission to view experiments},
         bool -> whether viewer has experiment permissions on the recipe,
         bool -> whether viewer has edit permissions on the recipe ) 
     """
     
-    this_recipe = Recipe.get_by_id(recipe_id)
+    this_recipe = get_recipe_without_history(recipe_id)
     if not this_recipe:
         return None
     timeline_items = None
     can_experiment = False
     can_edit = False
     this_permission = None
-    edits = [edit.to_dict() for edit in this_recipe.edits]
-    exps = [exp.to_dict() for exp in this_recipe.experiments]
+    # generators: the rows are only read (in batches) when the response body is written
+    edits = dto_helper.iter_rows(dto_helper.select_edit_rows(recipe_id, fields), dto_helper.EditRow, fields)
+    exps = dto_helper.iter_rows(dto_helper.select_experiment_rows(recipe_id, fields), dto_helper.ExperimentRow, fields)
     if this_recipe.user_id == viewer_id:
         can_experiment = True
         can_edit = True
@@ -69,12 +219,20 @@ def get_timeline(viewer_id: int | None, recipe_id: int): # -> list('Edit'|'Exper
             can_experiment = this_permission.can_experiment
             can_edit = this_permission.can_edit
     
-    if this_recipe.is_public:
-        timeline_items = {'edits':edits}
-    
-    if this_recipe.is_experiments_public or this_permission is not None:
-        timeline_items = {'edits':edits, 'experiments':exps}
+    visible = visible_item_types(this_recipe, False, this_permission)
+    if visible:
+        timeline_items = {'edits':edits, 'experiments':exps} if 'experiment' in visible else {'edits':edits}
     return (timeline_items, can_experiment, can_edit)
+
+def visible_item_types(recipe: Recipe, is_owner: bool, permission: Permission | None) -> tuple:
+    """Which of a recipe's timeline items a viewer sees: ('edit', 'experiment'), ('edit',), or () if none.
+    The owner and anyone it's shared with see everything; the public sees edits if the recipe is public,
+    and experiments too if they're public."""
+    if is_owner or permission is not None or recipe.is_experiments_public:
+        return ('edit', 'experiment')
+    if recipe.is_public:
+        return ('edit',)
+    return ()
     
 
 ## Given a user('s id) and a recipe id, return whether they can submit an experiment (bool)
@@ -94,6 +252,10 @@ def get_timeline(viewer_id: int | None, recipe_id: int): # -> list('Edit'|'Exper
 ## Given a recipe, get the edit that it was forked from
 
 if __name__== '__main__':
-    from api_server import app
-    connect_to_db(app, 'forkd-p')
+    # python3 -i permissions_helper.py [db_uri], to try these out against a db; db_uri defaults to $DEV_URI
+    from api_server import create_app
+    import os
+    import sys
+
+    app = create_app({'DB_URI': sys.argv[1] if sys.argv[1:2] else os.environ['DEV_URI']})
     app.app_context().push()
\ No newline at end of file
@@ -0,0 +1,185 @@
+"""Pub/sub for live updates: wakes the open event streams of a recipe when something in it changes, in every worker"""
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+import logging
+import select
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class Subscription:
+    """One open stream's interest in a recipe. wait() returns once something's been published for it (or on timeout)."""
+    def __init__(self, recipe_id: int):
+        self.recipe_id = recipe_id
+        self._event = threading.Event()
+
+    def notify(self) -> None:
+        self._event.set()
+
+    def wait(self, timeout: float) -> bool:
+        """Returns whether it was woken, rather than timing out"""
+        woken = self._event.wait(timeout)
+        self._event.clear()
+        return woken
+
+class LocalBroker:
+    """The subscriptions open in this process, by recipe"""
+    def __init__(self):
+        self._subscriptions = {} # recipe_id -> set of Subscriptions
+        self._lock = threading.Lock()
+
+    def add(self, subscription: Subscription) -> None:
+        with self._lock:
+            self._subscriptions.setdefault(subscription.recipe_id, set()).add(subscription)
+
+    def remove(self, subscription: Subscription) -> None:
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.recipe_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.recipe_id, None)
+
+    def deliver(self, recipe_ids) -> None:
+        """Wake the subscriptions for these recipes; None wakes every one (e.g. after notifications may have been missed)"""
+        with self._lock:
+            if recipe_ids is None:
+                woken = [sub for subscriptions in self._subscriptions.values() for sub in subscriptions]
+            else:
+                woken = [sub for recipe_id in recipe_ids for sub in self._subscriptions.get(recipe_id, ())]
+        for subscription in woken:
+            subscription.notify()
+
+    def count(self) -> int:
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+class MemoryBackend:
+    """Published ids go straight to this process's subscribers. For tests and single-process dev servers."""
+    def __init__(self, broker: LocalBroker, engine):
+        self.broker = broker
+
+    def start(self) -> None:
+        pass
+
+    def publish(self, recipe_ids: set[int]) -> None:
+        self.broker.deliver(recipe_ids)
+
+class PostgresBackend:
+    """Published ids go out with NOTIFY, so every worker (on every host) sharing the db hears them. Each process has one
+    connection LISTENing, on a daemon thread, which wakes that process's subscribers -- not one connection per stream."""
+    CHANNEL = 'recipe_changes'
+    MAX_PAYLOAD = 7000 # bytes; NOTIFY payloads have to be under 8000
+    RECONNECT_SECONDS = 2
+
+    def __init__(self, broker: LocalBroker, engine):
+        self.broker = broker
+        self.engine = engine
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen, name='forkd-listen', daemon=True)
+                self._thread.start()
+
+    def publish(self, recipe_ids: set[int]) -> None:
+        payloads, payload = [], ''
+        for recipe_id in sorted(recipe_ids):
+            if len(payload) + len(str(recipe_id)) + 1 > self.MAX_PAYLOAD:
+                payloads.append(payload)
+                payload = ''
+            payload += f'{"," if payload else ""}{recipe_id}'
+        payloads.append(payload)
+        with self.engine.begin() as conn: # its own connection: the request's transaction is already committed
+            for payload in payloads:
+                conn.execute(text('SELECT pg_notify(:channel, :payload)'), {'channel': self.CHANNEL, 'payload': payload})
+
+    def _listen(self) -> None:
+        while True:
+            conn = None
+            try:
+                raw = self.engine.raw_connection()
+                conn = raw.driver_connection
+                raw.detach() # held for good, so it shouldn't count against (or go back to) the pool
+                conn.autocommit = True
+                conn.cursor().execute(f'LISTEN {self.CHANNEL}')
+                self.broker.deliver(None) # anything published while we weren't listening
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    recipe_ids = set()
+                    while conn.notifies:
+                        recipe_ids.update(int(recipe_id) for recipe_id in conn.notifies.pop(0).payload.split(',') if recipe_id)
+                    self.broker.deliver(recipe_ids)
+            except Exception:
+                logger.exception('Lost the %s listener connection, reconnecting', self.CHANNEL)
+                if conn is not None and not conn.closed:
+                    conn.close()
+                time.sleep(self.RECONNECT_SECONDS)
+
+BACKENDS = {'memory': MemoryBackend, 'postgres': PostgresBackend}
+
+class PubSub:
+    """Flask extension. Streams subscribe() to a recipe; commits that log changes to recipes (see model.log_changes)
+    publish those recipes' ids once they've committed."""
+    def __init__(self, app=None):
+        self._backend = None
+        self.broker = LocalBroker()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        app.config.setdefault('PUBSUB_BACKEND', 'postgres') # or 'memory', for tests / a single process
+
+    @property
+    def backend(self):
+        name = current_app.config['PUBSUB_BACKEND']
+        if not isinstance(self._backend, BACKENDS[name]):
+            from model import db
+            self._backend = BACKENDS[name](self.broker, db.engine)
+        return self._backend
+
+    def reset(self) -> None:
+        """Forget the backend and subscribers, e.g. in a forked child (where the listener thread doesn't exist)"""
+        self._backend = None
+        self.broker = LocalBroker()
+
+    def subscribe(self, recipe_id: int) -> Subscription:
+        self.backend.start()
+        subscription = Subscription(recipe_id)
+        self.broker.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self.broker.remove(subscription)
+
+    def publish(self, recipe_ids: set[int]) -> None:
+        if recipe_ids:
+            self.backend.publish(set(recipe_ids))
+            metrics.incr('pubsub.published', len(recipe_ids))
+
+    def subscriber_count(self) -> int:
+        """Streams open in this process"""
+        return self.broker.count()
+
+hub = PubSub()
+
+@event.listens_for(Session, 'after_commit')
+def _publish_after_commit(session):
+    recipe_ids = session.info.pop('changed_recipe_ids', None)
+    if recipe_ids and has_app_context() and current_app.config.get('PUBSUB_BACKEND'):
+        try:
+            hub.publish(recipe_ids)
+        except Exception: # the write already went through; streams still catch up on their next keepalive
+            current_app.logger.exception('Publishing changes to recipes %s failed', sorted(recipe_ids))
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_unpublished(session):
+    session.info.pop('changed_recipe_ids', None)
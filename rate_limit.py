@@ -0,0 +1,118 @@
+"""Token-bucket rate limiting for expensive endpoints, per IP and per user, with pluggable shared state"""
+
+from flask import current_app, request
+from werkzeug.exceptions import TooManyRequests
+from sqlalchemy import text, delete
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+import hashlib
+import math
+import threading
+import time
+
+from model import db, RateLimitBucket
+
+# route name -> {'ip' / 'user': (capacity, seconds to refill it completely)}; override with app.config['RATELIMIT_BUDGETS']
+DEFAULT_BUDGETS = {
+    'login': {'ip': (20, 60), 'user': (10, 60)}, # Argon2 verify
+    'signup': {'ip': (10, 600)}, # Argon2 hash plus two uniqueness queries
+    'extract': {'ip': (30, 3600), 'user': (20, 3600)}, # paid Spoonacular call
+}
+
+class MemoryBackend:
+    """Buckets in a dict. Per process, so only for tests and single-worker dev servers."""
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, capacity: int, rate: float) -> float:
+        """Take a token from the bucket. Returns 0 if there was one, else seconds until there will be."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+        return 0 if allowed else (1 - tokens) / rate
+
+class DatabaseBackend:
+    """Buckets in the rate_limit_buckets table, shared by every gunicorn worker. One statement per check,
+    on its own short transaction so it never holds up (or gets rolled back with) the request's session."""
+    _refilled = 'LEAST(:capacity, b.tokens + EXTRACT(EPOCH FROM now() - b.updated_at) * :rate)'
+    _take = text(f'''
+        INSERT INTO rate_limit_buckets AS b (key, tokens, allowed, updated_at)
+        VALUES (:key, :capacity - 1, true, now())
+        ON CONFLICT (key) DO UPDATE SET
+            tokens = CASE WHEN {_refilled} >= 1 THEN {_refilled} - 1 ELSE {_refilled} END,
+            allowed = {_refilled} >= 1,
+            updated_at = now()
+        RETURNING tokens, allowed''')
+
+    def take(self, key: str, capacity: int, rate: float) -> float:
+        with db.engine.begin() as conn:
+            tokens, allowed = conn.execute(self._take, {'key': key, 'capacity': capacity, 'rate': rate}).one()
+        return 0 if allowed else (1 - tokens) / rate
+
+BACKENDS = {'memory': MemoryBackend, 'database': DatabaseBackend}
+
+def prune_buckets(idle_hours: int = 24) -> int:
+    """Delete buckets that haven't been touched in a while (they'd be full again anyway)"""
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=idle_hours)
+    result = db.session.execute(delete(RateLimitBucket).where(RateLimitBucket.updated_at < cutoff))
+    db.session.commit()
+    return result.rowcount
+
+def _user_key() -> str | None:
+    """Who's asking, without a db lookup: the login name for Basic auth, a hash of the token for Bearer auth"""
+    auth = request.authorization
+    if auth is None:
+        return None
+    if auth.type == 'basic':
+        return auth.username.lower() if auth.username else None
+    return hashlib.sha256(auth.token.encode()).hexdigest()[:32] if auth.token else None
+
+class RateLimiter:
+    """Flask extension; decorate expensive routes with @limiter.limit('<route name>').
+    Undecorated routes never touch the limiter."""
+    def __init__(self, app=None):
+        self._backend = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        app.config.setdefault('RATELIMIT_ENABLED', True)
+        app.config.setdefault('RATELIMIT_BACKEND', 'database') # 'memory' for tests / single process
+        app.config.setdefault('RATELIMIT_BUDGETS', {})
+
+    @property
+    def backend(self):
+        name = current_app.config['RATELIMIT_BACKEND']
+        if not isinstance(self._backend, BACKENDS[name]):
+            self._backend = BACKENDS[name]()
+        return self._backend
+
+    def reset(self) -> None:
+        """Forget all in-memory buckets"""
+        self._backend = None
+
+    def check(self, route_name: str) -> None:
+        """Take a token from each of the route's buckets, or abort with 429 and Retry-After"""
+        budgets = current_app.config['RATELIMIT_BUDGETS'].get(route_name) or DEFAULT_BUDGETS[route_name]
+        identities = {'ip': request.remote_addr, 'user': _user_key()} # the client's address, behind PROXY_HOPS proxies
+        wait = 0
+        for scope, (capacity, period) in budgets.items():
+            if identities.get(scope) is None:
+                continue
+            wait = max(wait, self.backend.take(f'{route_name}:{scope}:{identities[scope]}', capacity, capacity / period))
+        if wait:
+            raise TooManyRequests('Rate limit exceeded, try again later', retry_after=math.ceil(wait))
+
+    def limit(self, route_name: str):
+        def decorator(f):
+            @wraps(f)
+            def decorated(*args, **kwargs):
+                if current_app.config['RATELIMIT_ENABLED']:
+                    self.check(route_name)
+                return f(*args, **kwargs)
+            return decorated
+        return decorator
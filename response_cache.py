@@ -0,0 +1,196 @@
+"""Read-through cache for public-facing recipe and profile responses, invalidated by tag from the write paths"""
+
+from flask import Response, current_app, stream_with_context
+from sqlalchemy import select, union, delete, text, bindparam
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.types import String
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import threading
+
+from model import (db, Recipe, Edit, Experiment, ResponseCacheEntry, ResponseCacheInvalidation)
+import metrics
+
+class LRUBackend:
+    """Per-process cache, least recently used entries evicted first. Writes only invalidate the worker that made them,
+    so only for tests and single-worker dev servers."""
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # key -> (body, tags, expires_at)
+        self._invalidated_at = {} # tag -> when
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] < datetime.utcnow():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: str, body: bytes, tags: list[str], ttl: int, started_at: datetime) -> None:
+        with self._lock:
+            if any(self._invalidated_at.get(tag, datetime.min) >= started_at for tag in tags):
+                return # something it was built from changed while it was being built
+            self._entries[key] = (body, tags, datetime.utcnow() + timedelta(seconds=ttl))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, tags: set[str]) -> None:
+        now = datetime.utcnow()
+        with self._lock:
+            for tag in tags:
+                self._invalidated_at[tag] = now
+            for key in [key for key, (_, entry_tags, _) in self._entries.items() if tags.intersection(entry_tags)]:
+                del self._entries[key]
+
+class DatabaseBackend:
+    """Cache shared by every worker, in the response_cache_entries table. A hit is one primary key lookup,
+    instead of rebuilding the timeline or profile. Runs on its own connection, apart from the request's session."""
+    _set = text('''
+        INSERT INTO response_cache_entries (key, body, tags, expires_at)
+        SELECT :key, :body, :tags, :expires_at
+        WHERE NOT EXISTS (SELECT 1 FROM response_cache_invalidations
+                          WHERE tag = ANY(:tags) AND invalidated_at >= :started_at)
+        ON CONFLICT (key) DO UPDATE SET body = excluded.body, tags = excluded.tags, expires_at = excluded.expires_at
+        ''').bindparams(bindparam('tags', type_=ARRAY(String)))
+
+    def get(self, key: str) -> bytes | None:
+        with db.engine.connect() as conn:
+            return conn.scalar(select(ResponseCacheEntry.body).where(ResponseCacheEntry.key == key)
+                               .where(ResponseCacheEntry.expires_at > datetime.utcnow()))
+
+    def put(self, key: str, body: bytes, tags: list[str], ttl: int, started_at: datetime) -> None:
+        with db.engine.begin() as conn:
+            conn.execute(self._set, {'key': key, 'body': body, 'tags': tags, 'started_at': started_at,
+                                     'expires_at': datetime.utcnow() + timedelta(seconds=ttl)})
+
+    def invalidate(self, tags: set[str]) -> None:
+        now = datetime.utcnow()
+        with db.engine.begin() as conn:
+            conn.execute(insert(ResponseCacheInvalidation).values([{'tag': tag, 'invalidated_at': now} for tag in tags])
+                         .on_conflict_do_update(index_elements=['tag'], set_={'invalidated_at': now}))
+            conn.execute(delete(ResponseCacheEntry).where(ResponseCacheEntry.tags.overlap(sorted(tags))))
+
+def prune_cache(older_than_hours: int = 24) -> int:
+    """Drop expired entries, and invalidation records too old to matter to any response still being built"""
+    now = datetime.utcnow()
+    removed = db.session.execute(delete(ResponseCacheEntry).where(ResponseCacheEntry.expires_at < now)).rowcount
+    removed += db.session.execute(delete(ResponseCacheInvalidation)
+                                  .where(ResponseCacheInvalidation.invalidated_at < now - timedelta(hours=older_than_hours))).rowcount
+    db.session.commit()
+    return removed
+
+class ResponseCache:
+    """Flask extension. Views look up cache.get(endpoint, obj, viewer_class) before doing any work,
+    and pass what they built through cache.store(...) on a miss."""
+    def __init__(self, app=None):
+        self._backend = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        app.config.setdefault('RESPONSE_CACHE_ENABLED', True)
+        app.config.setdefault('RESPONSE_CACHE_BACKEND', 'database') # shared by all workers; 'lru' for tests / single process
+        app.config.setdefault('RESPONSE_CACHE_MAX_ENTRIES', 2048) # lru only
+        app.config.setdefault('RESPONSE_CACHE_TTL', 3600) # seconds; a safety net, invalidation is what keeps it fresh
+
+    @property
+    def backend(self):
+        name = current_app.config['RESPONSE_CACHE_BACKEND']
+        if name == 'lru' and not isinstance(self._backend, LRUBackend):
+            self._backend = LRUBackend(current_app.config['RESPONSE_CACHE_MAX_ENTRIES'])
+        elif name == 'database' and not isinstance(self._backend, DatabaseBackend):
+            self._backend = DatabaseBackend()
+        return self._backend
+
+    def reset(self) -> None:
+        """Forget everything held in-process"""
+        self._backend = None
+
+    def get(self, endpoint: str, obj, viewer_class: str) -> Response | None:
+        if not current_app.config['RESPONSE_CACHE_ENABLED']:
+            return None
+        body = self.backend.get(f'{endpoint}:{obj}:{viewer_class}')
+        metrics.incr(f'cache.{endpoint}.{"hit" if body is not None else "miss"}')
+        if body is None:
+            return None
+        return Response(body, status=200, mimetype='application/json')
+
+    def store(self, response: Response, endpoint: str, obj, viewer_class: str, tags: list[str]) -> Response:
+        """Cache a 200 response's body as it's written out; returns the response to send"""
+        if not current_app.config['RESPONSE_CACHE_ENABLED'] or response.status_code != 200:
+            return response
+        key = f'{endpoint}:{obj}:{viewer_class}'
+        started_at = datetime.utcnow()
+        ttl = current_app.config['RESPONSE_CACHE_TTL']
+        if not response.is_streamed:
+            self.backend.put(key, response.get_data(), tags, ttl, started_at)
+            return response
+
+        def tee(chunks):
+            body = []
+            for chunk in chunks:
+                body.append(chunk.encode() if isinstance(chunk, str) else chunk)
+                yield chunk
+            self.backend.put(key, b''.join(body), tags, ttl, started_at) # only once the whole body was built
+        response.response = stream_with_context(tee(response.response))
+        return response
+
+    def invalidate_after_commit(self, tags: set[str]) -> None:
+        """Invalidate tags once the current transaction commits (before then, a reader would just re-cache the old data)"""
+        db.session.info.setdefault('invalidate_tags', set()).update(tags)
+
+    def invalidate(self, tags: set[str]) -> None:
+        if tags:
+            self.backend.invalidate(set(tags))
+
+    def stats(self) -> dict:
+        """Hits, misses and hit ratio per endpoint since this worker started"""
+        counters = metrics.snapshot()['counters']
+        endpoints = {name.split('.')[1] for name in counters if name.startswith('cache.')}
+        stats = {}
+        for endpoint in endpoints:
+            hits, misses = counters.get(f'cache.{endpoint}.hit', 0), counters.get(f'cache.{endpoint}.miss', 0)
+            stats[endpoint] = {'hits': hits, 'misses': misses, 'hit_ratio': round(hits / (hits + misses), 4)}
+        return stats
+
+cache = ResponseCache()
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    tags = session.info.pop('invalidate_tags', None)
+    if tags:
+        try:
+            cache.invalidate(tags)
+        except Exception: # the write already went through; worst case, entries live out their TTL
+            current_app.logger.exception('Response cache invalidation failed for %s', sorted(tags))
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_invalidations(session):
+    session.info.pop('invalidate_tags', None)
+
+#################### Tags ####################
+# 'recipe:<id>': a recipe's timeline. 'profile:<user id>': the recipe list on a user's profile.
+def recipe_tags(recipe: Recipe) -> set[str]:
+    """Everything cached that shows this recipe's content or place in its owner's list"""
+    return {f'recipe:{recipe.id}', f'profile:{recipe.user_id}'}
+
+def user_tags(user_id: int) -> set[str]:
+    """Everything cached that shows this user's username or avatar: their profile, the timelines of their recipes
+    and of recipes they've committed to, and the cards of forks of their recipes (and the profiles those are on)"""
+    select_own = select(Recipe.id).where(Recipe.user_id == user_id)
+    select_forks = select(Recipe.id, Recipe.user_id).where(Recipe.forked_from.in_(select_own))
+    select_committed_to = union(select(Edit.recipe_id).where(Edit.commit_by == user_id),
+                               select(Experiment.recipe_id).where(Experiment.commit_by == user_id))
+    tags = {f'profile:{user_id}'}
+    tags.update(f'recipe:{recipe_id}' for recipe_id in db.session.scalars(union(select_own, select_committed_to)))
+    for recipe_id, owner_id in db.session.execute(select_forks):
+        tags.update({f'recipe:{recipe_id}', f'profile:{owner_id}'})
+    return tags
@@ -0,0 +1,183 @@
+"""Helpers for large responses: JSON streamed as rows come off the DB cursor, sparse fieldsets, and negotiated compression"""
+
+from flask import Response, current_app, request, stream_with_context
+from sqlalchemy.orm import load_only, selectinload
+from types import GeneratorType
+import zlib
+
+try:
+    import brotli # optional; without it only gzip is offered
+except ImportError:
+    brotli = None
+
+from model import Recipe, Edit, Experiment
+
+STREAM_CHUNK_SIZE = 16 * 1024 # bytes of JSON buffered before each write to the client
+YIELD_PER = 100 # rows fetched from the DB cursor (and held as ORM objects) at a time
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/plain', 'text/html', 'text/event-stream'}
+
+#################### Streaming JSON ####################
+def _is_lazy(value) -> bool:
+    if isinstance(value, GeneratorType):
+        return True
+    if isinstance(value, dict):
+        return any(_is_lazy(val) for val in value.values())
+    if isinstance(value, (list, tuple)):
+        return any(_is_lazy(val) for val in value)
+    return False
+
+def iter_json(value):
+    """Serialize value to JSON text piece by piece, the same way jsonify() would.
+    Generators (at any depth) become JSON arrays, consumed one item at a time."""
+    dumps = current_app.json.dumps
+    if not _is_lazy(value):
+        yield dumps(value)
+    elif isinstance(value, dict):
+        keys = sorted(value) if current_app.json.sort_keys else list(value)
+        yield '{'
+        for i, key in enumerate(keys):
+            yield (',' if i else '') + dumps(str(key)) + ':'
+            yield from iter_json(value[key])
+        yield '}'
+    else:
+        yield '['
+        for i, item in enumerate(value):
+            if i:
+                yield ','
+            yield from iter_json(item)
+        yield ']'
+
+def _buffered(pieces, size: int = STREAM_CHUNK_SIZE):
+    buffer, buffered = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield ''.join(buffer)
+            buffer, buffered = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+def stream_json(value, status: int = 200) -> Response:
+    """Return value as a streamed JSON response; generators inside it are only run as the body is written"""
+    return Response(stream_with_context(_buffered(iter_json(value))), status=status, mimetype='application/json')
+
+#################### Sparse fieldsets ####################
+# ?fields=a,b,c keeps just those keys in each recipe card and timeline item; ?view=summary keeps the ones list views show.
+# Columns nobody asked for aren't SELECTed (load_only), so edits' ingredients and instructions never leave the db.
+KEPT_FIELDS = frozenset({'id', 'item_type'}) # in every fieldset
+SUMMARY_FIELDS = KEPT_FIELDS | {'recipe_id', 'user_id', 'title', 'img_url', 'owner', 'owner_avatar', 'forked_from',
+                                'is_public', 'is_experiments_public', 'last_modified', 'edit_count', 'experiment_count',
+                                'fork_count', 'collaborator_count', 'commit_by', 'commit_by_avatar', 'commit_date', 'commit_msg'}
+DERIVED_FIELDS = {Recipe: {'title', 'description', 'img_url', 'owner', 'owner_avatar', 'forked_from_username', 'forked_from_avatar'},
+                  Edit: {'commit_by_avatar'},
+                  Experiment: {'commit_by_avatar'}} # filled in by to_dict(), not columns
+READ_BY_TO_DICT = {Recipe: ('id', 'user_id', 'forked_from'), # columns to_dict() itself reads, so they're always loaded
+                   Edit: ('id', 'recipe_id', 'source_edit_id', 'is_archived', 'commit_by'),
+                   Experiment: ('id', 'recipe_id', 'is_archived', 'commit_by')}
+# the head edit a recipe card takes its title, description and picture from
+CARD_EDIT_COLUMNS = (Edit.id, Edit.recipe_id, Edit.source_edit_id, Edit.title, Edit.description, Edit.img_url)
+ALL_FIELDS = KEPT_FIELDS.union(*(model_class.__table__.columns.keys() for model_class in DERIVED_FIELDS), *DERIVED_FIELDS.values())
+
+def requested_fields(args) -> frozenset | None:
+    """The fieldset asked for in the query string: fields=<comma-separated keys> or view=<full (default) | summary>.
+    None means every field. Raises ValueError, with a message for the client, if it's not understood."""
+    if 'fields' in args:
+        fields = frozenset(field.strip() for arg in args.getlist('fields') for field in arg.split(',') if field.strip())
+        unknown = fields - ALL_FIELDS
+        if unknown:
+            raise ValueError(f'Unknown fields: {", ".join(sorted(unknown))}')
+        return fields | KEPT_FIELDS
+    view = args.get('view', 'full')
+    if view not in ('full', 'summary'):
+        raise ValueError('view must be one of full, summary')
+    return SUMMARY_FIELDS if view == 'summary' else None
+
+def fieldset_key(fields: frozenset | None) -> str:
+    """Fieldset as a cache key suffix; '' for every field, so full responses keep their keys"""
+    return '' if fields is None else f'&fields={",".join(sorted(fields))}'
+
+def load_fields(model_class, fields: frozenset | None, card_edits: bool = True) -> list:
+    """Loader options for a select of Recipes, Edits or Experiments that only load the columns their to_dict()
+    needs for the fieldset. For recipes that includes their edits, which are loaded for the card's head edit --
+    card_edits=False if the head edits are loaded separately instead (with load_card_fields())."""
+    if fields is None:
+        return []
+    keys = [key for key in model_class.__table__.columns.keys() if key in fields or key in READ_BY_TO_DICT[model_class]]
+    options = [load_only(*(getattr(model_class, key) for key in keys))]
+    if model_class is Recipe and card_edits:
+        options.append(selectinload(Recipe.edits).load_only(*CARD_EDIT_COLUMNS))
+    return options
+
+def load_card_fields(fields: frozenset | None) -> list:
+    """Loader options for head edits passed to Recipe.to_dict(), and the parent edits un-materialized forks'
+    content is in, when a fieldset is asked for"""
+    if fields is None:
+        return []
+    return [load_only(*CARD_EDIT_COLUMNS), selectinload(Edit.source_edit).load_only(*CARD_EDIT_COLUMNS)]
+
+def only_fields(dicted: dict, fields: frozenset | None) -> dict:
+    """Drop the keys that aren't in the fieldset -- ones to_dict() adds regardless, or that were already loaded"""
+    if fields is None:
+        return dicted
+    return {key: val for key, val in dicted.items() if key in fields}
+
+#################### Compression ####################
+def _choose_encoding() -> str | None:
+    accepted = request.accept_encodings
+    gzip_q = accepted['gzip']
+    if brotli is not None and accepted['br'] and accepted['br'] >= gzip_q:
+        return 'br'
+    return 'gzip' if gzip_q else None
+
+class _Compressor:
+    """Same interface over gzip and brotli, flushing after every chunk so streamed responses keep streaming"""
+    def __init__(self, encoding: str, level: int):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=min(level, 11))
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31) # wbits=31: gzip container
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == 'br':
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+def _compress_stream(chunks, compressor: _Compressor):
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+def compress_response(response: Response) -> Response:
+    """after_request hook: gzip/brotli-encode the response if the client accepts it and it's worth it"""
+    if (request.method == 'HEAD' or response.status_code in (204, 304)
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = _choose_encoding()
+    if encoding is None:
+        return response
+    if not response.is_streamed and response.calculate_content_length() < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    compressor = _Compressor(encoding, current_app.config['COMPRESS_LEVEL'])
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, compressor)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compressor.compress(response.get_data()) + compressor.finish())
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def init_app(app) -> None:
+    app.config.setdefault('COMPRESS_MIN_SIZE', 1024) # bytes; smaller bodies aren't worth the CPU
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.after_request(compress_response)
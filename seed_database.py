@@ -20,8 +20,8 @@ if sys.argv[1:2] and sys.argv[2:3]:
         print("Adding to existing database 'test'...")
 
 # connect to db (and re-create tables, if needed)
-model.connect_to_db(api_server.app, f'/{db_name}')
-api_server.app.app_context().push()
+app = api_server.create_app({'DB_URI': f'/{db_name}'})
+app.app_context().push()
 if sys.argv[1:2] == ['recreate']:
     model.db.create_all()
 
@@ -93,4 +93,5 @@ for i in range(1,4): # for every user id
         this_permission = model.Permission(user_id=i,recipe_id=((3*(i%3))+j),can_experiment=bool(i-1),can_edit=(i-1)%2)
         model.db.session.add(this_permission)
 
-model.db.session.commit()
\ No newline at end of file
+model.db.session.commit()
+model.Recipe.reconcile_counts() # seeded directly, not through the routes that keep the counts
\ No newline at end of file
@@ -0,0 +1,130 @@
+"""Near-duplicate recipes: a MinHash signature of each recipe's current version, split into bands that are indexed
+as LSH buckets, so the recipes most like one are found with one index lookup per band instead of comparing against every recipe"""
+
+from model import db, Edit, RecipeSignature, RecipeBucket
+import ingredients_helper as ih
+import permissions_helper as ph
+from sqlalchemy import select, insert, delete, desc, func
+from sqlalchemy.orm import aliased
+import hashlib
+import random
+import re
+
+NUM_HASHES = 64
+BANDS = 16 # of 4 minhashes each: recipes 80% alike share a bucket 99.9% of the time, 50% alike about 2 times in 3
+ROWS = NUM_HASHES // BANDS
+SIMILARITY_THRESHOLD = 0.5 # estimated Jaccard similarity of the two recipes' shingles
+MAX_CANDIDATES = 500 # signatures scored per lookup, so a very common recipe can't make one slow
+MAX_RESULTS = 20
+SHINGLE_WORDS = 3 # instructions are compared as overlapping runs of this many words
+_PRIME = (1 << 61) - 1
+_rng = random.Random(5381) # fixed seed: signatures have to stay comparable across workers and restarts
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(_PRIME)) for _ in range(NUM_HASHES)]
+TAG_RE = re.compile(r'<[^>]+>') # Spoonacular's instructions can be HTML
+WORD_RE = re.compile(r'[a-z0-9]+')
+
+def _hash64(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'big')
+
+def shingles(ingredient_names: list[str], instructions: str | None) -> set[str]:
+    """Each normalized ingredient name, plus every run of SHINGLE_WORDS words of the instructions"""
+    found = {f'i:{name}' for name in ingredient_names}
+    words = WORD_RE.findall(TAG_RE.sub(' ', instructions or '').lower())
+    found.update(f'w:{" ".join(words[i:i + SHINGLE_WORDS])}' for i in range(max(len(words) - SHINGLE_WORDS, 0) + bool(words)))
+    return found
+
+def minhashes(found: set[str]) -> list[int] | None:
+    """MinHash signature of a set of shingles (None for an empty set): the smallest value each of NUM_HASHES
+    hash functions takes over it. Two signatures agree at a position with probability equal to the sets' Jaccard similarity."""
+    if not found:
+        return None
+    hashes = [_hash64(shingle) for shingle in found]
+    return [min((a * x + b) % _PRIME for x in hashes) for a, b in _PERMUTATIONS]
+
+def buckets(signature: list[int]) -> list[int]:
+    """One bucket per band: a signed 64-bit hash of the band number and its minhashes"""
+    return [int.from_bytes(hashlib.blake2b(repr((band, signature[band * ROWS:(band + 1) * ROWS])).encode(),
+                                           digest_size=8).digest(), 'big', signed=True)
+            for band in range(BANDS)]
+
+def similarity(a: list[int], b: list[int]) -> float:
+    """Estimated Jaccard similarity of the shingles behind two signatures"""
+    return sum(x == y for x, y in zip(a, b)) / NUM_HASHES
+
+def signature_of(ingredient_names: list[str], instructions: str | None) -> list[int] | None:
+    return minhashes(shingles(ingredient_names, instructions))
+
+def _replace(signatures: dict[int, tuple]) -> None:
+    """Replace the index entries of each recipe_id in signatures ({recipe_id: (edit_id, signature or None)})"""
+    recipe_ids = list(signatures)
+    db.session.execute(delete(RecipeSignature).where(RecipeSignature.recipe_id.in_(recipe_ids)))
+    db.session.execute(delete(RecipeBucket).where(RecipeBucket.recipe_id.in_(recipe_ids)))
+    rows = [{'recipe_id': recipe_id, 'edit_id': edit_id, 'minhashes': signature}
+            for recipe_id, (edit_id, signature) in signatures.items() if signature]
+    if rows:
+        db.session.execute(insert(RecipeSignature), rows)
+        # the same bucket can come up in two bands only by a hash collision, but the primary key would still reject it
+        db.session.execute(insert(RecipeBucket), [{'recipe_id': row['recipe_id'], 'bucket': bucket}
+                                                  for row in rows for bucket in set(buckets(row['minhashes']))])
+
+def index_edit(edit: Edit, parsed: list[dict] | None = None) -> None:
+    """Make the given (current) edit the recipe's entry in the near-duplicate index.
+    parsed: its ingredients, if they're already structured (as for ingredients_helper.index_edit())."""
+    content = edit.content_edit
+    if parsed is None:
+        parsed = ih.parse_ingredients(content.ingredients)
+    _replace({edit.recipe_id: (edit.id, signature_of([ingredient['name'] for ingredient in parsed], content.instructions))})
+
+def find_similar(viewer_id: int | None, signature: list[int] | None, exclude_id: int | None = None) -> list[tuple]:
+    """Recipes the viewer can see that are near-duplicates of the signature, most alike first (at most MAX_RESULTS).
+    Only recipes sharing an LSH bucket with it are scored, so this reads a few index entries, not every signature.
+
+    Returns [(Recipe, head Edit, similarity)]; pass them to to_dict(head=...).
+    """
+    if not signature:
+        return []
+    # SELECT recipe_id, minhashes FROM recipe_signatures
+    # WHERE recipe_id IN (SELECT recipe_id FROM recipe_buckets WHERE bucket IN <one per band>) LIMIT 500
+    candidates = select(RecipeBucket.recipe_id).where(RecipeBucket.bucket.in_(buckets(signature)))
+    stmt = (select(RecipeSignature.recipe_id, RecipeSignature.minhashes)
+            .where(RecipeSignature.recipe_id.in_(candidates)).limit(MAX_CANDIDATES))
+    if exclude_id is not None:
+        stmt = stmt.where(RecipeSignature.recipe_id != exclude_id)
+    scores = {recipe_id: similarity(signature, other) for recipe_id, other in db.session.execute(stmt)}
+    ranked = sorted((recipe_id for recipe_id, score in scores.items() if score >= SIMILARITY_THRESHOLD),
+                    key=lambda recipe_id: (-scores[recipe_id], recipe_id))
+    if not ranked:
+        return []
+    recipes = ph.get_recipes_for_viewer(viewer_id, ranked)
+    visible = [recipe_id for recipe_id in ranked if recipe_id in recipes and recipes[recipe_id][1]][:MAX_RESULTS]
+    heads = ph.get_head_edits(visible)
+    return [(recipes[recipe_id][0], heads.get(recipe_id), scores[recipe_id]) for recipe_id in visible]
+
+def find_similar_to_recipe(viewer_id: int | None, recipe_id: int) -> list[tuple]:
+    """find_similar() for a recipe's current version, leaving out the recipe itself"""
+    signature = db.session.scalar(select(RecipeSignature.minhashes).where(RecipeSignature.recipe_id == recipe_id))
+    return find_similar(viewer_id, signature, exclude_id=recipe_id)
+
+def backfill_index(batch_size: int = 500) -> int:
+    """(Re)build the near-duplicate index for every recipe, batch_size recipes per transaction. Returns how many were indexed."""
+    source = aliased(Edit)
+    # current version of each recipe, as in ingredients_helper.backfill_index()
+    select_heads = (select(Edit.id, Edit.recipe_id,
+                           func.coalesce(source.ingredients, Edit.ingredients).label('ingredients'),
+                           func.coalesce(source.instructions, Edit.instructions).label('instructions'))
+                    .outerjoin(source, Edit.source_edit_id == source.id)
+                    .where(Edit.pending_approval.isnot(True))
+                    .distinct(Edit.recipe_id)
+                    .order_by(Edit.recipe_id, desc(Edit.commit_date)))
+    last_id = 0
+    indexed = 0
+    while True:
+        heads = db.session.execute(select_heads.where(Edit.recipe_id > last_id).limit(batch_size)).all()
+        if not heads:
+            return indexed
+        _replace({head.recipe_id: (head.id, signature_of([ingredient['name'] for ingredient in ih.parse_ingredients(head.ingredients)],
+                                                         head.instructions))
+                  for head in heads})
+        db.session.commit()
+        indexed += len(heads)
+        last_id = heads[-1].recipe_id
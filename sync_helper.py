@@ -0,0 +1,131 @@
+from model import (db, User, Recipe, Edit, Experiment, Permission, Change)
+from archive_helper import full_dicts
+from sqlalchemy import select, union, delete, func, or_, tuple_, text
+from sqlalchemy.orm import lazyload, selectinload
+from datetime import datetime, timedelta
+
+CHANGE_LOG_RETENTION_DAYS = 30
+
+class SyncTokenExpired(Exception):
+    """The changes after this token have been pruned from the change log; the client has to start over"""
+
+def select_synced_recipe_ids(user_id: int):
+    """Recipes that get synced to a user: the ones they own, plus the ones shared with them"""
+    return union(select(Recipe.id).where(Recipe.user_id == user_id),
+                 select(Permission.recipe_id).where(Permission.user_id == user_id))
+
+def permission_to_dict(permission: Permission) -> dict:
+    return {'recipe_id': permission.recipe_id,
+            'user_id': permission.user_id,
+            'username': permission.user.username,
+            'can_experiment': permission.can_experiment,
+            'can_edit': permission.can_edit}
+
+def oldest_running_txid() -> int:
+    """Transaction id that every change not yet visible to us was logged at or after: the oldest transaction still
+    running (or the next one to start, if none is). Changes committed later, however long they ran, are never below it."""
+    return db.session.scalar(select(text('pg_snapshot_xmin(pg_current_snapshot())::text::bigint')))
+
+def get_changes_since(user_id: int, token: int | None) -> dict:
+    """Given a user's id and the token from their last sync (None for a first sync),
+    return everything they need to bring their copy of their recipes up to date.
+
+    Returns:    {token: <int, pass to the next sync>,
+                 full: <bool, True if this is a complete snapshot rather than changes>,
+                 recipes, edits, experiments: lists of dicts, same as their to_dict(),
+                 permissions: list of dicts {recipe_id, user_id, username, can_experiment, can_edit},
+                 deleted: list of dicts {type: 'recipe'|'edit'|'experiment', id}
+                                     or {type: 'permission', recipe_id, user_id}}
+    Raises SyncTokenExpired if the change log no longer goes back as far as token.
+    """
+    # New token: taken before reading, so whatever this sync can't see yet is at or after it. Changes that are
+    # returned now may be returned again next time too -- everything here is safe to apply twice.
+    new_token = oldest_running_txid()
+    synced_ids = set(db.session.scalars(select_synced_recipe_ids(user_id)))
+
+    if token is None:
+        return _snapshot(synced_ids, new_token)
+
+    # transaction ids aren't contiguous, so this can't tell pruned changes from no changes: if nothing retained is
+    # older than the token, the client starts over to be safe
+    oldest = db.session.scalar(select(func.min(Change.txid)))
+    if (oldest is not None and token < oldest) or token > new_token: # or it isn't one of ours
+        raise SyncTokenExpired()
+
+    # SELECT * FROM changes WHERE txid >= <token>
+    #   AND (recipe_id IN <synced ids> OR user_id = <user_id>)
+    # A deleted recipe is no longer in synced ids; its tombstone was logged once for each user who had it (user_id).
+    select_changes = (select(Change).where(Change.txid >= token)
+                      .where(or_(Change.recipe_id.in_(synced_ids), Change.user_id == user_id))
+                      .order_by(Change.id))
+    latest = {} # only the last change to each row matters
+    for change in db.session.scalars(select_changes):
+        key = (change.entity_type, change.recipe_id, change.entity_id)
+        latest[key] = change.op
+
+    upserts = {'recipe': set(), 'edit': set(), 'experiment': set(), 'permission': set()}
+    deleted = []
+    newly_shared = set()
+    for (entity_type, recipe_id, entity_id), op in latest.items():
+        if entity_type == 'permission':
+            if op == 'upsert' and entity_id == user_id:
+                newly_shared.add(recipe_id)
+            if op == 'delete' and entity_id == user_id and recipe_id not in synced_ids:
+                deleted.append({'type': 'recipe', 'id': recipe_id}) # lost access, drop the whole recipe
+            if op == 'delete':
+                deleted.append({'type': 'permission', 'recipe_id': recipe_id, 'user_id': entity_id})
+            elif recipe_id in synced_ids:
+                upserts['permission'].add((recipe_id, entity_id))
+        elif op == 'delete':
+            deleted.append({'type': entity_type, 'id': entity_id})
+        elif recipe_id in synced_ids:
+            upserts[entity_type].add(entity_id)
+
+    response = _fetch(upserts, newly_shared & synced_ids, synced_ids, deleted)
+    response['token'] = max(token, new_token)
+    response['full'] = False
+    return response
+
+def _snapshot(synced_ids: set[int], new_token: int) -> dict:
+    response = _fetch({'recipe': set(), 'edit': set(), 'experiment': set(), 'permission': set()},
+                      synced_ids, synced_ids, [])
+    response['token'] = new_token
+    response['full'] = True
+    return response
+
+def _fetch(upserts: dict, whole_recipe_ids: set[int], synced_ids: set[int], deleted: list[dict]) -> dict:
+    """Load the current version of every upserted row (plus every row of whole_recipe_ids).
+    Rows that have disappeared in the meantime become tombstones."""
+    recipe_ids = upserts['recipe'] | whole_recipe_ids
+    # everything to_dict() reads is loaded up front, a few statements per list rather than one per row
+    recipes = db.session.scalars(select(Recipe).where(Recipe.id.in_(recipe_ids))
+                                 .options(selectinload(Recipe.edits).selectinload(Edit.source_edit), selectinload(Recipe.owner),
+                                          selectinload(Recipe.parent).options(lazyload(Recipe.edits), selectinload(Recipe.owner)))).all()
+    edits = db.session.scalars(select(Edit).where(Edit.recipe_id.in_(synced_ids)).where(Edit.pending_approval.isnot(True))
+                               .where(or_(Edit.id.in_(upserts['edit']), Edit.recipe_id.in_(whole_recipe_ids)))
+                               .options(selectinload(Edit.source_edit))).all()
+    experiments = db.session.scalars(select(Experiment).where(Experiment.recipe_id.in_(synced_ids))
+                                     .where(or_(Experiment.id.in_(upserts['experiment']),
+                                                Experiment.recipe_id.in_(whole_recipe_ids)))).all()
+    permissions = db.session.scalars(select(Permission)
+                                     .where(or_(tuple_(Permission.recipe_id, Permission.user_id).in_(upserts['permission']),
+                                                Permission.recipe_id.in_(whole_recipe_ids)))
+                                     .options(selectinload(Permission.user))).all()
+    for entity_type, found in (('recipe', recipes), ('edit', edits), ('experiment', experiments)):
+        missing = upserts[entity_type] - {row.id for row in found}
+        deleted += [{'type': entity_type, 'id': entity_id} for entity_id in missing]
+    missing = upserts['permission'] - {(p.recipe_id, p.user_id) for p in permissions}
+    deleted += [{'type': 'permission', 'recipe_id': recipe_id, 'user_id': user_id} for recipe_id, user_id in missing]
+
+    return {'recipes': [recipe.to_dict() for recipe in recipes],
+            'edits': full_dicts(edits), # offline clients get archived bodies too
+            'experiments': full_dicts(experiments),
+            'permissions': [permission_to_dict(permission) for permission in permissions],
+            'deleted': deleted}
+
+def prune_change_log(retention_days: int = CHANGE_LOG_RETENTION_DAYS) -> int:
+    """Delete change log rows older than retention_days. Clients that last synced before that get a full resync."""
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    result = db.session.execute(delete(Change).where(Change.changed_at < cutoff))
+    db.session.commit()
+    return result.rowcount
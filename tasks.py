@@ -0,0 +1,57 @@
+"""Minimal background task runner for work that shouldn't hold up a request"""
+
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+import logging
+
+from model import db
+
+logger = logging.getLogger(__name__)
+_executor = None
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Create the worker pool on first use, so importing this module never starts threads"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='forkd-task')
+    return _executor
+
+def reset() -> None:
+    """Forget the worker pool, e.g. in a forked child (where its threads don't exist); the next task starts a new one"""
+    global _executor
+    _executor = None
+
+def run_in_background(fn, *args) -> None:
+    """Run fn(*args) in its own app context (and so its own db session) on a worker thread.
+
+    With app.config['TASKS_INLINE'] set (as in tests), runs it right away instead.
+    """
+    app = current_app._get_current_object()
+
+    def _run():
+        with app.app_context():
+            try:
+                fn(*args)
+            except Exception:
+                db.session.rollback()
+                logger.exception('Background task %s failed', fn.__name__)
+
+    if app.config.get('TASKS_INLINE'):
+        _run()
+    else:
+        _get_executor().submit(_run)
+
+def run_after_commit(fn, *args) -> None:
+    """Queue fn(*args) to run in the background once the current transaction commits. Dropped on rollback."""
+    db.session.info.setdefault('after_commit_tasks', []).append((fn, args))
+
+@event.listens_for(Session, 'after_commit')
+def _submit_after_commit_tasks(session):
+    for fn, args in session.info.pop('after_commit_tasks', []):
+        run_in_background(fn, *args)
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_after_commit_tasks(session):
+    session.info.pop('after_commit_tasks', None)
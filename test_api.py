@@ -1,8 +1,50 @@
 import unittest
+from unittest import mock
 unittest.TestLoader.sortTestMethodsUsing = lambda *args: -1
 import model
-from api_server import app
+import feed_helper as fh
+import ingredients_helper as ih
+import similarity_helper as sim
+import permissions_helper as ph
+import sync_helper as sh
+import dto_helper as dh
+import rate_limit
+import response_cache as rc
+import archive_helper as ah
+import account_helper as acc
+import metrics
+import deadline
+import jobs
+from flask import Response
+from api_server import create_app, limiter, outbound
+from upstream_stubs import StubUpstream
 from datetime import datetime, timedelta
+from sqlalchemy import delete, event, insert, select, text, update
+from urllib.parse import urlsplit
+import gzip
+import re
+import io
+import json
+
+# SQL statements each endpoint (by view name) may send per request, whatever the size of the data it reads --
+# tests that go through QueryBudget fail if one goes over, listing what it sent. A new endpoint needs a budget here.
+QUERY_BUDGETS = {
+    'get_token': 2, 'revoke_token': 2, 'get_user': 1,
+    'read_all_users': 1, 'create_user': 3, 'read_user_profile': 4,
+    'delete_user': 20, # the whole deletion job, which runs inline in tests
+    'read_account_deletion': 1, 'update_user': 5,
+    'get_featured_recipes': 9, 'create_new_recipe': 12, 'read_similar_recipes': 10,
+    'search_recipes_by_ingredient': 9, # 5, and 4 more if any result is a fork (its parent, its source edit...)
+    'read_recipe_timeline': 7, 'delete_recipe': 8, 'fork_recipe': 18, 'checkout_recipe': 7,
+    'stream_recipe_events': 6, # opening checks and one pass over the replay (its cursor, then its changes)
+    'create_new_exp': 20, 'create_new_edit': 22, # a big audience's feed fan-out is a (here inline) job of its own
+    'read_pending_edits': 6, 'approve_edit': 19, 'reject_edit': 6, 'create_batch': 18,
+    'read_permissions': 5, 'update_global_permissions': 5, 'create_permission': 12, 'delete_permission': 11,
+    'update_or_delete_permission': 7, 'batch_permissions': 9, 'read_feed': 2,
+    'sync_changes': 25, # selectin loads go 500 keys per statement, so a full sync grows by one every 500 rows
+    'read_metrics': 0, 'delete_edit': 13, 'read_edit_body': 5, 'read_experiment_body': 6, 'delete_experiment': 11,
+    'edit_experiment': 11, 'extract_recipe_from_url': 3,
+}
 
 # Test visibility for a public user
 class TestPublicUser(unittest.TestCase):
@@ -124,6 +166,16 @@ class TestSignUp(unittest.TestCase):
         self.assertEqual(response.status_code, 201)
         self.assertEqual(model.User.query.count(), initial_user_count + 1, "New user should have been made")
 
+class TestAppFactory(unittest.TestCase):
+    def test_clients_loaded_lazily(self):
+        import sys
+        self.assertNotIn('cloudinary', sys.modules)
+        self.assertNotIn('requests', sys.modules)
+
+    def test_needs_a_database(self):
+        with self.assertRaises(RuntimeError):
+            create_app({'DB_URI': None})
+
 class TestAuthentication(unittest.TestCase):
     # def test_login_no_inputs(self):
     #     response = client.post('/tokens', auth=('', ''))
@@ -161,6 +213,27 @@ class LoggedInUser(): #Mixin for logging in
     def get_api_token(self, login, password):
         response = client.post('/api/tokens', auth=(login, password))
         return response.json['token']
+
+class QueryBudget(): #Mixin for checking requests against QUERY_BUDGETS
+    def request_within_budget(self, method, url, **kwargs):
+        """Make the request (reading all of a streamed body), and fail if it sent more SQL statements than its
+        endpoint's budget. The statements are left in self.statements."""
+        model.db.session.expire_all() # as if the request's session started empty, as it does outside tests
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(model.db.engine, 'before_cursor_execute', record)
+        try:
+            response = client.open(url, method=method, **kwargs)
+            response.get_data() # streamed bodies run their queries as they're read
+        finally:
+            event.remove(model.db.engine, 'before_cursor_execute', record)
+        self.statements = statements
+        endpoint, _ = client.application.url_map.bind('localhost').match(urlsplit(url).path, method)
+        view = endpoint.rpartition('.')[2]
+        if len(statements) > QUERY_BUDGETS[view]:
+            listed = '\n'.join(f'  {i}. {" ".join(statement.split())[:300]}' for i, statement in enumerate(statements, 1))
+            self.fail(f'{method} {url} ({view}) sent {len(statements)} SQL statements, over its budget of {QUERY_BUDGETS[view]}:\n{listed}')
+        return response
     
 class TestCreateAndDelete(LoggedInUser, unittest.TestCase):
     def setUp(self):
@@ -244,7 +317,1332 @@ class TestPermissions(LoggedInUser, unittest.TestCase):
             headers = {'Authorization': f'Bearer {self.shared_token}'})
         self.assertEqual(n_response.status_code, 200)
 
-        
+
+class TestAccountDeletion(LoggedInUser, unittest.TestCase):
+    def setUp(self):
+        suffix = model.User.query.count() # fresh users every test, since each one deletes its own
+        self.leaving = model.User.create(f'futaba{suffix}@tokyo.com', 'phantomthieves', f'futaba{suffix}')
+        self.friend = model.User.create(f'haru{suffix}@tokyo.com', 'phantomthieves', f'haru{suffix}')
+        model.db.session.add_all([self.leaving, self.friend])
+        model.db.session.flush()
+        now = datetime.utcnow()
+        self.shared = model.Recipe.create(self.leaving, now)
+        self.unshared = model.Recipe.create(self.leaving, now)
+        for recipe in (self.shared, self.unshared):
+            model.Edit.create(recipe, 'Leaving', '', 'ingredients', 'instructions', '', now, self.leaving)
+        self.contribution = model.Edit.create(model.Recipe.get_by_id(2), 'Their edit', '', '', '', '', now, self.leaving)
+        model.db.session.add_all([self.shared, self.unshared, self.contribution])
+        model.db.session.flush()
+        model.db.session.add_all([model.Permission.create(self.friend.id, self.shared.id, True, False),
+                                  model.Permission.create(self.leaving.id, 2, True, True)])
+        model.Recipe.adjust_counts(self.shared.id, collaborators=1)
+        model.Recipe.adjust_counts(2, collaborators=1)
+        model.db.session.commit()
+        self.username = self.leaving.username
+        self.ids = (self.leaving.id, self.shared.id, self.unshared.id, self.contribution.id)
+
+    def test_deactivated_at_once(self):
+        token = self.get_api_token(self.username, 'phantomthieves')
+        job = acc.request_deletion(self.leaving) # without running it
+        model.db.session.commit()
+        self.assertEqual(client.post('/api/tokens', auth=(self.username, 'phantomthieves')).status_code, 403)
+        self.assertEqual(client.get('/api/me', headers={'Authorization': f'Bearer {token}'}).status_code, 401)
+        self.assertEqual(client.get(f'/api/users/{self.username}').status_code, 404)
+        self.assertEqual(client.get(f'/api/account-deletions/{job.id}').json['status'], 'pending')
+        self.assertTrue(acc.run_deletion(job.id, batch_size=1)) # one row at a time, committing in between
+        status = client.get(f'/api/account-deletions/{job.id}').json
+        self.assertEqual(status['recipes'], {'total': 2, 'transferred': 1, 'deleted': 1})
+        self.assertEqual(status['contributions'], {'total': 2, 'done': 2}) # on joker's recipe, and on the handed-off one
+
+    def test_delete_account(self):
+        user_id, shared_id, unshared_id, contribution_id = self.ids
+        token = self.get_api_token(self.username, 'phantomthieves')
+        other = client.delete(f'/api/users/{user_id - 1}', headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(other.status_code, 403)
+        response = client.delete(f'/api/users/{user_id}', headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(client.get(response.json['status_url']).json['status'], 'done') # tasks run inline in tests
+        self.assertIsNone(model.User.get_by_id(user_id))
+        shared = model.Recipe.get_by_id(shared_id)
+        self.assertEqual(shared.user_id, self.friend.id) # handed to its collaborator
+        self.assertEqual((shared.collaborator_count, shared.permissions), (0, []))
+        self.assertIsNone(model.Recipe.get_by_id(unshared_id))
+        self.assertIsNone(model.Edit.get_by_id(contribution_id).commit_by) # kept, but no longer credited
+        self.assertIsNone(model.Permission.get_by_user_and_recipe(user_id, 2))
+
+    def test_resumed_by_job_invalidates_cache(self):
+        app.config['RESPONSE_CACHE_BACKEND'] = 'database' # as the job's app has it, and the server's
+        try:
+            acc.request_deletion(self.leaving) # left for the job, as if the server restarted before running it
+            model.db.session.commit()
+            self.assertEqual(client.get(f'/api/recipes/{self.shared.id}').json['owner'], self.username) # now cached
+            self.assertEqual(jobs.run('resume-account-deletions', app.config['DB_URI']), 1)
+            model.db.session.expire_all() # changed by the job's session
+            self.assertEqual(client.get(f'/api/recipes/{self.shared.id}').json['owner'], self.friend.username)
+        finally:
+            app.config['RESPONSE_CACHE_BACKEND'] = 'lru'
+            rc.cache.reset()
+
+class TestActivityFeed(LoggedInUser, unittest.TestCase):
+    def setUp(self):
+        self.owner_token = self.get_api_token('joker','phantomthieves')
+        self.collab_token = self.get_api_token('makoto','phantomthieves')
+        owner = model.User.get_by_username('joker')
+        self.collaborator = model.User.get_by_username('makoto')
+        self.recipe = model.Recipe.create(owner, datetime.utcnow(), False, False)
+        model.Edit.create(self.recipe, 'Feed recipe', '', 'ingredients', 'instructions', '', datetime.utcnow(), owner)
+        model.db.session.add(self.recipe)
+        model.db.session.flush()
+        model.db.session.add(model.Permission.create(self.collaborator.id, self.recipe.id))
+        model.db.session.commit()
+
+    def post_experiment(self, commit_msg):
+        return client.post(f'/api/recipes/{self.recipe.id}/experiments', json={'commit_msg': commit_msg},
+                           headers = {'Authorization': f'Bearer {self.collab_token}'})
+
+    def read_feed(self, token, query=''):
+        return client.get(f'/api/feed{query}', headers = {'Authorization': f'Bearer {token}'})
+
+    def test_collaborator_experiment_reaches_owner_feed(self):
+        self.post_experiment('Feed experiment')
+        items = self.read_feed(self.owner_token).json['items']
+        self.assertEqual(items[0]['summary'], 'Feed experiment')
+        self.assertEqual(items[0]['actor'], 'makoto')
+        self.assertEqual(items[0]['recipe_id'], self.recipe.id)
+        # the actor doesn't get their own activity
+        collab_items = self.read_feed(self.collab_token).json['items']
+        self.assertFalse(any(item['recipe_id'] == self.recipe.id for item in collab_items))
+
+    def test_feed_cursor_pagination(self):
+        for i in range(3):
+            self.post_experiment(f'Page experiment {i}')
+        first_page = self.read_feed(self.owner_token, '?limit=2').json
+        self.assertEqual([item['summary'] for item in first_page['items']], ['Page experiment 2', 'Page experiment 1'])
+        self.assertIsNotNone(first_page['next_cursor'])
+        second_page = self.read_feed(self.owner_token, f"?limit=2&before={first_page['next_cursor']}").json
+        self.assertEqual(second_page['items'][0]['summary'], 'Page experiment 0')
+
+    def test_background_fan_out(self):
+        original_limit = fh.INLINE_FANOUT_LIMIT
+        fh.INLINE_FANOUT_LIMIT = 0
+        try:
+            self.post_experiment('Deferred experiment')
+        finally:
+            fh.INLINE_FANOUT_LIMIT = original_limit
+        items = self.read_feed(self.owner_token).json['items']
+        self.assertEqual(items[0]['summary'], 'Deferred experiment')
+
+    def test_feed_is_capped(self):
+        self.post_experiment('Capped experiment')
+        fh.trim_feeds({model.User.get_by_username('joker').id}, max_items=1)
+        model.db.session.commit()
+        items = self.read_feed(self.owner_token).json['items']
+        self.assertEqual(len(items), 1)
+
+class TestBatchWrite(LoggedInUser, unittest.TestCase):
+    def setUp(self):
+        self.token = self.get_api_token('makoto','phantomthieves')
+        user = model.User.get_by_username('makoto')
+        self.recipe = model.Recipe.create(user, datetime.utcnow() - timedelta(days=1))
+        model.Edit.create(self.recipe, 'Batch recipe', '', 'ingredients', 'instructions', '', datetime.utcnow(), user)
+        model.db.session.add(self.recipe)
+        model.db.session.commit()
+        self.initial_modified = self.recipe.last_modified
+        self.others_recipe_id = 2 # joker's, not shared with makoto
+
+    def post_batch(self, body):
+        return client.post('/api/batch', json=body, headers = {'Authorization': f'Bearer {self.token}'})
+
+    def test_atomic_batch_success(self):
+        response = self.post_batch({'operations': [
+            {'type': 'experiment', 'recipe_id': self.recipe.id, 'commit_msg': 'Offline 1'},
+            {'type': 'edit', 'recipe_id': self.recipe.id, 'title': 'Offline title'},
+            {'type': 'experiment', 'recipe_id': self.recipe.id, 'commit_msg': 'Offline 2'},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(all(result['status'] == 201 for result in response.json['results']))
+        model.db.session.refresh(self.recipe)
+        self.assertEqual([exp.commit_msg for exp in self.recipe.experiments], ['Offline 2', 'Offline 1'])
+        self.assertEqual(self.recipe.edits[0].title, 'Offline title')
+        self.assertGreater(self.recipe.last_modified, self.initial_modified)
+
+    def test_atomic_batch_rejected_as_a_whole(self):
+        initial_exp_count = model.Experiment.query.count()
+        response = self.post_batch({'operations': [
+            {'type': 'experiment', 'recipe_id': self.recipe.id, 'commit_msg': 'Should not exist'},
+            {'type': 'experiment', 'recipe_id': self.others_recipe_id, 'commit_msg': 'Forbidden'},
+        ]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([result['status'] for result in response.json['results']], [424, 403])
+        self.assertEqual(model.Experiment.query.count(), initial_exp_count)
+
+    def test_partial_batch(self):
+        response = self.post_batch({'mode': 'partial', 'operations': [
+            {'type': 'experiment', 'recipe_id': self.recipe.id, 'commit_msg': 'Partial'},
+            {'type': 'edit', 'recipe_id': self.others_recipe_id, 'title': 'Forbidden'},
+            {'type': 'experiment', 'recipe_id': 999999},
+            {'type': 'unknown', 'recipe_id': self.recipe.id},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        results = response.json['results']
+        self.assertEqual([result['status'] for result in results], [201, 403, 404, 400])
+        self.assertEqual(model.Experiment.get_by_id(results[0]['id']).commit_msg, 'Partial')
+
+class TestSync(LoggedInUser, unittest.TestCase):
+    def setUp(self):
+        self.owner_token = self.get_api_token('joker','phantomthieves')
+        self.token = self.get_api_token('makoto','phantomthieves')
+        owner = model.User.get_by_username('joker')
+        self.user = model.User.get_by_username('makoto')
+        self.recipe = model.Recipe.create(owner, datetime.utcnow(), False, False)
+        model.Edit.create(self.recipe, 'Synced recipe', '', 'ingredients', 'instructions', '', datetime.utcnow(), owner)
+        model.db.session.add(self.recipe)
+        model.db.session.flush()
+        model.db.session.add(model.Permission.create(self.user.id, self.recipe.id))
+        model.db.session.commit()
+
+    def sync(self, sync_token=None):
+        query = f'?token={sync_token}' if sync_token is not None else ''
+        return client.get(f'/api/sync{query}', headers = {'Authorization': f'Bearer {self.token}'})
+
+    def test_first_sync_is_full_snapshot(self):
+        response = self.sync()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json['full'])
+        self.assertIn(self.recipe.id, [recipe['id'] for recipe in response.json['recipes']])
+        self.assertIn(self.recipe.edits[0].id, [edit['id'] for edit in response.json['edits']])
+
+    def test_incremental_sync_returns_changes_and_tombstones(self):
+        sync_token = self.sync().json['token']
+        response = client.post(f'/api/recipes/{self.recipe.id}/experiments', json={'commit_msg': 'Synced experiment'},
+                               headers = {'Authorization': f'Bearer {self.owner_token}'})
+        exp_id = response.json['id']
+        changes = self.sync(sync_token).json
+        self.assertFalse(changes['full'])
+        self.assertIn(exp_id, [exp['id'] for exp in changes['experiments']])
+        self.assertIn(self.recipe.id, [recipe['id'] for recipe in changes['recipes']]) # last_modified moved
+
+        client.delete(f'/api/experiments/{exp_id}', headers = {'Authorization': f'Bearer {self.owner_token}'})
+        changes = self.sync(sync_token).json
+        self.assertNotIn(exp_id, [exp['id'] for exp in changes['experiments']])
+        self.assertIn({'type': 'experiment', 'id': exp_id}, changes['deleted'])
+
+    def test_slow_transaction_not_skipped(self):
+        with model.db.engine.connect() as slow: # a write that's still running when the client syncs
+            with slow.begin():
+                exp_id = slow.scalar(insert(model.Experiment).values(recipe_id=self.recipe.id, commit_msg='Slow', commit_date=datetime.utcnow())
+                                     .returning(model.Experiment.id))
+                slow.execute(insert(model.Change), [model.item_change_row('experiment', self.recipe.id, exp_id)])
+                client.post(f'/api/recipes/{self.recipe.id}/experiments', json={'commit_msg': 'Fast'},
+                            headers = {'Authorization': f'Bearer {self.owner_token}'})
+                model.db.session.execute(update(model.Change).values(changed_at=datetime.utcnow() - timedelta(minutes=1)))
+                model.db.session.commit() # the slow one has been running a while
+                sync_token = self.sync().json['token']
+        self.assertIn(exp_id, [exp['id'] for exp in self.sync(sync_token).json['experiments']])
+
+    def test_revoked_recipe_is_tombstoned(self):
+        sync_token = self.sync().json['token']
+        client.delete(f'/api/recipes/{self.recipe.id}/permissions/{self.user.id}',
+                      headers = {'Authorization': f'Bearer {self.owner_token}'})
+        changes = self.sync(sync_token).json
+        self.assertIn({'type': 'recipe', 'id': self.recipe.id}, changes['deleted'])
+
+    def test_deleted_recipe_is_tombstoned_only_for_its_audience(self):
+        owner = model.User.get_by_username('joker')
+        unshared = model.Recipe.create(owner, datetime.utcnow(), False, False)
+        model.Edit.create(unshared, 'Not shared', '', 'ingredients', 'instructions', '', datetime.utcnow(), owner)
+        model.db.session.add(unshared)
+        model.db.session.commit()
+        unshared_id = unshared.id
+        sync_token = self.sync().json['token']
+        for recipe_id in (unshared_id, self.recipe.id):
+            client.delete(f'/api/recipes/{recipe_id}', headers = {'Authorization': f'Bearer {self.owner_token}'})
+        deleted = self.sync(sync_token).json['deleted']
+        self.assertIn({'type': 'recipe', 'id': self.recipe.id}, deleted)
+        self.assertNotIn({'type': 'recipe', 'id': unshared_id}, deleted)
+        owner_deleted = client.get(f'/api/sync?token={sync_token}', headers = {'Authorization': f'Bearer {self.owner_token}'}).json['deleted']
+        self.assertIn({'type': 'recipe', 'id': unshared_id}, owner_deleted)
+
+    def test_invalid_sync_token(self):
+        self.assertEqual(self.sync('abc').status_code, 400)
+
+class TestArchive(LoggedInUser, unittest.TestCase):
+    def setUp(self):
+        self.token = self.get_api_token('joker','phantomthieves')
+        owner = model.User.get_by_username('joker')
+        long_ago = datetime.utcnow() - timedelta(days=3650)
+        self.recipe = model.Recipe.create(owner, long_ago, True, True)
+        self.old = model.Edit.create(self.recipe, 'v1', '', '1 cup flour', 'bake', '', long_ago, owner)
+        self.head = model.Edit.create(self.recipe, 'v2', '', '2 cups flour', 'bake longer', '', long_ago + timedelta(days=1), owner)
+        self.experiment = model.Experiment.create(self.recipe, 'tried v1', 'too dry', long_ago, long_ago, owner)
+        model.db.session.add(self.recipe)
+        model.db.session.commit()
+        self.archived = ah.archive_old_bodies(older_than_days=3000)
+
+    def test_timeline_shows_stubs(self):
+        self.assertEqual(self.archived, 2) # the old edit and the experiment; never the current version
+        items = client.get(f'/api/recipes/{self.recipe.id}').json['timeline_items']
+        old, head = sorted(items['edits'], key=lambda edit: edit['id'])
+        self.assertTrue(old['is_archived'])
+        self.assertNotIn('ingredients', old)
+        self.assertEqual(head['ingredients'], '2 cups flour')
+        self.assertNotIn('notes', items['experiments'][0])
+
+    def test_body_endpoints(self):
+        response = client.get(f'/api/edits/{self.old.id}/body')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'id': self.old.id, 'ingredients': '1 cup flour', 'instructions': 'bake'})
+        self.assertEqual(client.get(f'/api/experiments/{self.experiment.id}/body').json['notes'], 'too dry')
+        self.assertEqual(client.get(f'/api/edits/{self.head.id}/body').json['ingredients'], '2 cups flour')
+
+    def test_checkout_and_delete_restore_bodies(self):
+        checkout = client.get(f'/api/recipes/{self.recipe.id}/checkout?edit={self.old.id}').json
+        self.assertEqual(checkout['edit']['ingredients'], '1 cup flour')
+        self.assertEqual(checkout['experiments'][0]['notes'], 'too dry')
+        response = client.delete(f'/api/edits/{self.head.id}', headers={'Authorization': f'Bearer {self.token}'})
+        self.assertEqual(response.status_code, 200)
+        old = model.Edit.get_by_id(self.old.id) # the current version again, so back in the hot table
+        self.assertFalse(old.is_archived)
+        self.assertEqual(old.ingredients, '1 cup flour')
+        self.assertIsNone(model.db.session.get(model.EditArchive, self.old.id))
+
+class TestBulkPermissions(LoggedInUser, unittest.TestCase):
+    def setUp(self):
+        self.token = self.get_api_token('joker','phantomthieves')
+        owner = model.User.get_by_username('joker')
+        self.ryuji = model.User.get_by_username('ryuji')
+        if not self.ryuji:
+            self.ryuji = model.User.create('ryuji@tokyo.com', 'phantomthieves', 'ryuji')
+        now = datetime.utcnow()
+        self.cookbook = [model.Recipe.create(owner, now, False, False) for _ in range(2)]
+        for recipe in self.cookbook:
+            model.Edit.create(recipe, 'Family recipe', '', 'ingredients', 'instructions', '', now, owner)
+        model.db.session.add_all(self.cookbook + [self.ryuji])
+        model.db.session.commit()
+        self.makotos_recipe_id = model.User.get_by_username('makoto').recipes[0].id
+
+    def post_batch(self, body):
+        return client.post('/api/permissions/batch', json=body, headers = {'Authorization': f'Bearer {self.token}'})
+
+    def test_share_cookbook(self):
+        response = self.post_batch({'operations': [
+            {'action': 'grant', 'recipe_id': recipe.id, 'username': username, 'can_experiment': True, 'can_edit': False}
+            for recipe in self.cookbook for username in ('makoto', 'ryuji')]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({(r['status'], r['outcome']) for r in response.json['results']}, {(201, 'created')})
+        for recipe in self.cookbook:
+            model.db.session.refresh(recipe)
+            self.assertEqual(recipe.collaborator_count, 2)
+            self.assertEqual(len(recipe.permissions), 2)
+
+        response = self.post_batch({'operations': [
+            {'action': 'grant', 'recipe_id': self.cookbook[0].id, 'user_id': self.ryuji.id, 'can_experiment': True, 'can_edit': True},
+            {'action': 'revoke', 'recipe_id': self.cookbook[1].id, 'username': 'makoto'},
+            {'action': 'revoke', 'recipe_id': self.cookbook[1].id, 'username': 'makoto'},
+        ], 'mode': 'partial'})
+        self.assertEqual([(r['status'], r.get('outcome')) for r in response.json['results']],
+                         [(200, 'updated'), (200, 'revoked'), (409, None)])
+        self.assertTrue(model.Permission.get_by_user_and_recipe(self.ryuji.id, self.cookbook[0].id).can_edit)
+        self.assertIsNone(model.Permission.get_by_user_and_recipe(2, self.cookbook[1].id))
+        model.db.session.refresh(self.cookbook[1])
+        self.assertEqual(self.cookbook[1].collaborator_count, 1)
+        revoke = self.post_batch({'operations': [{'action': 'revoke', 'recipe_id': self.cookbook[1].id, 'username': 'makoto'}]})
+        self.assertEqual(revoke.json['results'][0]['outcome'], 'not_shared')
+
+    def test_atomic_batch_rejected_as_a_whole(self):
+        response = self.post_batch({'operations': [
+            {'action': 'grant', 'recipe_id': self.cookbook[0].id, 'username': 'ryuji', 'can_experiment': True},
+            {'action': 'grant', 'recipe_id': self.makotos_recipe_id, 'username': 'ryuji', 'can_experiment': True},
+            {'action': 'grant', 'recipe_id': self.cookbook[1].id, 'username': 'nobody', 'can_experiment': True},
+            {'action': 'grant', 'recipe_id': self.cookbook[1].id, 'username': 'ryuji', 'can_edit': True},
+        ]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([result['status'] for result in response.json['results']], [424, 403, 404, 400])
+        self.assertIsNone(model.Permission.get_by_user_and_recipe(self.ryuji.id, self.cookbook[0].id))
+
+class TestCheckout(LoggedInUser, unittest.TestCase):
+    def setUp(self):
+        self.token = self.get_api_token('joker','phantomthieves')
+        owner = model.User.get_by_username('joker')
+        self.now = now = datetime.utcnow()
+        hour = timedelta(hours=1)
+        self.recipe = model.Recipe.create(owner, now, True, False)
+        self.v1 = model.Edit.create(self.recipe, 'v1', '', '1 cup flour', 'bake', '', now - hour*3, owner)
+        self.v2 = model.Edit.create(self.recipe, 'v2', '', '2 cups flour', 'bake', '', now - hour, owner)
+        model.Experiment.create(self.recipe, 'tried v1', '', now - hour*2, now - hour*2, owner)
+        model.Experiment.create(self.recipe, 'tried v2', '', now, now, owner)
+        model.db.session.add(self.recipe)
+        model.db.session.commit()
+
+    def checkout(self, query, token=None):
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        return client.get(f'/api/recipes/{self.recipe.id}/checkout?{query}', headers=headers)
+
+    def test_checkout_at_time(self):
+        response = self.checkout(f'at={(self.now - timedelta(hours=2)).isoformat()}', self.token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['title'], 'v1')
+        self.assertEqual(response.json['edit']['ingredients'], '1 cup flour')
+        self.assertEqual([e['commit_msg'] for e in response.json['experiments']], ['tried v1'])
+        self.assertFalse(response.json['is_current'])
+
+    def test_checkout_by_edit(self):
+        response = self.checkout(f'edit={self.v2.id}', self.token).json
+        self.assertEqual(response['title'], 'v2')
+        self.assertTrue(response['is_current'])
+        self.assertEqual([e['commit_msg'] for e in response['experiments']], ['tried v2'])
+        self.assertNotIn('experiments', self.checkout(f'edit={self.v2.id}').json) # experiments aren't public
+
+    def test_checkout_errors(self):
+        self.assertEqual(self.checkout(f'at={(self.now - timedelta(days=1)).isoformat()}').status_code, 404)
+        self.assertEqual(self.checkout('edit=999999').status_code, 404)
+        self.assertEqual(self.checkout('at=yesterday').status_code, 400)
+        self.assertEqual(self.checkout(f'edit={self.v1.id}&at={self.now.isoformat()}').status_code, 400)
+
+class TestFork(LoggedInUser, unittest.TestCase):
+    def setUp(self):
+        self.owner_token = self.get_api_token('joker','phantomthieves')
+        self.token = self.get_api_token('makoto','phantomthieves')
+        owner = model.User.get_by_username('joker')
+        now = datetime.utcnow()
+        self.parent = model.Recipe.create(owner, now)
+        model.Edit.create(self.parent, 'Parent v1', 'desc', 'old ingredients', 'old instructions', '', now - timedelta(hours=1), owner)
+        self.parent_head = model.Edit.create(self.parent, 'Parent v2', 'desc', 'ingredients', 'instructions', '', now, owner)
+        self.private_parent = model.Recipe.create(owner, now, False, False)
+        model.Edit.create(self.private_parent, 'Private', '', 'ingredients', 'instructions', '', now, owner)
+        model.db.session.add_all([self.parent, self.private_parent])
+        model.db.session.commit()
+
+    def fork(self, recipe_id, token):
+        return client.post(f'/api/recipes/{recipe_id}/fork', headers = {'Authorization': f'Bearer {token}'})
+
+    def test_fork_references_parent_content(self):
+        response = self.fork(self.parent.id, self.token)
+        self.assertEqual(response.status_code, 201)
+        child = model.Recipe.get_by_id(response.json['id'])
+        self.assertEqual(child.forked_from, self.parent.id)
+        self.assertEqual(child.owner.username, 'makoto')
+        self.assertEqual(child.edits[0].source_edit_id, self.parent_head.id)
+        self.assertIsNone(child.edits[0].ingredients) # not copied
+        timeline = client.get(f'/api/recipes/{child.id}', headers = {'Authorization': f'Bearer {self.token}'}).json
+        self.assertEqual(timeline['title'], 'Parent v2')
+        self.assertEqual(timeline['timeline_items']['edits'][0]['ingredients'], 'ingredients')
+
+    def test_fork_materialized_on_first_edit(self):
+        child_id = self.fork(self.parent.id, self.token).json['id']
+        client.post(f'/api/recipes/{child_id}/edits', json={'title': 'Child v1'},
+                    headers = {'Authorization': f'Bearer {self.token}'})
+        child = model.Recipe.get_by_id(child_id)
+        self.assertEqual(child.edits[0].title, 'Child v1')
+        self.assertIsNone(child.edits[1].source_edit_id)
+        self.assertEqual(child.edits[1].ingredients, 'ingredients')
+
+    def test_fork_materialized_when_source_deleted(self):
+        child_id = self.fork(self.parent.id, self.token).json['id']
+        response = client.delete(f'/api/edits/{self.parent_head.id}', headers = {'Authorization': f'Bearer {self.owner_token}'})
+        self.assertEqual(response.status_code, 200)
+        model.db.session.expire_all()
+        child_edit = model.Recipe.get_by_id(child_id).edits[0]
+        self.assertIsNone(child_edit.source_edit_id)
+        self.assertEqual(child_edit.title, 'Parent v2')
+
+    def test_shared_parent_deleted(self):
+        child_id = self.fork(self.parent.id, self.token).json['id']
+        model.db.session.add(model.Permission.create(2, self.parent.id))
+        model.db.session.commit()
+        response = client.delete(f'/api/recipes/{self.parent.id}', headers = {'Authorization': f'Bearer {self.owner_token}'})
+        self.assertEqual(response.status_code, 200)
+        model.db.session.expire_all()
+        self.assertIsNone(model.Permission.get_by_user_and_recipe(2, self.parent.id)) # ON DELETE CASCADE
+        child = model.Recipe.get_by_id(child_id)
+        self.assertIsNone(child.forked_from) # ON DELETE SET NULL
+        self.assertEqual(child.edits[0].title, 'Parent v2') # took its own copy first
+
+    def test_cant_fork_unviewable_recipe(self):
+        self.assertEqual(self.fork(self.private_parent.id, self.token).status_code, 403)
+        self.assertEqual(self.fork(self.private_parent.id, self.owner_token).status_code, 201) # owner can
+        self.assertEqual(self.fork(999999, self.token).status_code, 404)
+
+class TestSimilarRecipes(LoggedInUser, unittest.TestCase):
+    INSTRUCTIONS = ('Whisk the flour, sugar, baking powder and salt together in a large bowl. In another bowl beat the eggs '
+                    'with the buttermilk and melted butter until smooth. Pour the wet ingredients into the dry ones and stir '
+                    'until just combined; a few lumps are fine. Heat a greased pan over medium heat and cook a quarter cup '
+                    'of batter at a time until bubbles form, then flip and cook until golden.')
+    INGREDIENTS = '2 cups flour\n2 tbsp sugar\n2 tsp baking powder\n1 tsp salt\n2 eggs\n2 cups buttermilk\n3 tbsp butter'
+
+    def setUp(self):
+        self.token = self.get_api_token('makoto','phantomthieves')
+        self.headers = {'Authorization': f'Bearer {self.token}'}
+
+    def create(self, title: str, ingredients: str, instructions: str, is_public: bool = True) -> int:
+        response = client.post('/api/recipes', headers=self.headers, json={
+            'title': title, 'ingredients': ingredients, 'instructions': instructions, 'set_is_public': is_public})
+        self.assertEqual(response.status_code, 201)
+        return model.db.session.scalar(model.db.select(model.db.func.max(model.Recipe.id)))
+
+    def similar_ids(self, recipe_id: int, headers: dict | None = None) -> dict:
+        response = client.get(f'/api/recipes/{recipe_id}/similar', headers=headers or {})
+        self.assertEqual(response.status_code, 200)
+        return {recipe['id']: recipe['similarity'] for recipe in response.json['recipes']}
+
+    def test_near_duplicates_found(self):
+        original = self.create('Pancakes', self.INGREDIENTS, self.INSTRUCTIONS)
+        reimport = self.create('Fluffy pancakes', self.INGREDIENTS + '\n1 tsp vanilla',
+                               self.INSTRUCTIONS.replace('golden', 'golden brown'))
+        other = self.create('Salsa', '4 tomatoes\n1 onion\n1 lime', 'Chop everything finely, squeeze the lime over and season.')
+        similar = self.similar_ids(original)
+        self.assertIn(reimport, similar)
+        self.assertGreaterEqual(similar[reimport], 0.5)
+        self.assertNotIn(other, similar)
+        self.assertNotIn(original, similar)
+        # kept up to date: once the re-import is rewritten, it isn't a duplicate any more
+        client.post(f'/api/recipes/{reimport}/edits', headers=self.headers, json={
+            'title': 'Crepes', 'ingredients': '1 cup flour\n3 eggs\n1 cup milk', 'instructions': 'Blend, rest, swirl thin in a hot pan.'})
+        self.assertNotIn(reimport, self.similar_ids(original))
+
+    def test_only_visible_duplicates(self):
+        public = self.create('Pancakes', self.INGREDIENTS, self.INSTRUCTIONS)
+        private = self.create('My pancakes', self.INGREDIENTS, self.INSTRUCTIONS, is_public=False)
+        self.assertNotIn(private, self.similar_ids(public))
+        self.assertIn(private, self.similar_ids(public, self.headers))
+        self.assertEqual(client.get(f'/api/recipes/{private}/similar').status_code, 403)
+
+    def test_backfill_rebuilds_index(self):
+        original = self.create('Pancakes', self.INGREDIENTS, self.INSTRUCTIONS)
+        copy = self.create('Pancakes again', self.INGREDIENTS, self.INSTRUCTIONS)
+        model.RecipeBucket.query.delete()
+        model.RecipeSignature.query.delete()
+        model.db.session.commit()
+        self.assertEqual(self.similar_ids(original), {})
+        self.assertGreater(sim.backfill_index(batch_size=2), 0)
+        self.assertEqual(self.similar_ids(original).get(copy), 1.0)
+
+class TestIngredientSearch(LoggedInUser, unittest.TestCase):
+    def setUp(self):
+        self.token = self.get_api_token('makoto','phantomthieves')
+        for title, ingredients in (('Buttermilk pancakes', '1 cup buttermilk\n2 large eggs\n1 1/2 cups flour'),
+                                   ('Eggless scones', '- 3/4 cup Buttermilk\n2 cups flour')):
+            client.post('/api/recipes', json={'title': title, 'ingredients': ingredients, 'instructions': 'Bake'},
+                        headers = {'Authorization': f'Bearer {self.token}'})
+
+    def search(self, query):
+        return client.get(f'/api/recipes/search?{query}', headers = {'Authorization': f'Bearer {self.token}'})
+
+    def test_search_with_and_without(self):
+        response = self.search('with=buttermilk&without=eggs')
+        self.assertEqual(response.status_code, 200)
+        titles = {recipe['title'] for recipe in response.json['recipes']}
+        self.assertIn('Eggless scones', titles)
+        self.assertNotIn('Buttermilk pancakes', titles)
+        titles = {recipe['title'] for recipe in self.search('with=egg,flour').json['recipes']}
+        self.assertIn('Buttermilk pancakes', titles)
+        self.assertNotIn('Eggless scones', titles)
+
+    def test_search_needs_an_ingredient(self):
+        self.assertEqual(self.search('without=eggs').status_code, 400)
+
+    def test_index_follows_current_version(self):
+        recipe = model.Recipe.query.join(model.Edit).filter(model.Edit.title == 'Eggless scones').first()
+        client.post(f'/api/recipes/{recipe.id}/edits', json={'title': 'Eggless scones', 'ingredients': '1 cup cream'},
+                    headers = {'Authorization': f'Bearer {self.token}'})
+        self.assertNotIn(recipe.id, [r['id'] for r in self.search('with=buttermilk').json['recipes']])
+        self.assertIn(recipe.id, [r['id'] for r in self.search('with=cream').json['recipes']])
+
+    def test_backfill(self):
+        user = model.User.get_by_username('makoto')
+        recipe = model.Recipe.create(user, datetime.utcnow())
+        model.Edit.create(recipe, 'Unindexed', '', '2 tbsp tahini', '', '', datetime.utcnow(), user)
+        model.db.session.add(recipe)
+        model.db.session.commit()
+        self.assertEqual(self.search('with=tahini').json['recipes'], [])
+        ih.backfill_index(batch_size=2)
+        self.assertEqual([r['id'] for r in self.search('with=tahini').json['recipes']], [recipe.id])
+
+    def test_parse_ingredient_line(self):
+        self.assertEqual(ih.parse_ingredient_line('1½ Tbsp sugar'),
+                         {'name': 'sugar', 'term': 'sugar', 'quantity': 1.5, 'unit': 'tbsp'})
+        self.assertEqual(ih.parse_ingredient_line('2 large Eggs, beaten'),
+                         {'name': 'large egg', 'term': 'egg', 'quantity': 2, 'unit': None})
+        self.assertEqual(ih.parse_ingredient_line('1/0 cup flour'),
+                         {'name': 'flour', 'term': 'flour', 'quantity': None, 'unit': 'cup'})
+
+class TestResponseCompression(unittest.TestCase):
+    def test_streamed_timeline_gzipped_when_accepted(self):
+        plain = client.get('/api/recipes/3')
+        self.assertTrue(plain.is_streamed)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        compressed = client.get('/api/recipes/3', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', compressed.headers['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(compressed.data)), plain.json)
+
+    def test_streamed_profile_matches_unstreamed_json(self):
+        response = client.get('/api/users/joker', headers={'Accept-Encoding': 'gzip'})
+        profile = json.loads(gzip.decompress(response.data))
+        self.assertEqual(profile['username'], 'joker')
+        self.assertTrue(all(recipe['is_public'] for recipe in profile['recipes']))
+
+    def test_small_responses_not_compressed(self):
+        response = client.get('/api/recipes/1', headers={'Accept-Encoding': 'gzip'}) # 403, tiny body
+        self.assertNotIn('Content-Encoding', response.headers)
+
+class TestSparseFields(LoggedInUser, unittest.TestCase):
+    def setUp(self):
+        self.token = self.get_api_token('joker','phantomthieves')
+        model.db.session.expire_all()
+
+    def test_summary_timeline_leaves_bodies_in_db(self):
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(model.db.engine, 'before_cursor_execute', record)
+        try:
+            timeline = client.get('/api/recipes/3?view=summary').json # streamed: read before the next request
+            profile = client.get('/api/users/joker?view=summary', headers = {'Authorization': f'Bearer {self.token}'}).json
+        finally:
+            event.remove(model.db.engine, 'before_cursor_execute', record)
+        edit = timeline['timeline_items']['edits'][0]
+        experiment = timeline['timeline_items']['experiments'][0]
+        self.assertEqual(edit['title'], 'Recipe 2')
+        self.assertNotIn('ingredients', edit)
+        self.assertNotIn('notes', experiment)
+        self.assertNotIn('description', timeline)
+        self.assertNotIn('description', profile['recipes'][0])
+        self.assertFalse(any('edits.instructions' in statement or 'experiments.notes' in statement for statement in statements))
+
+    def test_fields_on_timeline_and_profile(self):
+        timeline = client.get('/api/recipes/3?fields=title,commit_date').json
+        self.assertEqual(set(timeline['timeline_items']['edits'][0]), {'id', 'item_type', 'title', 'commit_date'})
+        self.assertEqual(set(timeline) - {'timeline_items', 'can_edit', 'can_experiment'}, {'id', 'title'})
+        profile = client.get('/api/users/joker?fields=title,last_modified',
+                             headers = {'Authorization': f'Bearer {self.token}'}).json
+        self.assertEqual(set(profile['recipes'][0]), {'id', 'title', 'last_modified'})
+        self.assertEqual(profile['username'], 'joker')
+
+    def test_fieldsets_cached_separately(self):
+        summary = client.get('/api/users/joker?view=summary').json['recipes']
+        full = client.get('/api/users/joker').json['recipes']
+        self.assertNotIn('description', summary[0])
+        self.assertIn('description', full[0])
+
+    def test_unknown_fields_rejected(self):
+        self.assertEqual(client.get('/api/recipes/3?fields=title,secret').status_code, 400)
+        self.assertEqual(client.get('/api/recipes?view=tiny').status_code, 400)
+
+class TestListRows(LoggedInUser, unittest.TestCase):
+    def setUp(self):
+        self.token = self.get_api_token('makoto','phantomthieves')
+        joker = model.User.get_by_username('joker')
+        now = datetime.utcnow()
+        self.parent = model.Recipe.create(joker, now)
+        model.Edit.create(self.parent, 'Parent v1', 'desc', 'ingredients', 'instructions', '', now - timedelta(hours=1), joker)
+        model.Edit.create(self.parent, 'Parent v2', 'desc', 'more ingredients', 'instructions', '', now, joker)
+        model.Experiment.create(self.parent, 'Tried it', 'notes', now, now, joker)
+        model.db.session.add(self.parent)
+        model.db.session.commit()
+        self.child_id = client.post(f'/api/recipes/{self.parent.id}/fork', headers = {'Authorization': f'Bearer {self.token}'}).json['id']
+        model.db.session.expire_all()
+
+    def test_recipe_cards_match_to_dict(self):
+        makoto = model.User.get_by_username('makoto')
+        cards = {card['id']: card for card in dh.iter_rows(ph.select_own_cards(makoto.id), dh.RecipeCard)}
+        self.assertEqual(cards, {recipe.id: recipe.to_dict() for recipe in makoto.recipes})
+        self.assertEqual(cards[self.child_id]['forked_from_username'], 'joker')
+        self.assertEqual(cards[self.child_id]['title'], self.parent.to_dict()['title']) # from the parent's edit
+
+    def test_timeline_rows_match_to_dict(self):
+        for recipe_id in (self.child_id, self.parent.id):
+            recipe = model.Recipe.get_by_id(recipe_id)
+            edits = list(dh.iter_rows(dh.select_edit_rows(recipe_id), dh.EditRow))
+            experiments = list(dh.iter_rows(dh.select_experiment_rows(recipe_id), dh.ExperimentRow))
+            self.assertEqual(edits, [edit.to_dict() for edit in recipe.edits])
+            self.assertEqual(experiments, [experiment.to_dict() for experiment in recipe.experiments])
+        self.assertEqual(edits[0]['commit_by'], 'joker')
+        self.assertIn('commit_by_avatar', edits[0])
+
+    def test_profile_reads_no_edit_bodies(self):
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(model.db.engine, 'before_cursor_execute', record)
+        try:
+            profile = client.get('/api/users/makoto', headers = {'Authorization': f'Bearer {self.token}'}).json
+        finally:
+            event.remove(model.db.engine, 'before_cursor_execute', record)
+        self.assertIn(self.child_id, [recipe['id'] for recipe in profile['recipes']])
+        self.assertFalse(any('edits.ingredients' in statement or 'edits.instructions' in statement for statement in statements))
+
+class TestQueryBudgets(QueryBudget, LoggedInUser, unittest.TestCase):
+    def setUp(self):
+        self.user = model.User.get_by_username('budget')
+        if not self.user:
+            self.user = model.User.create(email='budget@tokyo.com', password='phantomthieves', username='budget')
+            model.db.session.add(self.user)
+            model.db.session.commit()
+        self.token = self.get_api_token('budget', 'phantomthieves')
+        self.auth = {'Authorization': f'Bearer {self.token}'}
+        makoto = model.User.get_by_username('makoto')
+        now = datetime.utcnow()
+        self.recipe = model.Recipe.create(self.user, now)
+        self.head = model.Edit.create(self.recipe, 'Budget v1', 'desc', '2 cups flour', 'instructions', '', now, self.user)
+        model.Experiment.create(self.recipe, 'Tried it', 'notes', now, now, self.user)
+        model.db.session.add(self.recipe)
+        model.db.session.flush()
+        ih.index_edit(self.head)
+        sim.index_edit(self.head)
+        self.pending = model.Edit.create(self.recipe, 'Budget v2', '', '', '', '', now, makoto, pending_approval=True)
+        model.db.session.add(self.pending)
+        model.db.session.commit()
+        self.cursor = sh.oldest_running_txid() # where a stream opened now would start
+        rc.cache.reset()
+        model.db.session.expire_all()
+
+    def tearDown(self):
+        app.config['EVENTS_STREAM_SECONDS'] = 300
+        if hasattr(self, 'grown'): # so later tests don't have to wade through it
+            users, recipes, edits, experiments = self.grown
+            model.db.session.rollback()
+            for model_class, ids in ((model.Edit, edits), (model.Experiment, experiments), (model.Recipe, recipes)):
+                model.db.session.execute(delete(model_class).where(model_class.id.in_(ids)))
+            model.db.session.execute(delete(model.Permission).where(model.Permission.user_id.in_(users)))
+            model.db.session.execute(delete(model.User).where(model.User.id.in_(users)))
+            model.db.session.commit()
+
+    def grow(self, n):
+        """Give the user n more recipes, n more shared with them, and n more edits, experiments and collaborators on self.recipe"""
+        now = datetime.utcnow()
+        makoto = model.User.get_by_username('makoto')
+        users = model.db.session.scalars(insert(model.User).returning(model.User.id), [
+            {'email': f'budget{self.recipe.id}-{i}@tokyo.com', 'username': f'budget{self.recipe.id}-{i}', 'password': ''} for i in range(n)]).all()
+        recipes = model.db.session.scalars(insert(model.Recipe).returning(model.Recipe.id), [
+            {'user_id': owner_id, 'last_modified': now - timedelta(minutes=i), 'is_public': True, 'is_experiments_public': True}
+            for owner_id in (self.user.id, makoto.id) for i in range(n)]).all()
+        edits = model.db.session.scalars(insert(model.Edit).returning(model.Edit.id), [
+            {'recipe_id': recipe_id, 'title': f'Recipe {i}', 'ingredients': '2 cups flour', 'instructions': 'mix', 'commit_date': now,
+             'commit_by': self.user.id} for i, recipe_id in enumerate([*recipes, *[self.recipe.id] * n])]).all()
+        experiments = model.db.session.scalars(insert(model.Experiment).returning(model.Experiment.id), [
+            {'recipe_id': self.recipe.id, 'commit_msg': f'try {i}', 'notes': 'fine', 'commit_date': now - timedelta(minutes=i),
+             'commit_by': self.user.id} for i in range(n)]).all()
+        self.grown = (users, recipes, edits[len(recipes):], experiments)
+        model.db.session.execute(insert(model.Permission), [
+            *({'user_id': self.user.id, 'recipe_id': recipe_id, 'can_experiment': True, 'can_edit': False} for recipe_id in recipes[n:]),
+            *({'user_id': user_id, 'recipe_id': self.recipe.id, 'can_experiment': True, 'can_edit': False} for user_id in users)])
+        model.db.session.commit()
+        ih.backfill_index()
+        sim.backfill_index()
+        rc.cache.reset()
+        model.db.session.expire_all()
+
+    def reads(self):
+        recipe_ids = ','.join(str(recipe.id) for recipe in self.user.recipes[:100])
+        return [('GET', '/api/users/budget', self.auth), ('GET', '/api/users/budget', {}),
+                ('GET', f'/api/recipes/{self.recipe.id}', self.auth), ('GET', f'/api/recipes/{self.recipe.id}', {}),
+                ('GET', f'/api/recipes/{self.recipe.id}/checkout?edit={self.head.id}', self.auth),
+                ('GET', f'/api/recipes?ids={recipe_ids}', self.auth), ('GET', '/api/recipes', {}),
+                ('GET', f'/api/recipes/{self.recipe.id}/permissions', self.auth),
+                ('GET', f'/api/recipes/{self.recipe.id}/pending-edits', self.auth),
+                ('GET', f'/api/recipes/{self.recipe.id}/similar', self.auth), ('GET', '/api/recipes/search?with=flour', self.auth),
+                ('GET', f'/api/edits/{self.head.id}/body', self.auth), ('GET', '/api/feed', self.auth),
+                ('GET', '/api/sync', self.auth), ('GET', '/api/me', self.auth), ('GET', '/api/users', {}),
+                ('GET', f'/api/recipes/{self.recipe.id}/events', {**self.auth, 'Last-Event-ID': str(self.cursor)})]
+
+    def test_over_budget_lists_statements(self):
+        with mock.patch.dict(QUERY_BUDGETS, get_user=0):
+            with self.assertRaises(AssertionError) as raised:
+                self.request_within_budget('GET', '/api/me', headers=self.auth)
+        self.assertIn('(get_user) sent 1 SQL statements, over its budget of 0', str(raised.exception))
+        self.assertIn('1. SELECT users.id', str(raised.exception))
+
+    def test_every_endpoint_has_a_budget(self):
+        views = {rule.endpoint.rpartition('.')[2] for rule in client.application.url_map.iter_rules() if rule.endpoint != 'static'}
+        self.assertEqual(views - set(QUERY_BUDGETS), set())
+
+    def test_reads_within_budget_at_any_size(self):
+        app.config['EVENTS_STREAM_SECONDS'] = 0 # one pass over what's there, then the stream ends
+        for n in (0, 500):
+            if n:
+                self.grow(n)
+            for method, url, headers in self.reads():
+                self.assertEqual(self.request_within_budget(method, url, headers=headers).status_code, 200, url)
+
+    def test_writes_within_budget_at_any_size(self):
+        makoto = model.User.get_by_username('makoto')
+        for n in (0, 500):
+            if n:
+                self.grow(n)
+                self.pending = model.Edit.create(self.recipe, 'Budget v3', '', '', '', '', datetime.utcnow(), makoto, pending_approval=True)
+                model.db.session.add(self.pending)
+                model.db.session.commit()
+            recipe_url = f'/api/recipes/{self.recipe.id}'
+            self.request_within_budget('POST', '/api/recipes', headers=self.auth,
+                                       json={'title': 'Budgeted', 'ingredients': '1 egg', 'instructions': 'Boil'})
+            created = model.db.session.scalar(model.db.select(model.db.func.max(model.Recipe.id)))
+            edit_id = self.request_within_budget('POST', f'{recipe_url}/edits', headers=self.auth, json={'title': 'Budget v4'}).json['id']
+            exp_id = self.request_within_budget('POST', f'{recipe_url}/experiments', headers=self.auth, json={'commit_msg': 'try'}).json['id']
+            for method, url, body in [('POST', f'{recipe_url}/permissions', {'username': 'makoto', 'can_experiment': True}),
+                                      ('PUT', f'{recipe_url}/permissions/{makoto.id}', {'can_experiment': True, 'can_edit': True}),
+                                      ('PUT', f'{recipe_url}/permissions', {'is_public': True, 'is_experiments_public': True}),
+                                      ('DELETE', f'{recipe_url}/permissions/{makoto.id}', None),
+                                      ('POST', f'/api/edits/{self.pending.id}/approve', None),
+                                      ('POST', f'{recipe_url}/fork', None),
+                                      ('DELETE', f'/api/experiments/{exp_id}', None),
+                                      ('DELETE', f'/api/edits/{edit_id}', None),
+                                      ('DELETE', f'/api/recipes/{created}', None)]:
+                self.assertLess(self.request_within_budget(method, url, headers=self.auth, json=body).status_code, 300, url)
+
+    def test_account_and_batch_routes_within_budget(self):
+        experiment_id = self.recipe.experiments[0].id
+        stub = StubUpstream().start()
+        app.config['HTTP_UPSTREAMS'] = {name: {'base_url': stub.url} for name in ('spoonacular', 'cloudinary')}
+        outbound.reset()
+        try:
+            for method, url, kwargs in [
+                    ('POST', f'/api/edits/{self.pending.id}/reject', {'headers': self.auth}),
+                    ('GET', f'/api/experiments/{experiment_id}/body', {'headers': self.auth}),
+                    ('POST', '/api/batch', {'headers': self.auth, 'json': {'operations': [
+                        {'type': 'experiment', 'recipe_id': self.recipe.id, 'commit_msg': 'Offline'},
+                        {'type': 'edit', 'recipe_id': self.recipe.id, 'title': 'Offline title'}]}}),
+                    ('POST', '/api/permissions/batch', {'headers': self.auth, 'json': {'operations': [
+                        {'action': 'grant', 'recipe_id': self.recipe.id, 'username': 'makoto', 'can_experiment': True, 'can_edit': False}]}}),
+                    ('GET', '/api/extract-recipe?url=https://example.com/pancakes', {'headers': self.auth}),
+                    ('GET', '/api/metrics', {}),
+                    ('POST', '/api/users', {'json': {'email': f'leaving{self.recipe.id}@tokyo.com', 'username': f'leaving{self.recipe.id}',
+                                                     'password': 'phantomthieves'}})]:
+                self.assertLess(self.request_within_budget(method, url, **kwargs).status_code, 300, url)
+            leaving = model.User.get_by_username(f'leaving{self.recipe.id}')
+            response = self.request_within_budget('POST', '/api/tokens', auth=(leaving.username, 'phantomthieves'))
+            leaving_auth = {'Authorization': f'Bearer {response.json["token"]}'}
+            for method, url, kwargs in [('PATCH', f'/api/users/{leaving.id}', {'headers': leaving_auth, 'json': {'img_url': 'https://example.com/a.png'}}),
+                                        ('PATCH', f'/api/users/{leaving.id}', {'headers': leaving_auth, 'data': {'img_file': (io.BytesIO(b'png'), 'a.png')}}),
+                                        ('DELETE', f'/api/users/{leaving.id}', {'headers': leaving_auth})]:
+                response = self.request_within_budget(method, url, **kwargs)
+                self.assertLess(response.status_code, 300, url)
+            self.assertEqual(self.request_within_budget('GET', response.headers['Location']).json['status'], 'done')
+            self.assertEqual(self.request_within_budget('DELETE', '/api/tokens', headers=self.auth).status_code, 204)
+        finally:
+            app.config['HTTP_UPSTREAMS'] = {}
+            outbound.reset()
+            stub.stop()
+
+class TestBatchRead(LoggedInUser, unittest.TestCase):
+    def setUp(self):
+        self.token = self.get_api_token('makoto','phantomthieves')
+        owner = model.User.get_by_username('joker')
+        reader = model.User.get_by_username('makoto')
+        now = datetime.utcnow()
+        self.private, self.public, self.shared = [model.Recipe.create(owner, now, is_public) for is_public in (False, True, False)]
+        self.forks = [model.Recipe.create(reader, now, True) for _ in range(4)]
+        for recipe in (self.private, self.public, self.shared, *self.forks):
+            model.Edit.create(recipe, f'Batch {recipe is self.public}', '', 'ingredients', 'instructions', '', now, recipe.owner)
+        model.db.session.add_all([self.private, self.public, self.shared, *self.forks])
+        model.db.session.flush()
+        for fork in self.forks:
+            fork.forked_from = self.public.id
+        model.db.session.add(model.Permission(user_id=reader.id, recipe_id=self.shared.id, can_experiment=False, can_edit=False))
+        model.db.session.commit()
+
+    def get_batch(self, ids: list[int], query: str = ''):
+        return client.get(f'/api/recipes?ids={",".join(map(str, ids))}{query}',
+                          headers = {'Authorization': f'Bearer {self.token}'})
+
+    def test_statuses_per_id(self):
+        response = self.get_batch([self.public.id, self.private.id, self.shared.id, self.forks[0].id, 10**6, self.public.id])
+        self.assertEqual(response.status_code, 200)
+        results = response.json['results']
+        self.assertEqual([result['status'] for result in results], [200, 403, 200, 200, 404])
+        self.assertEqual(results[0]['recipe']['title'], 'Batch True')
+        self.assertNotIn('recipe', results[1])
+        self.assertEqual(results[3]['recipe']['forked_from_username'], 'joker')
+
+    def test_anonymous_sees_public_only(self):
+        results = client.get(f'/api/recipes?ids={self.public.id},{self.shared.id}').json['results']
+        self.assertEqual([result['status'] for result in results], [200, 403])
+
+    def test_queries_dont_grow_with_batch(self):
+        def count_queries(ids):
+            statements = []
+            record = lambda *args: statements.append(args[2])
+            model.db.session.expunge_all()
+            event.listen(model.db.engine, 'before_cursor_execute', record)
+            try:
+                self.assertEqual(self.get_batch(ids).status_code, 200)
+            finally:
+                event.remove(model.db.engine, 'before_cursor_execute', record)
+            return len(statements)
+        public_id, private_id, shared_id, fork_ids = self.public.id, self.private.id, self.shared.id, [fork.id for fork in self.forks]
+        few = count_queries([public_id, fork_ids[0]])
+        many = count_queries([public_id, private_id, shared_id] + fork_ids)
+        self.assertEqual(few, many)
+
+    def test_summary_and_limits(self):
+        recipe = self.get_batch([self.public.id], '&view=summary').json['results'][0]['recipe']
+        self.assertEqual(recipe['title'], 'Batch True')
+        self.assertNotIn('description', recipe)
+        self.assertEqual(self.get_batch(list(range(1, 102))).status_code, 413)
+        self.assertEqual(client.get('/api/recipes?ids=1,two').status_code, 400)
+
+class TestLiveEvents(LoggedInUser, unittest.TestCase):
+    def setUp(self):
+        self.token = self.get_api_token('joker','phantomthieves')
+        owner = model.User.get_by_username('joker')
+        recipe = model.Recipe.create(owner, datetime.utcnow(), is_public=True, is_experiments_public=False)
+        model.Edit.create(recipe, 'Live v1', '', 'ingredients', 'instructions', '', datetime.utcnow(), owner)
+        model.db.session.add(recipe)
+        model.db.session.commit()
+        self.recipe_id = recipe.id
+        self.cursor = sh.oldest_running_txid() # where a stream opened now would start
+
+    def tearDown(self):
+        app.config['EVENTS_STREAM_SECONDS'] = 300
+        app.config['EVENTS_MAX_STREAMS'] = 12
+
+    def read_events(self, headers: dict) -> str:
+        app.config['EVENTS_STREAM_SECONDS'] = 0 # one pass over what's there, then the stream ends
+        response = client.get(f'/api/recipes/{self.recipe_id}/events', headers=headers)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        return response.get_data(as_text=True)
+
+    def test_replay_respects_visibility(self):
+        client.post(f'/api/recipes/{self.recipe_id}/experiments', json={'commit_msg': 'Private try'},
+                    headers = {'Authorization': f'Bearer {self.token}'})
+        client.post(f'/api/recipes/{self.recipe_id}/edits', json={'title': 'Live v2'},
+                    headers = {'Authorization': f'Bearer {self.token}'})
+        own = self.read_events({'Authorization': f'Bearer {self.token}', 'Last-Event-ID': str(self.cursor)})
+        self.assertIn('"commit_msg":"Private try"', own)
+        self.assertIn('"title":"Live v2"', own)
+        public = self.read_events({'Last-Event-ID': str(self.cursor)})
+        self.assertIn('"title":"Live v2"', public)
+        self.assertNotIn('Private try', public)
+
+    def test_slow_transaction_not_skipped_on_reconnect(self):
+        auth = {'Authorization': f'Bearer {self.token}'}
+        with model.db.engine.connect() as slow:
+            with slow.begin():
+                exp_id = slow.scalar(insert(model.Experiment).values(recipe_id=self.recipe_id, commit_msg='Slow try', commit_date=datetime.utcnow())
+                                     .returning(model.Experiment.id))
+                slow.execute(insert(model.Change), [model.item_change_row('experiment', self.recipe_id, exp_id)])
+                client.post(f'/api/recipes/{self.recipe_id}/edits', json={'title': 'Live v2'}, headers=auth)
+                first = self.read_events({**auth, 'Last-Event-ID': str(self.cursor)})
+        self.assertNotIn('Slow try', first)
+        last_id = (re.findall(r'^id: (\d+)$', first, re.MULTILINE) or [str(self.cursor)])[-1] # as EventSource would reconnect
+        self.assertIn('"commit_msg":"Slow try"', self.read_events({**auth, 'Last-Event-ID': last_id}))
+
+    def test_pushed_when_committed(self):
+        import threading
+        app.config['EVENTS_STREAM_SECONDS'] = 5
+        response = client.get(f'/api/recipes/{self.recipe_id}/events', headers = {'Authorization': f'Bearer {self.token}',
+                                                                                   'Last-Event-ID': str(self.cursor)})
+        chunks = (chunk.decode() for chunk in response.response)
+        self.assertTrue(next(chunks).startswith('retry:')) # subscribed by now
+        def commit_experiment():
+            with app.app_context():
+                recipe = model.db.session.get(model.Recipe, self.recipe_id)
+                model.db.session.add(model.Experiment.create(recipe, 'Live try', '', datetime.utcnow(), None, recipe.owner))
+                model.db.session.commit()
+        writer = threading.Thread(target=commit_experiment)
+        writer.start()
+        try:
+            self.assertIn('"commit_msg":"Live try"', next(chunk for chunk in chunks if 'event:' in chunk))
+        finally:
+            writer.join()
+            response.close()
+        self.assertEqual(client.get('/api/metrics').json['event_streams'], 0)
+
+    def test_too_many_streams(self):
+        app.config['EVENTS_MAX_STREAMS'] = 0
+        response = client.get(f'/api/recipes/{self.recipe_id}/events')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+
+class TestIdempotency(LoggedInUser, unittest.TestCase):
+    def setUp(self):
+        self.token = self.get_api_token('joker','phantomthieves')
+        self.owner_id = model.User.get_by_username('joker').id
+
+    def tearDown(self):
+        app.config['DEADLINE_BUDGETS'] = {}
+
+    def post_experiment(self, key: str, commit_msg: str = 'Retried'):
+        return client.post('/api/recipes/1/experiments', json={'commit_msg': commit_msg},
+                           headers={'Authorization': f'Bearer {self.token}', 'Idempotency-Key': key})
+
+    def test_retry_replays_first_response(self):
+        initial_count = model.Experiment.query.count()
+        key = f'retry-{datetime.utcnow().timestamp()}'
+        first = self.post_experiment(key)
+        retry = self.post_experiment(key)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual((retry.status_code, retry.json), (first.status_code, first.json))
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(model.Experiment.query.count(), initial_count + 1, "The retry shouldn't create another")
+        # another key is another request
+        self.assertEqual(self.post_experiment(f'{key}-2').status_code, 200)
+        self.assertEqual(model.Experiment.query.count(), initial_count + 2)
+
+    def test_key_reused_for_other_request(self):
+        key = f'reused-{datetime.utcnow().timestamp()}'
+        self.assertEqual(self.post_experiment(key).status_code, 200)
+        self.assertEqual(self.post_experiment(key, 'Something else').status_code, 422)
+
+    def test_duplicate_waits_for_first(self):
+        key = f'pending-{datetime.utcnow().timestamp()}'
+        first = self.post_experiment(key) # then make it look like it's still running
+        model.IdempotencyKey.query.filter_by(user_id=self.owner_id, key=key).update({'status_code': None})
+        model.db.session.commit()
+        app.config['DEADLINE_BUDGETS'] = {'create_new_exp': 0.2}
+        self.assertEqual(self.post_experiment(key).status_code, 409)
+        model.IdempotencyKey.query.filter_by(user_id=self.owner_id, key=key).update({'status_code': 200})
+        model.db.session.commit()
+        self.assertEqual(self.post_experiment(key).json, first.json)
+
+    def test_expired_keys_pruned(self):
+        now = datetime.utcnow()
+        model.db.session.add(model.IdempotencyKey(user_id=self.owner_id, key='expired', request_hash='', status_code=200,
+                                                  created_at=now - timedelta(days=2), expires_at=now - timedelta(days=1)))
+        model.db.session.commit()
+        self.assertEqual(self.post_experiment(f'prune-{now.timestamp()}').status_code, 200)
+        self.assertIsNone(model.db.session.get(model.IdempotencyKey, (self.owner_id, 'expired')), 'Storing a response prunes')
+
+class TestPendingEdits(LoggedInUser, unittest.TestCase):
+    def setUp(self):
+        self.owner_token = self.get_api_token('joker','phantomthieves')
+        self.token = self.get_api_token('makoto','phantomthieves')
+        owner = model.User.get_by_username('joker')
+        self.recipe = model.Recipe.create(owner, datetime.utcnow(), False, False)
+        model.Edit.create(self.recipe, 'Original', '', 'ingredients', 'instructions', '', datetime.utcnow(), owner)
+        model.db.session.add(self.recipe)
+        model.db.session.flush()
+        model.db.session.add(model.Permission.create(model.User.get_by_username('makoto').id, self.recipe.id, True, False))
+        model.db.session.commit()
+
+    def propose(self, title):
+        return client.post(f'/api/recipes/{self.recipe.id}/edits', json={'title': title},
+                           headers = {'Authorization': f'Bearer {self.token}'})
+
+    def pending(self, token):
+        return client.get(f'/api/recipes/{self.recipe.id}/pending-edits', headers = {'Authorization': f'Bearer {token}'})
+
+    def test_proposed_edit_waits_for_approval(self):
+        response = self.propose('Proposed')
+        self.assertEqual(response.status_code, 202)
+        timeline = client.get(f'/api/recipes/{self.recipe.id}', headers = {'Authorization': f'Bearer {self.token}'}).json
+        self.assertEqual(timeline['title'], 'Original')
+        self.assertEqual([edit['title'] for edit in timeline['timeline_items']['edits']], ['Original'])
+        self.assertEqual([edit['title'] for edit in self.pending(self.owner_token).json['edits']], ['Proposed'])
+        self.assertEqual(self.pending(self.token).status_code, 403)
+
+        approved = client.post(f'/api/edits/{response.json["id"]}/approve', headers = {'Authorization': f'Bearer {self.owner_token}'})
+        self.assertEqual(approved.status_code, 200)
+        model.db.session.expire_all()
+        self.assertEqual(self.recipe.to_dict()['title'], 'Proposed')
+        self.assertEqual(self.recipe.edit_count, 1) # only approved edits count; seeded edit wasn't counted
+        self.assertEqual(self.pending(self.owner_token).json['edits'], [])
+        self.assertEqual(client.post(f'/api/edits/{response.json["id"]}/approve',
+                                     headers = {'Authorization': f'Bearer {self.owner_token}'}).status_code, 409)
+
+    def test_reject_and_withdraw(self):
+        rejected_id = self.propose('Rejected').json['id']
+        withdrawn_id = self.propose('Withdrawn').json['id']
+        self.assertEqual(client.post(f'/api/edits/{rejected_id}/reject', 
+                                     headers = {'Authorization': f'Bearer {self.token}'}).status_code, 403)
+        self.assertEqual(client.post(f'/api/edits/{rejected_id}/reject', 
+                                     headers = {'Authorization': f'Bearer {self.owner_token}'}).status_code, 200)
+        self.assertEqual(client.delete(f'/api/edits/{withdrawn_id}', 
+                                       headers = {'Authorization': f'Bearer {self.token}'}).status_code, 200)
+        self.assertEqual(self.pending(self.owner_token).json['edits'], [])
+        self.assertEqual(model.Recipe.get_by_id(self.recipe.id).to_dict()['title'], 'Original')
+
+    def test_temp_user_logout_leaves_edit_count(self):
+        guest = model.User.create('guest@tokyo.com', 'phantomthieves', 'guest', True)
+        model.db.session.add(guest)
+        model.db.session.flush()
+        model.db.session.add(model.Permission.create(guest.id, self.recipe.id, True, False))
+        model.db.session.commit()
+        guest_token = self.get_api_token('guest', 'phantomthieves')
+        response = client.post(f'/api/recipes/{self.recipe.id}/edits', json={'title': 'Guest proposal'},
+                               headers = {'Authorization': f'Bearer {guest_token}'})
+        self.assertEqual(response.status_code, 202)
+        edit_count = model.Recipe.get_by_id(self.recipe.id).edit_count
+        self.assertEqual(client.delete('/api/tokens', headers = {'Authorization': f'Bearer {guest_token}'}).status_code, 204)
+        model.db.session.expire_all()
+        self.assertEqual(model.Recipe.get_by_id(self.recipe.id).edit_count, edit_count)
+        self.assertEqual(self.pending(self.owner_token).json['edits'], [])
+
+class TestRateLimit(unittest.TestCase):
+    def setUp(self):
+        app.config['RATELIMIT_ENABLED'] = True
+        app.config['RATELIMIT_BUDGETS'] = {'login': {'ip': (2, 60)}, 'signup': {'ip': (1, 60)}}
+        limiter.reset()
+
+    def tearDown(self):
+        app.config['RATELIMIT_ENABLED'] = False
+        app.config['RATELIMIT_BUDGETS'] = {}
+        limiter.reset()
+
+    def test_login_throttled_per_ip(self):
+        for _ in range(2):
+            self.assertEqual(client.post('/api/tokens', auth=('joker', 'phantomthieves')).status_code, 200)
+        response = client.post('/api/tokens', auth=('joker', 'phantomthieves'))
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response.headers['Retry-After']), 0)
+        # other routes aren't affected
+        self.assertEqual(client.get('/api/recipes/3').status_code, 200)
+
+    def test_clients_behind_proxy_throttled_separately(self):
+        def signup(forwarded_for):
+            return client.post('/api/users', json={}, headers={'X-Forwarded-For': forwarded_for}).status_code
+        self.assertNotEqual(signup('203.0.113.1'), 429)
+        self.assertNotEqual(signup('203.0.113.2'), 429)
+        self.assertEqual(signup('203.0.113.1'), 429)
+        # only the address our proxy added is trusted, not ones the client sent ahead of it
+        self.assertEqual(signup('198.51.100.9, 203.0.113.2'), 429)
+
+    def test_signup_throttled(self):
+        client.post('/api/users', json={})
+        self.assertEqual(client.post('/api/users', json={}).status_code, 429)
+
+    def test_database_backend_shared_bucket(self):
+        backend = rate_limit.DatabaseBackend()
+        key = f'test:ip:{datetime.utcnow().timestamp()}'
+        self.assertEqual(backend.take(key, 2, 2/60), 0)
+        self.assertEqual(backend.take(key, 2, 2/60), 0)
+        self.assertGreater(backend.take(key, 2, 2/60), 0)
+        self.assertEqual(model.RateLimitBucket.query.get(key).allowed, False)
+
+class TestDeadlines(unittest.TestCase):
+    def tearDown(self):
+        app.config['DEADLINE_BUDGETS'] = {}
+        model.db.session.rollback()
+
+    def test_statement_cancelled_at_deadline(self):
+        exceeded = metrics.get('deadline.exceeded.db')
+        model.db.session.rollback() # so the statement starts a transaction of its own
+        with app.test_request_context():
+            deadline.start(0.1)
+            with self.assertRaises(deadline.DeadlineExceeded):
+                model.db.session.execute(text('SELECT pg_sleep(2)'))
+        self.assertEqual(metrics.get('deadline.exceeded.db'), exceeded + 1)
+
+    def test_out_of_time_is_504(self):
+        app.config['DEADLINE_BUDGETS'] = {'read_recipe_timeline': 1e-9}
+        model.db.session.rollback()
+        response = client.get('/api/recipes/3')
+        self.assertEqual(response.status_code, 504)
+        app.config['DEADLINE_BUDGETS'] = {}
+        self.assertEqual(client.get('/api/recipes/3').status_code, 200) # the session's still usable
+
+    def test_http_timeout_capped_by_deadline(self):
+        self.assertEqual(deadline.http_timeout(3, 10), (3, 10)) # no request, no deadline
+        with app.test_request_context():
+            deadline.start(2)
+            connect, read = deadline.http_timeout(3, 10)
+            self.assertLessEqual(read, 2)
+            self.assertLessEqual(connect, 2)
+
+class TestOutboundHttp(LoggedInUser, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.stub = StubUpstream().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub.stop()
+
+    def setUp(self):
+        app.config['HTTP_UPSTREAMS'] = {name: {'base_url': self.stub.url} for name in ('spoonacular', 'cloudinary')}
+        outbound.reset()
+
+    def tearDown(self):
+        app.config['HTTP_UPSTREAMS'] = {}
+        app.config['HTTP_BREAKER_FAILURES'] = 5
+        outbound.reset()
+
+    def extract(self):
+        return client.get('/api/extract-recipe', query_string={'url': 'https://example.com/pancakes'})
+
+    def test_extract_retries_through_blips(self):
+        self.stub.fail(('status', 503), ('status', 502))
+        retries = metrics.get('http.spoonacular.retries')
+        sent = self.stub.requests
+        response = self.extract()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['title'], 'Buttermilk Pancakes')
+        self.assertEqual(self.stub.requests - sent, 3)
+        self.assertEqual(metrics.get('http.spoonacular.retries'), retries + 2)
+        self.assertGreater(metrics.snapshot()['timings']['http.spoonacular']['count'], 0)
+
+    def test_breaker_fails_fast(self):
+        app.config['HTTP_BREAKER_FAILURES'] = 2
+        app.config['HTTP_UPSTREAMS']['spoonacular']['retries'] = 0
+        self.stub.fail(('status', 500), ('status', 500))
+        self.assertEqual(self.extract().status_code, 502)
+        self.assertEqual(self.extract().status_code, 502)
+        sent = self.stub.requests
+        response = self.extract()
+        self.assertEqual(response.status_code, 503)
+        self.assertGreater(int(response.headers['Retry-After']), 0)
+        self.assertEqual(self.stub.requests, sent, "An open breaker shouldn't call out at all")
+
+    def test_slow_upstream_times_out(self):
+        app.config['HTTP_UPSTREAMS']['spoonacular'].update(read_timeout=0.2, retries=0)
+        self.stub.fail(('delay', 1))
+        self.assertEqual(self.extract().status_code, 504)
+
+    def test_avatar_upload(self):
+        token = self.get_api_token('makoto','phantomthieves')
+        user_id = model.User.get_by_username('makoto').id
+        response = client.patch(f'/api/users/{user_id}', headers={'Authorization': f'Bearer {token}'},
+                                data={'img_file': (io.BytesIO(b'not really a png'), 'avatar.png')})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json['new_avatar'].startswith('https://res.cloudinary.com/stub/'))
+        with model.db.engine.connect() as conn: # committed, not just set on the session
+            saved = conn.scalar(select(model.User.img_url).where(model.User.id == user_id))
+        self.assertEqual(saved, response.json['new_avatar'])
+
+    def test_avatar_upload_not_configured(self):
+        token = self.get_api_token('makoto','phantomthieves')
+        user_id = model.User.get_by_username('makoto').id
+        with mock.patch.dict(app.config, {'CLOUDINARY_SECRET': None}):
+            response = client.patch(f'/api/users/{user_id}', headers={'Authorization': f'Bearer {token}'},
+                                    data={'img_file': (io.BytesIO(b'not really a png'), 'avatar.png')})
+        self.assertEqual(response.status_code, 503)
+
+    def test_avatar_upload_retry_resends_file(self):
+        import requests
+        send, bodies = requests.Session.request, []
+        def connect_once(session, method, url, **kwargs):
+            bodies.append(requests.Request(method, url, data=kwargs.get('data'), files=kwargs.get('files')).prepare().body)
+            if len(bodies) == 1:
+                raise requests.ConnectTimeout()
+            return send(session, method, url, **kwargs)
+        token = self.get_api_token('makoto','phantomthieves')
+        user_id = model.User.get_by_username('makoto').id
+        with mock.patch.object(requests.Session, 'request', autospec=True, side_effect=connect_once):
+            response = client.patch(f'/api/users/{user_id}', headers={'Authorization': f'Bearer {token}'},
+                                    data={'img_file': (io.BytesIO(b'not really a png'), 'avatar.png')})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(bodies), 2)
+        self.assertIn(b'not really a png', bodies[1])
+
+class TestRecipeCounts(LoggedInUser, unittest.TestCase):
+    def setUp(self):
+        self.token = self.get_api_token('joker','phantomthieves')
+        self.other_token = self.get_api_token('makoto','phantomthieves')
+        client.post('/api/recipes', json={'title': 'Counted', 'ingredients': 'i', 'instructions': 'i'},
+                    headers = {'Authorization': f'Bearer {self.token}'})
+        self.recipe = model.User.get_by_username('joker').recipes[0]
+
+    def counts(self):
+        model.db.session.expire(self.recipe)
+        return (self.recipe.edit_count, self.recipe.experiment_count, self.recipe.fork_count, self.recipe.collaborator_count)
+
+    def test_counts_follow_writes(self):
+        self.assertEqual(self.counts(), (1, 0, 0, 0))
+        auth = {'Authorization': f'Bearer {self.token}'}
+        client.post(f'/api/recipes/{self.recipe.id}/edits', json={'title': 'Counted v2'}, headers=auth)
+        exp_id = client.post(f'/api/recipes/{self.recipe.id}/experiments', json={'commit_msg': 'try'}, headers=auth).json['id']
+        client.post(f'/api/recipes/{self.recipe.id}/permissions', json={'username': 'makoto', 'can_experiment': True}, headers=auth)
+        client.post(f'/api/recipes/{self.recipe.id}/fork', headers = {'Authorization': f'Bearer {self.other_token}'})
+        self.assertEqual(self.counts(), (2, 1, 1, 1))
+        client.delete(f'/api/experiments/{exp_id}', headers=auth)
+        client.delete(f'/api/recipes/{self.recipe.id}/permissions/{model.User.get_by_username("makoto").id}', headers=auth)
+        self.assertEqual(self.counts(), (2, 0, 1, 0))
+        profile = client.get('/api/users/joker', headers=auth).json
+        self.assertEqual(profile['recipes'][0]['edit_count'], 2)
+
+    def test_reconcile_fixes_drift(self):
+        model.Recipe.adjust_counts(self.recipe.id, edits=5, forks=-1)
+        model.db.session.commit()
+        self.assertGreaterEqual(model.Recipe.reconcile_counts(batch_size=2), 1)
+        self.assertEqual(self.counts(), (1, 0, 0, 0))
+
+    def test_sort_profile_by_count(self):
+        client.post(f'/api/recipes/{self.recipe.id}/edits', json={'title': 'Counted v2'},
+                    headers = {'Authorization': f'Bearer {self.token}'})
+        recipes = client.get('/api/users/joker?sort=edits').json['recipes']
+        self.assertEqual([r['edit_count'] for r in recipes], sorted((r['edit_count'] for r in recipes), reverse=True))
+        self.assertEqual(client.get('/api/users/joker?sort=likes').status_code, 400)
+
+class TestResponseCache(LoggedInUser, unittest.TestCase):
+    def setUp(self):
+        self.token = self.get_api_token('joker','phantomthieves')
+        owner = model.User.get_by_username('joker')
+        self.recipe = model.Recipe.create(owner, datetime.utcnow(), True, True)
+        model.Edit.create(self.recipe, 'Cached v1', '', 'ingredients', 'instructions', '', datetime.utcnow(), owner)
+        model.db.session.add(self.recipe)
+        model.db.session.commit()
+        rc.cache.reset()
+        metrics.reset()
+
+    def tearDown(self):
+        app.config['RESPONSE_CACHE_BACKEND'] = 'lru'
+        rc.cache.reset()
+
+    def test_public_timeline_cached_until_new_edit(self):
+        first = client.get(f'/api/recipes/{self.recipe.id}').json
+        self.assertEqual(client.get(f'/api/recipes/{self.recipe.id}').json, first)
+        self.assertEqual(metrics.get('cache.timeline.hit'), 1)
+        client.post(f'/api/recipes/{self.recipe.id}/edits', json={'title': 'Cached v2'},
+                    headers = {'Authorization': f'Bearer {self.token}'})
+        self.assertEqual(client.get(f'/api/recipes/{self.recipe.id}').json['title'], 'Cached v2')
+        self.assertEqual(metrics.get('cache.timeline.hit'), 1)
+
+    def test_viewer_classes_cached_separately(self):
+        public = client.get(f'/api/recipes/{self.recipe.id}').json
+        own = client.get(f'/api/recipes/{self.recipe.id}', headers = {'Authorization': f'Bearer {self.token}'}).json
+        self.assertFalse(public['can_edit'])
+        self.assertTrue(own['can_edit'])
+
+    def test_profile_invalidated_by_username_change(self):
+        self.assertEqual(client.get('/api/users/joker').json['username'], 'joker')
+        self.assertEqual(client.get('/api/users/joker').status_code, 200)
+        self.assertEqual(metrics.get('cache.profile.hit'), 1)
+        user = model.User.get_by_username('joker')
+        client.patch(f'/api/users/{user.id}', json={'new_username': 'joker2'},
+                     headers = {'Authorization': f'Bearer {self.token}'})
+        try:
+            self.assertEqual(client.get('/api/users/joker').status_code, 404)
+            timeline = client.get(f'/api/recipes/{self.recipe.id}').json
+            self.assertEqual(timeline['owner'], 'joker2')
+        finally:
+            client.patch(f'/api/users/{user.id}', json={'new_username': 'joker'},
+                         headers = {'Authorization': f'Bearer {self.token}'})
+
+    def test_database_backend(self):
+        app.config['RESPONSE_CACHE_BACKEND'] = 'database'
+        first = client.get(f'/api/recipes/{self.recipe.id}').json
+        self.assertEqual(client.get(f'/api/recipes/{self.recipe.id}').json, first)
+        self.assertEqual(metrics.get('cache.timeline.hit'), 1)
+        client.post(f'/api/recipes/{self.recipe.id}/experiments', json={'commit_msg': 'Tried it'},
+                    headers = {'Authorization': f'Bearer {self.token}'})
+        experiments = client.get(f'/api/recipes/{self.recipe.id}').json['timeline_items']['experiments']
+        self.assertEqual(experiments[0]['commit_msg'], 'Tried it')
+        self.assertEqual(client.get('/api/metrics').json['cache']['timeline']['hits'], 1)
+
+    def test_database_backend_invalidated_across_workers(self):
+        app.config['RESPONSE_CACHE_BACKEND'] = 'database'
+        writer, reader = rc.ResponseCache(), rc.ResponseCache() # as in two gunicorn workers
+        with app.test_request_context():
+            reader.store(Response(b'{}'), 'timeline', self.recipe.id, 'public', [f'recipe:{self.recipe.id}'])
+            self.assertIsNotNone(reader.get('timeline', self.recipe.id, 'public'))
+            writer.invalidate(rc.recipe_tags(self.recipe))
+            self.assertIsNone(reader.get('timeline', self.recipe.id, 'public'))
+
+    def test_public_hit_rechecks_visibility(self):
+        self.assertEqual(client.get(f'/api/recipes/{self.recipe.id}').json['title'], 'Cached v1')
+        # changed without invalidating this worker's cache, as by another worker
+        model.db.session.execute(update(model.Recipe).where(model.Recipe.id == self.recipe.id).values(is_experiments_public=False))
+        model.db.session.commit()
+        self.assertNotIn('experiments', client.get(f'/api/recipes/{self.recipe.id}').json['timeline_items'])
+        model.db.session.execute(update(model.Recipe).where(model.Recipe.id == self.recipe.id).values(is_public=False))
+        model.db.session.commit()
+        self.assertEqual(client.get(f'/api/recipes/{self.recipe.id}').status_code, 403)
+
+    def test_stale_fill_skipped(self):
+        backend = rc.LRUBackend(10)
+        started_at = datetime.utcnow()
+        backend.invalidate({'recipe:1'})
+        backend.put('timeline:1:public', b'{}', ['recipe:1'], 60, started_at)
+        self.assertIsNone(backend.get('timeline:1:public'))
+
 # grant permission one by one
 # and check if the other user can see it as they should
 # and if they can edit it as they should
@@ -257,8 +1655,14 @@ class TestPermissions(LoggedInUser, unittest.TestCase):
 
 
 if __name__ == "__main__":
-    app.config['TESTING'] = True
-    model.connect_to_db(app, '/forkd-testdb',False)
+    app = create_app({'TESTING': True,
+                      'TASKS_INLINE': True,
+                      'RATELIMIT_ENABLED': False, # most tests log in over and over; TestRateLimit turns it on
+                      'RATELIMIT_BACKEND': 'memory',
+                      'RESPONSE_CACHE_BACKEND': 'lru',
+                      'PUBSUB_BACKEND': 'memory',
+                      'CLOUDINARY_KEY': 'test', 'CLOUDINARY_SECRET': 'test', # uploads go to StubUpstream
+                      'DB_URI': '/forkd-testdb'})
     app.app_context().push()
     client = app.test_client()
    
@@ -288,6 +1692,7 @@ if __name__ == "__main__":
             model.db.session.add(recipe)
 
     model.db.session.commit()
+    model.Recipe.reconcile_counts()
   
     # Finally, run tests
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,102 @@
+"""Local stand-ins for Spoonacular and Cloudinary, so the API can be run and tested offline:
+
+    python3 upstream_stubs.py [--port 8765]
+
+then start the API with SPOONACULAR_URL=http://127.0.0.1:8765 and CLOUDINARY_API_URL=http://127.0.0.1:8765.
+Tests start one in-process with StubUpstream().start(), and queue faults (slow answers, error statuses) on it.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+import argparse
+import json
+import threading
+import time
+
+EXTRACTED_RECIPE = {
+    'title': 'Buttermilk Pancakes',
+    'sourceName': 'Stub Kitchen',
+    'summary': 'Fluffy pancakes.',
+    'license': 'CC BY 4.0',
+    'image': 'https://example.com/pancakes.jpg',
+    'instructions': '<ol><li>Whisk the dry ingredients.</li><li>Beat in the buttermilk and eggs.</li>'
+                    '<li>Cook on a hot griddle until golden.</li></ol>',
+    'extendedIngredients': [
+        {'nameClean': 'all purpose flour', 'name': 'flour', 'amount': 2, 'unit': 'cups', 'original': '2 cups flour'},
+        {'nameClean': 'buttermilk', 'name': 'buttermilk', 'amount': 2, 'unit': 'cups', 'original': '2 cups buttermilk'},
+        {'nameClean': 'egg', 'name': 'eggs', 'amount': 2, 'unit': '', 'original': '2 eggs'},
+    ],
+}
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, as the real APIs do
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self) -> None:
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        fault = self.server.next_fault()
+        if fault and fault[0] == 'delay':
+            time.sleep(fault[1])
+        if fault and fault[0] == 'status':
+            return self._reply(fault[1], {'message': 'stubbed failure'})
+        path = urlparse(self.path).path
+        if path == '/recipes/extract':
+            return self._reply(200, EXTRACTED_RECIPE)
+        if path.endswith('/image/upload'):
+            return self._reply(200, {'secure_url': f'https://res.cloudinary.com/stub/image/upload/v{int(time.time())}/avatar.png'})
+        self._reply(404, {'message': 'no such stub'})
+
+    do_GET = do_POST = _handle
+
+class StubUpstream(ThreadingHTTPServer):
+    """Answers like Spoonacular's /recipes/extract and Cloudinary's /v1_1/<cloud>/image/upload.
+    fail(('status', 503), ('delay', 2.0), ...) queues faults, one per request, before it goes back to answering normally."""
+    daemon_threads = True
+
+    def __init__(self, port: int = 0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.requests = 0
+        self._faults = []
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def handle_error(self, request, client_address):
+        pass # a client that timed out and hung up, which tests do on purpose
+
+    def fail(self, *faults: tuple) -> None:
+        with self._lock:
+            self._faults.extend(faults)
+
+    def next_fault(self) -> tuple | None:
+        with self._lock:
+            self.requests += 1
+            return self._faults.pop(0) if self._faults else None
+
+    def start(self) -> 'StubUpstream':
+        threading.Thread(target=self.serve_forever, name='upstream-stub', daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    stub = StubUpstream(args.port)
+    print(f'Stub Spoonacular and Cloudinary on {stub.url}')
+    stub.serve_forever()